@@ -4,26 +4,80 @@
     tdesc
     
     cat filenames | python -m tdesc --model vgg16 --crow > feats
+    
+    python -m tdesc index build|query ...  (see tdesc/index.py)
+    
+    python -m tdesc serve --model vgg16 --socket /tmp/tdesc.sock  (see tdesc/server.py)
+    cat filenames | python -m tdesc client --socket /tmp/tdesc.sock > feats
 """
 
+import os
+import sys
 import argparse
 
-def parse_args():
+from tdesc.artifacts import ImageArtifact
+from tdesc.writers import TSVWriter, JSONWriter, BinaryWriter, StoreWriter, ChipWriter, DetectionWriter, \
+    DeadLetterWriter
+
+
+def parse_args(argv=None, serve=False):
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, default='vgg16')
     parser.add_argument('--io-threads', type=int, default=3)
+    parser.add_argument('--decode-procs', type=int, default=0)
     parser.add_argument('--timeout', type=int, default=10)
+    parser.add_argument('--max-pending', type=int, default=0)
+    parser.add_argument('--unordered', action='store_true')
+    parser.add_argument('--fetch-connections', type=int, default=32)
+    parser.add_argument('--fetch-per-host', type=int, default=8)
+    parser.add_argument('--fetch-retries', type=int, default=3)
+    parser.add_argument('--fetch-backoff', type=float, default=0.5)
+    parser.add_argument('--hedge-after', type=float, default=None)
+    parser.add_argument('--deadline', type=float, default=None)
+    parser.add_argument('--dead-letter', type=str, default=None)
+    parser.add_argument('--cache', type=str, default=None)
+    parser.add_argument('--cache-size', type=int, default=10000)
+    parser.add_argument('--dedup-radius', type=int, default=None)
+    parser.add_argument('--dedup-size', type=int, default=100000)
+    parser.add_argument('--output-format', type=str, default='tsv', choices=['tsv', 'binary', 'h5'])
+    parser.add_argument('--outpath', type=str, default=None)
+    parser.add_argument('--output-dtype', type=str, default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--n-shards', type=int, default=16)
+    parser.add_argument('--resume', type=str, default=None)
+    parser.add_argument('--metrics', action='store_true')
+    parser.add_argument('--metrics-path', type=str, default=None)
+    parser.add_argument('--trace', type=str, default=None)
+    parser.add_argument('--trace-sample', type=float, default=0.01)
+    
+    # Post-processing
+    parser.add_argument('--l2-norm', action='store_true')
+    parser.add_argument('--pca-dim', type=int, default=0)
+    parser.add_argument('--pca-fit', type=int, default=10000)
+    parser.add_argument('--pca-path', type=str, default=None)
+    parser.add_argument('--quantize', type=str, default=None, choices=['float16', 'int8'])
+    
     parser.add_argument('--target-dim', type=int, default=224)
+    parser.add_argument('--no-draft', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=0)
+    parser.add_argument('--max-wait', type=float, default=0.05)
     
     # VGG16 options
     parser.add_argument('--crow', action="store_true")
+    parser.add_argument('--descriptors', type=str, default=None)
+    parser.add_argument('--model-cache', type=str, default=None)
     
     # DlibFace options
     parser.add_argument('--dnn', action='store_true')
     parser.add_argument('--upsample', type=int, default=0)
-    parser.add_argument('--batch-size', type=int, default=0)
     parser.add_argument('--num-jitters', type=int, default=10)
     parser.add_argument('--det-threshold', type=float, default=0.0)
+    parser.add_argument('--face-procs', type=int, default=0)
+    parser.add_argument('--face-sizes', type=str, default=None)
+    
+    # DlibAlign options
+    parser.add_argument('--chip-size', type=int, default=150)
+    parser.add_argument('--chip-padding', type=float, default=0.25)
+    parser.add_argument('--best-face', action='store_true')
     
     # Yolo options
     parser.add_argument('--yolo-cfg-path', type=str, required=False)
@@ -31,30 +85,109 @@ def parse_args():
     parser.add_argument('--yolo-name-path', type=str, required=False)
     parser.add_argument('--yolo-thresh', type=float, default=0.1)
     parser.add_argument('--yolo-nms', type=float, default=0.3)
+    parser.add_argument('--yolo-columns', action='store_true')
     
-    args = parser.parse_args()
+    # Stub options (benchmarking)
+    parser.add_argument('--stub-latency', type=float, default=0.0)
     
-    if args.model == 'yolo':
+    if serve:
+        parser.add_argument('--socket', type=str, default=None)
+        parser.add_argument('--port', type=int, default=None)
+        parser.add_argument('--max-clients', type=int, default=64)
+        parser.add_argument('--max-inflight', type=int, default=256)
+        parser.add_argument('--max-per-client', type=int, default=64)
+    
+    args = parser.parse_args(argv)
+    
+    if serve:
+        assert (args.socket is None) != (args.port is None), 'tdesc: serve needs one of --socket or --port'
+        assert args.output_format == 'tsv' and args.model != 'dlib_align', \
+            'tdesc: serve only writes results back to clients (no --output-format / dlib_align)'
+        assert not args.resume, 'tdesc: serve does not support --resume'
+        assert not args.pca_dim or (args.pca_path and os.path.exists(args.pca_path)), \
+            'tdesc: serve w/ --pca-dim requires an existing --pca-path fit'
+    
+    if 'yolo' in args.model.split(','):
         assert args.yolo_cfg_path is not None
         assert args.yolo_weight_path is not None
         assert args.yolo_nms is not None
     
+    if ',' in args.model:
+        # MultiWorker only calls each model's `prepare` / `featurize_batch`, and the
+        # sharded face worker does its work in `_decode_and_prepare`
+        assert not args.face_procs, 'tdesc: --face-procs cannot be combined w/ other models'
+    
+    if 'dlib_align' in args.model.split(','):
+        assert args.model == 'dlib_align', 'tdesc: dlib_align cannot be combined w/ other models'
+        assert args.outpath is not None, 'tdesc: --model dlib_align requires --outpath (chip pack prefix)'
+    
+    if args.cache or args.dedup_radius is not None:
+        # cached and copied results go through the worker's `to_cache` / `from_cache`
+        assert ',' not in args.model and args.model != 'dlib_align', \
+            'tdesc: --cache / --dedup-radius need a single model other than dlib_align'
+    
+    if args.output_format == 'binary' and args.model == 'yolo':
+        assert args.outpath is not None, 'tdesc: --output-format binary requires --outpath'
+    elif args.output_format != 'tsv':
+        assert args.outpath is not None, 'tdesc: --output-format %s requires --outpath' % args.output_format
+        assert args.model in ('vgg16', 'dlib_face', 'stub'), \
+            'tdesc: --output-format %s needs a single descriptor model' % args.output_format
+        assert not args.descriptors or ',' not in args.descriptors, \
+            'tdesc: --output-format %s needs a single --descriptors' % args.output_format
+    
+    if args.l2_norm or args.pca_dim or args.quantize:
+        # post-processing rewrites descriptor rows, so needs a TSV / binary / h5 writer
+        assert args.model in ('vgg16', 'dlib_face', 'stub'), \
+            'tdesc: post-processing needs a single descriptor model'
+        
+        # one pipeline (and PCA fit) per run, so all rows must be the same descriptor
+        assert not args.descriptors or ',' not in args.descriptors, \
+            'tdesc: post-processing needs a single --descriptors'
+    
+    if args.quantize:
+        args.output_dtype = args.quantize
+    
+    # casting unscaled floats to int8 wraps around
+    assert args.output_dtype != 'int8' or args.quantize == 'int8', \
+        'tdesc: --output-dtype int8 requires --quantize int8'
+    
+    if args.resume and args.pca_dim:
+        # rows held back for the PCA fit can't be checkpointed
+        assert args.pca_path and os.path.exists(args.pca_path), \
+            'tdesc: --resume w/ --pca-dim requires an existing --pca-path fit'
+    
     return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    
-    if args.model == 'vgg16':
+def stdin_artifacts(artifact_cls=ImageArtifact):
+    for line in sys.stdin:
+        path = line.strip()
+        if path:
+            yield artifact_cls(path, path, save_results=False)
+
+
+def get_worker(model, args):
+    if model == 'vgg16':
         from tdesc.workers import VGG16Worker
-        worker = VGG16Worker(**{
+        return VGG16Worker(**{
             "crow" : args.crow,
             "target_dim" : args.target_dim,
+            "descriptors" : args.descriptors.split(',') if args.descriptors else None,
+            "model_cache" : args.model_cache,
         })
-    elif args.model == 'dlib_face':
-        if not args.batch_size:
+    elif model == 'dlib_face':
+        if args.face_procs:
+            from tdesc.workers import DlibFaceShardedWorker
+            return DlibFaceShardedWorker(**{
+                "n_procs" : args.face_procs,
+                "dnn" : args.dnn,
+                "num_jitters" : args.num_jitters,
+                "det_threshold" : args.det_threshold,
+                "upsample" : args.upsample,
+            })
+        elif not args.batch_size:
             from tdesc.workers import DlibFaceWorker
-            worker = DlibFaceWorker(**{
+            return DlibFaceWorker(**{
                 "dnn" : args.dnn,
                 "num_jitters" : args.num_jitters,
                 "det_threshold" : args.det_threshold,
@@ -62,23 +195,216 @@ if __name__ == "__main__":
             })
         else:
             from tdesc.workers import DlibFaceBatchWorker
-            worker = DlibFaceBatchWorker(**{
-                "batch_size" : args.batch_size,
-                "num_jitters" : args.num_jitters
+            return DlibFaceBatchWorker(**{
+                "num_jitters" : args.num_jitters,
+                "canonical_sizes" : [
+                    tuple(int(x) for x in size.split('x')) for size in args.face_sizes.split(',')
+                ] if args.face_sizes else None,
             })
-    elif args.model == 'yolo':
+    elif model == 'dlib_align':
+        from tdesc.workers import DlibAlignWorker
+        return DlibAlignWorker(**{
+            "size" : args.chip_size,
+            "padding" : args.chip_padding,
+            "det_threshold" : args.det_threshold,
+            "upsample" : args.upsample,
+            "best_face" : args.best_face,
+        })
+    elif model == 'stub':
+        from tdesc.workers import StubWorker
+        return StubWorker(**{
+            "latency" : args.stub_latency,
+            "target_dim" : args.target_dim,
+        })
+    elif model == 'yolo':
         from tdesc.workers import YoloWorker
-        worker = YoloWorker(**{
+        return YoloWorker(**{
             "cfg_path" : args.yolo_cfg_path,
             "weight_path" : args.yolo_weight_path,
             "name_path" : args.yolo_name_path,
             "thresh" : args.yolo_thresh,
             "nms" : args.yolo_nms,
+            "columns" : args.yolo_columns,
         })
     else:
-        print("tdesc: Unknown model=%s" % args.model, file=sys.stderr)
+        print("tdesc: Unknown model=%s" % model, file=sys.stderr)
         raise Exception()
+
+
+def get_writer(args, stream=sys.stdout):
+    if args.model == 'dlib_align':
+        from tdesc.packfile import PackWriter
+        return ChipWriter(PackWriter(args.outpath))
+    elif args.model == 'yolo' and args.output_format == 'binary':
+        return DetectionWriter(args.outpath)
+    elif args.model == 'yolo' or ',' in args.model:
+        return JSONWriter(stream)
+    elif args.output_format == 'binary':
+        return BinaryWriter(args.outpath, dtype=args.output_dtype)
+    elif args.output_format == 'h5':
+        from tdesc.store import ShardedStore
+        return StoreWriter(ShardedStore(args.outpath, n_shards=args.n_shards, dtype=args.output_dtype))
+    else:
+        return TSVWriter(stream)
+
+
+def get_postprocessor(args):
+    from tdesc import postprocess
+    
+    steps = []
+    if args.l2_norm:
+        steps.append(postprocess.L2Normalize())
+    
+    if args.pca_dim:
+        steps.append(postprocess.PCAWhitening(args.pca_dim, fit_size=args.pca_fit, path=args.pca_path))
+        steps.append(postprocess.L2Normalize())
+    
+    if args.quantize:
+        steps.append(postprocess.Quantize(args.quantize))
+    
+    return postprocess.Pipeline(steps) if steps else None
+
+
+def get_run_kwargs(args):
+    run_kwargs = {
+        "io_threads" : args.io_threads,
+        "timeout" : args.timeout,
+        "max_pending" : args.max_pending or None,
+        "ordered" : not args.unordered,
+        "decode_procs" : args.decode_procs,
+        "fetch_connections" : args.fetch_connections,
+        "fetch_per_host" : args.fetch_per_host,
+        "fetch_retries" : args.fetch_retries,
+        "fetch_backoff" : args.fetch_backoff,
+        "hedge_after" : args.hedge_after,
+        "deadline" : args.deadline,
+        "cache_path" : args.cache,
+        "cache_size" : args.cache_size,
+        "dedup_radius" : args.dedup_radius,
+        "dedup_size" : args.dedup_size,
+    }
+    if args.batch_size:
+        run_kwargs.update({
+            "batch_size" : args.batch_size,
+            "max_wait" : args.max_wait,
+        })
+    
+    return run_kwargs
+
+
+def build_worker(args):
+    models = args.model.split(',')
+    if len(models) == 1:
+        worker = get_worker(models[0], args)
+    else:
+        from tdesc.workers import MultiWorker
+        worker = MultiWorker([(model, get_worker(model, args)) for model in models])
+    
+    if args.no_draft:
+        worker.draft = False
+    
+    return worker
+
+
+def get_metrics(args, worker, tracer=None):
+    from tdesc.metrics import Metrics
+    return Metrics(**{
+        "stream" : sys.stderr if args.metrics else None,
+        "textfile" : args.metrics_path,
+        "interval" : worker.print_interval,
+        "tracer" : tracer,
+    })
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        from tdesc.index import main
+        main(sys.argv[2:])
+        sys.exit(0)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'client':
+        from tdesc.server import client
+        sys.exit(client(sys.argv[2:]))
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from tdesc.server import serve
+        args = parse_args(sys.argv[2:], serve=True)
+        worker = build_worker(args)
+        
+        run_kwargs = get_run_kwargs(args)
+        run_kwargs['metrics'] = get_metrics(args, worker)
+        if args.dead_letter:
+            run_kwargs['dead_letters'] = DeadLetterWriter(args.dead_letter)
+        
+        def make_writer(stream):
+            writer = get_writer(args, stream)
+            pipeline = get_postprocessor(args)
+            if pipeline is not None:
+                from tdesc.postprocess import PostprocessWriter
+                writer = PostprocessWriter(writer, pipeline)
+            
+            return writer
+        
+        serve(worker, run_kwargs, make_writer, **{
+            "socket_path" : args.socket,
+            "port" : args.port,
+            "max_clients" : args.max_clients,
+            "max_inflight" : args.max_inflight,
+            "max_per_client" : args.max_per_client,
+        })
+        sys.exit(0)
+    
+    args = parse_args()
+    worker = build_worker(args)
+    run_kwargs = get_run_kwargs(args)
+    
+    writer = get_writer(args)
+    pipeline = get_postprocessor(args)
+    if pipeline is not None:
+        from tdesc.postprocess import PostprocessWriter
+        writer = PostprocessWriter(writer, pipeline)
+    
+    image_artifacts = stdin_artifacts(worker.artifact_class)
+    
+    checkpoint = None
+    if args.resume:
+        from tdesc.checkpoint import Checkpoint
+        checkpoint = Checkpoint(args.resume, before_sync=writer.flush)
+        image_artifacts = checkpoint.filter(image_artifacts)
+        print('tdesc: resuming from %s (%d done)' % (args.resume, len(checkpoint)), file=sys.stderr)
+    
+    tracer = None
+    if args.trace:
+        from tdesc.trace import Tracer
+        tracer = Tracer(args.trace, sample=args.trace_sample)
+    
+    metrics = get_metrics(args, worker, tracer)
+    run_kwargs['metrics'] = metrics
+    
+    dead_letters = None
+    if args.dead_letter:
+        dead_letters = DeadLetterWriter(args.dead_letter)
+        run_kwargs['dead_letters'] = dead_letters
+    
+    for result in worker.run(image_artifacts, **run_kwargs):
+        if result is not None:
+            with metrics.timer('serialize', [id(worker.artifact(result))]):
+                writer.write(worker, result)
+            if checkpoint is not None:
+                checkpoint.mark(worker.artifact(result).id)
+    
+    if checkpoint is not None:
+        checkpoint.close()
+        print('tdesc: skipped %d completed inputs' % checkpoint.n_skipped, file=sys.stderr)
+    
+    writer.close()
+    worker.close()
+    
+    if dead_letters is not None:
+        dead_letters.close()
+        if dead_letters.n:
+            print('tdesc: %d failed inputs written to %s' % (dead_letters.n, args.dead_letter), file=sys.stderr)
     
-    for w in worker.run(io_threads=args.io_threads, timeout=args.timeout):
-        pass
+    if tracer is not None:
+        tracer.close()
 
@@ -4,9 +4,8 @@ Centralized models module.
 Contains all model objects used within
 the ApeFace analytics.
 """
-import os
-import h5py
 import json
+import numpy as np
 
 from datetime import datetime
 
@@ -28,30 +27,31 @@ class ImageArtifact(object):
     Data structure used to communicate between
     Image analytics, and application layer.
     """
-    def __init__(self, id, filepath, save_results=True, *args, **kwargs):
+    def __init__(self, id, filepath, save_results=True, md5=None, store=None, *args, **kwargs):
         self.id = id
         self.filepath = filepath
-        self.db = self._create_db() if save_results else None
+        self.md5 = md5
+        self.phash = None
+        self.size = None
+        self.timed_out = False
+        self.store = store if save_results else None
+        self.rows = None
         self.image = None
 
-    def _create_db(self):
-        """Creates a DB (h5) file.
+    def load(self):
+        """Read this artifact's descriptors back from its store.
 
-        If existing DB exists, delete it
-        and create a new one.
+        Artifacts don't own a file -- once written to a
+        `tdesc.store.ShardedStore`, `self.rows` is the
+        (shard, start, stop) row range holding them.
 
         Returns:
-            h5py file
+            (n, dim) array, or None if nothing was saved
         """
-        if os.path.exists(self.db_path):
-            os.remove(self.db_path)
+        if self.store is None or self.rows is None:
+            return None
 
-        return h5py.File(self.db_path)
-
-    @property
-    def db_path(self):
-        """Returns db path to save h5."""
-        raise NotImplementedError
+        return self.store.read(*self.rows)
 
     @classmethod
     def from_dict(cls, dic, *args, **kwargs):
@@ -72,20 +72,17 @@ class ImageArtifact(object):
         Returns:
             ImageArtifact
         """
-        return cls(dic['_id'], dic['filepath'], *args, **kwargs)
+        return cls(dic['_id'], dic['filepath'], md5=dic.get('md5'), *args, **kwargs)
 
     def close(self):
-        """Wrapper around h5py.close()
-
-        Not all image artifacts will have an
-        associated H5.
+        """Artifacts no longer hold open files -- the
+        store owns them, see `ShardedStore.close()`.
         """
-        if self.db:
-            self.db.close()
+        pass
 
     def to_dict(self):
         """Returns dict representation of class."""
-        return {"_id": self.id, "filepath": filepath}
+        return {"_id": self.id, "filepath": self.filepath}
 
 
 class YoloFeature(Feature):
@@ -109,16 +106,80 @@ class YoloFeature(Feature):
 
 
 class YoloArtifact(ImageArtifact):
+    """YoloArtifact class.
+
+    Detections are stored as columns -- class index,
+    confidence and bbox (top, bottom, left, right) --
+    w/ one timestamp per artifact, instead of one
+    `YoloFeature` per detection.
+    """
     def __init__(self, *args, **kwargs):
         super(YoloArtifact, self).__init__(*args, **kwargs)
 
-        self.features = []
+        self.created = datetime.utcnow()
+        self.class_names = []
+        self.cls = np.zeros(0, dtype=np.int32)
+        self.confidence = np.zeros(0, dtype=np.float64)
+        self.bbox = np.zeros((0, 4), dtype=np.int32)
+
+    def set_detections(self, cls, confidence, bbox, class_names):
+        """Set all detections at once.
+
+        Args:
+            cls: class indices into `class_names`
+            confidence: detection scores
+            bbox: (top, bottom, left, right) per detection
+            class_names: list of class names (shared, not copied)
+        """
+        self.created = datetime.utcnow()
+        self.class_names = class_names
+        self.cls = np.asarray(cls, dtype=np.int32)
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self.bbox = np.asarray(bbox).reshape(-1, 4) if len(bbox) else np.zeros((0, 4), dtype=np.int32)
 
-    def _create_db(self):
-        return None
+    def __len__(self):
+        return len(self.cls)
+
+    @property
+    def features(self):
+        """Detections as `YoloFeature`s, built on demand.
+
+        Slow on dense scenes -- prefer the columns.
+        """
+        features = []
+        for c, confidence, bbox in zip(self.cls.tolist(), self.confidence.tolist(), self.bbox.tolist()):
+            feature = YoloFeature(self.class_names[c], confidence, bbox)
+            feature.created = self.created
+            features.append(feature)
+
+        return features
+
+    def to_columns(self):
+        """Returns dict of columns, one list per field."""
+        return {
+            "_id": self.id,
+            "created": str(self.created),
+            "class_name": [self.class_names[c] for c in self.cls.tolist()],
+            "confidence": self.confidence.tolist(),
+            "bbox": self.bbox.tolist(),
+        }
 
     def to_dict(self):
+        """Returns dict representation of class.
+
+        Same layout as when each detection was a `YoloFeature`.
+        """
+        created = str(self.created)
         return {
             "_id": self.id,
-            "yolo": [yf.to_dict() for yf in self.features]
+            "yolo": [
+                {
+                    "created": created,
+                    "error": "",
+                    "class_name": self.class_names[c],
+                    "confidence": confidence,
+                    "bbox": bbox,
+                }
+                for c, confidence, bbox in zip(self.cls.tolist(), self.confidence.tolist(), self.bbox.tolist())
+            ]
         }
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+"""
+    bench.py
+
+    Reproducible throughput benchmarks -- no GPU or network needed
+
+        python -m tdesc.bench --io-threads 1,4,8 --batch-size 1,16 --source file,http > results.jsonl
+        python -m tdesc.bench compare base.jsonl results.jsonl
+
+    Generates a synthetic JPEG corpus, serves it from a local HTTP server for
+    `--source http`, and runs `StubWorker` (a model w/ configurable latency)
+    through the real pipeline.  Writes one JSON line per measurement:
+    per-stage throughput (each stage run alone, single threaded) and
+    end-to-end throughput for every combination of the grid.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+from PIL import Image
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from tdesc.artifacts import ImageArtifact
+from tdesc.decode import load_rgb
+from tdesc.fetch import AsyncFetcher
+from tdesc.writers import TSVWriter, BinaryWriter
+from tdesc.workers.stub_worker import StubWorker
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m tdesc.bench')
+    parser.add_argument('--n-images', type=int, default=256)
+    parser.add_argument('--image-size', type=str, default='640x480')
+    parser.add_argument('--corpus-dir', type=str, default=None)
+    parser.add_argument('--seed', type=int, default=123)
+
+    parser.add_argument('--source', type=str, default='file')
+    parser.add_argument('--io-threads', type=str, default='1,4')
+    parser.add_argument('--batch-size', type=str, default='1,16')
+    parser.add_argument('--decode-procs', type=str, default='0')
+
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--item-latency', type=float, default=0.001)
+    parser.add_argument('--http-latency', type=float, default=0.0)
+    parser.add_argument('--repeats', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def _ints(x):
+    return [int(v) for v in x.split(',')]
+
+
+# --
+# Corpus
+
+def make_corpus(outdir, n_images, size=(640, 480), seed=123):
+    """ Smooth random images, so JPEG sizes and decode costs are photo-like """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(n_images):
+        path = os.path.join(outdir, '%06d.jpg' % i)
+        if not os.path.exists(path):
+            small = (rng.rand(size[1] // 16, size[0] // 16, 3) * 255).astype(np.uint8)
+            Image.fromarray(small).resize(size, Image.BICUBIC).save(path, quality=90)
+        else:
+            rng.rand(size[1] // 16, size[0] // 16, 3)
+
+        paths.append(path)
+
+    return paths
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        return SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(root, latency=0.0, handler=None):
+    """
+        Local stand-in for an image host.  Returns (server, base url)
+
+        handler: a subclass of `_Handler` to use instead, eg one that injects
+        errors for tests
+    """
+    handler = type('Handler', (handler or _Handler,), {"latency" : latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=root))
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+# --
+# Measurements
+
+def _env():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        commit = None
+
+    return {
+        "commit" : commit,
+        "python" : platform.python_version(),
+        "numpy" : np.__version__,
+        "cpus" : os.cpu_count(),
+    }
+
+
+def _timed(fn, items):
+    start = time.time()
+    for item in items:
+        fn(item)
+
+    return time.time() - start
+
+
+def bench_stages(paths, urls, worker, batch_size):
+    """ Each stage alone, single threaded, over the whole corpus """
+    n = len(paths)
+    out = []
+
+    fetcher = AsyncFetcher()
+    srcs = {}
+    def fetch(i):
+        if urls:
+            srcs[i] = fetcher.fetch(urls[i])
+        else:
+            with open(paths[i], 'rb') as f:
+                srcs[i] = f.read()
+
+    out.append(("fetch", _timed(fetch, range(n))))
+    fetcher.close()
+
+    imgs = {}
+    def decode(i):
+        imgs[i] = load_rgb(srcs[i], **worker.decode_args())
+
+    out.append(("decode", _timed(decode, range(n))))
+
+    prepared = {}
+    def prepare(i):
+        prepared[i] = worker.prepare(imgs[i])
+
+    out.append(("prepare", _timed(prepare, range(n))))
+
+    artifacts = [ImageArtifact(p, p, save_results=False) for p in paths]
+    batches = [
+        [(artifacts[i], prepared[i]) for i in range(start, min(start + batch_size, n))]
+        for start in range(0, n, batch_size)
+    ]
+    results = []
+    out.append(("inference", _timed(lambda b: results.extend(worker.featurize_batch(b)), batches)))
+
+    with open(os.devnull, 'w') as devnull:
+        tsv = TSVWriter(devnull)
+        out.append(("serialize_tsv", _timed(lambda r: tsv.write(worker, r), results)))
+        tsv.close()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        binary = BinaryWriter(os.path.join(tmpdir, 'bench'))
+        try:
+            out.append(("serialize_binary", _timed(lambda r: binary.write(worker, r), results)))
+        finally:
+            binary.close()
+
+    return out
+
+
+def bench_e2e(inputs, worker, io_threads, batch_size, decode_procs):
+    artifacts = (ImageArtifact(p, p, save_results=False) for p in inputs)
+
+    start = time.time()
+    n = sum(1 for _ in worker.run(artifacts, io_threads=io_threads, batch_size=batch_size,
+                                   max_wait=0.01, decode_procs=decode_procs))
+    return n, time.time() - start
+
+
+def run(args):
+    size = tuple(_ints(args.image_size.replace('x', ',')))
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), 'tdesc-bench-%dx%d-%d' % (size[0], size[1], args.seed))
+    paths = make_corpus(corpus_dir, args.n_images, size=size, seed=args.seed)
+
+    server, base_url = serve(corpus_dir, latency=args.http_latency)
+    try:
+        _run(args, paths, base_url)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _run(args, paths, base_url):
+    urls = ['%s/%s' % (base_url, os.path.basename(p)) for p in paths]
+
+    worker = StubWorker(latency=args.latency, item_latency=args.item_latency)
+    env = _env()
+    config = {
+        "n_images" : len(paths),
+        "image_size" : args.image_size,
+        "latency" : args.latency,
+        "item_latency" : args.item_latency,
+        "http_latency" : args.http_latency,
+    }
+
+    def emit(record):
+        record.update(config)
+        record.update(env)
+        print(json.dumps(record))
+        sys.stdout.flush()
+
+    for source in args.source.split(','):
+        for batch_size in _ints(args.batch_size):
+            for stage, seconds in bench_stages(paths, urls if source == 'http' else None, worker, batch_size):
+                emit({
+                    "kind" : "stage",
+                    "stage" : stage,
+                    "source" : source,
+                    "batch_size" : batch_size,
+                    "seconds" : seconds,
+                    "images_per_sec" : len(paths) / seconds if seconds > 0 else None,
+                })
+
+    for source in args.source.split(','):
+        inputs = urls if source == 'http' else paths
+        for io_threads in _ints(args.io_threads):
+            for batch_size in _ints(args.batch_size):
+                for decode_procs in _ints(args.decode_procs):
+                    for repeat in range(args.repeats):
+                        n, seconds = bench_e2e(inputs, worker, io_threads, batch_size, decode_procs)
+                        emit({
+                            "kind" : "e2e",
+                            "source" : source,
+                            "io_threads" : io_threads,
+                            "batch_size" : batch_size,
+                            "decode_procs" : decode_procs,
+                            "repeat" : repeat,
+                            "n_done" : n,
+                            "seconds" : seconds,
+                            "images_per_sec" : n / seconds if seconds > 0 else None,
+                        })
+
+
+# --
+# Compare
+
+_key_fields = ('kind', 'stage', 'source', 'io_threads', 'batch_size', 'decode_procs', 'n_images', 'image_size',
+               'latency', 'item_latency', 'http_latency')
+
+
+def _load(path):
+    groups = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            key = tuple((k, record.get(k)) for k in _key_fields if record.get(k) is not None)
+            groups.setdefault(key, []).append(record['images_per_sec'])
+
+    return dict((key, float(np.median(v))) for key, v in groups.items())
+
+
+def compare(base_path, new_path):
+    """ Median images/sec per configuration, new vs base """
+    base, new = _load(base_path), _load(new_path)
+    for key in sorted(set(base) & set(new)):
+        print('\t'.join((
+            ' '.join('%s=%s' % kv for kv in key),
+            '%.1f' % base[key],
+            '%.1f' % new[key],
+            '%.2fx' % (new[key] / base[key]),
+        )))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        compare(*sys.argv[2:4])
+    else:
+        run(parse_args(sys.argv[1:]))
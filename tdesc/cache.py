@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+    cache.py
+
+    Content addressed descriptor cache
+
+    Keyed by (model configuration, md5 of the image bytes), so exact duplicates
+    and re-runs skip decoding and inference.  Recently used entries live in an
+    in-memory LRU, everything lives in a SQLite file.
+"""
+import json
+import sqlite3
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def config_digest(config):
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DescriptorCache(object):
+
+    def __init__(self, path, config, capacity=10000, flush_every=256):
+        self.path = path
+        self.config = config_digest(config)
+        self.capacity = capacity
+        self.flush_every = flush_every
+
+        self._lru = OrderedDict()
+        self._pending = {}  # md5 -> blob, not yet in SQLite
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS descriptors ('
+            'config TEXT, md5 TEXT, value BLOB, PRIMARY KEY (config, md5))'
+        )
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, md5):
+        """ Returns the cached blob for `md5`, or None """
+        with self._lock:
+            if md5 in self._lru:
+                self._lru.move_to_end(md5)
+                self.hits += 1
+                return self._lru[md5]
+
+            if md5 in self._pending:
+                # evicted from the LRU before it was flushed
+                self.hits += 1
+                self._remember(md5, self._pending[md5])
+                return self._lru[md5]
+
+            row = self.db.execute(
+                'SELECT value FROM descriptors WHERE config=? AND md5=?', (self.config, md5)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._remember(md5, bytes(row[0]))
+            return self._lru[md5]
+
+    def put(self, md5, blob):
+        with self._lock:
+            self._remember(md5, blob)
+            self._pending[md5] = blob
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+
+    def _remember(self, md5, blob):
+        self._lru[md5] = blob
+        self._lru.move_to_end(md5)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def _flush(self):
+        if self._pending:
+            self.db.executemany('INSERT OR REPLACE INTO descriptors VALUES (?, ?, ?)', [
+                (self.config, md5, sqlite3.Binary(blob)) for md5, blob in self._pending.items()
+            ])
+            self.db.commit()
+            self._pending = {}
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+    checkpoint.py
+
+    Progress index for resuming long runs.
+
+    Completed ids are kept as 64-bit blake2b digests, in memory as a set and
+    on disk as an append-only file of 8 byte records.  The file is fsync'd
+    every `sync_every` marks or `sync_interval` seconds, so a crash loses at
+    most that much progress (those inputs are just recomputed).
+"""
+import os
+import hashlib
+import numpy as np
+from time import time
+
+
+def _digest(id):
+    return int.from_bytes(hashlib.blake2b(id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, sync_every=1000, sync_interval=10, before_sync=None):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.before_sync = before_sync
+
+        self.done = set()
+        if os.path.exists(path):
+            # Ignore a partial trailing record from a crash mid-write
+            n = os.path.getsize(path) // 8
+            self.done.update(np.fromfile(path, dtype='<u8', count=n).tolist())
+            with open(path, 'r+b') as f:
+                f.truncate(n * 8)
+
+        self.n_skipped = 0
+        self._file = open(path, 'ab')
+        self._unsynced = 0
+        self._last_sync = time()
+
+    def __contains__(self, id):
+        return _digest(id) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def filter(self, image_artifacts):
+        """ Drop artifacts that were completed by a previous run """
+        for image_artifact in image_artifacts:
+            if _digest(image_artifact.id) in self.done:
+                self.n_skipped += 1
+            else:
+                yield image_artifact
+
+    def mark(self, id):
+        d = _digest(id)
+        if d in self.done:
+            return
+
+        self.done.add(d)
+        self._file.write(d.to_bytes(8, 'little'))
+        self._unsynced += 1
+
+        if self._unsynced >= self.sync_every or time() - self._last_sync > self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Make sure everything marked so far survives a crash """
+        if self.before_sync is not None:
+            self.before_sync()
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time()
+
+    def close(self):
+        self.sync()
+        self._file.close()
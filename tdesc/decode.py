@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+    decode.py
+
+    Image decoding, either inline or in a pool of processes
+"""
+import io
+import weakref
+import numpy as np
+
+from PIL import Image
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import multiprocessing
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# Refuse to decode anything bigger than this (after draft scaling)
+MAX_PIXELS = 100 * 10 ** 6
+
+
+def load_rgb(src, target_size=None, resample=Image.BILINEAR, draft=True, max_pixels=MAX_PIXELS):
+    """
+        src: path, file-like or bytes
+        target_size: (width, height) to resize to, or None for native size
+        draft: for JPEGs, let libjpeg decode at 1/2, 1/4 or 1/8 scale -- the
+            smallest that's still at least `target_size` -- before resizing.
+            Much less work and memory for large photos.
+        max_pixels: raise ValueError for images with more pixels than this
+
+        Returns HxWx3 uint8 array
+    """
+    if isinstance(src, bytes):
+        src = io.BytesIO(src)
+
+    img = Image.open(src)
+    if draft and target_size is not None and img.format == 'JPEG':
+        img.draft('RGB', tuple(target_size))
+
+    if max_pixels and img.size[0] * img.size[1] > max_pixels:
+        raise ValueError('load_rgb: %dx%d image is larger than max_pixels=%d' % (img.size[0], img.size[1], max_pixels))
+
+    img = img.convert('RGB')
+    if target_size is not None:
+        img = img.resize(target_size, resample)
+
+    return np.asarray(img, dtype=np.uint8)
+
+
+def resize(img, target_size=None, resample=Image.BILINEAR):
+    """
+        Apply `load_rgb`'s resize to an already decoded HxWx3 uint8 array
+    """
+    if target_size is None or (img.shape[1], img.shape[0]) == tuple(target_size):
+        return img
+
+    return np.asarray(Image.fromarray(img).resize(target_size, resample), dtype=np.uint8)
+
+
+# --
+# Buffers
+
+class BufferPool(object):
+    """
+        Recycles uint8 image arrays, so steady state decoding doesn't
+        allocate.  `get` hands out a free buffer of the requested shape, or
+        allocates one if there isn't any -- so it never blocks, and the pool
+        grows to the number of images actually in flight.  `put` only takes
+        back buffers the pool handed out, once.  A buffer that's never put
+        back is just garbage collected.
+    """
+    def __init__(self, max_free=256):
+        self.max_free = max_free
+        self.free = {}
+        self.issued = weakref.WeakValueDictionary()  # id -> buffer, until it's put back or freed
+        self.lock = Lock()
+
+    def get(self, shape):
+        shape = tuple(shape)
+        with self.lock:
+            bufs = self.free.get(shape)
+            buf = bufs.pop() if bufs else None
+
+        if buf is None:
+            buf = np.empty(shape, dtype=np.uint8)
+
+        with self.lock:
+            self.issued[id(buf)] = buf
+
+        return buf
+
+    def put(self, buf):
+        with self.lock:
+            # an id alone could belong to a new object, once the buffer it was issued for is freed
+            if self.issued.get(id(buf)) is not buf:
+                return
+
+            del self.issued[id(buf)]
+            bufs = self.free.setdefault(buf.shape, [])
+            if len(bufs) < self.max_free:
+                bufs.append(buf)
+
+
+# --
+# Process pool
+
+def _ping():
+    return True
+
+
+def process_pool(n_procs, initializer=None, initargs=()):
+    """
+        A `ProcessPoolExecutor` w/ all `n_procs` processes already started.
+        They come from a forkserver (or are spawned), since forking the
+        parent once its IO threads are running isn't safe.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    executor = ProcessPoolExecutor(max_workers=n_procs, mp_context=context,
+                                   initializer=initializer, initargs=initargs)
+
+    for future in [executor.submit(_ping) for _ in range(n_procs)]:
+        future.result()
+
+    return executor
+
+
+_attached = {}
+
+
+def _decode_to_slot(slot_name, src, kwargs):
+    """ Runs in a decode process: decode `src` and write pixels into a shared slot """
+    img = load_rgb(src, **kwargs)
+
+    if slot_name not in _attached:
+        _attached[slot_name] = shared_memory.SharedMemory(name=slot_name)
+
+    slot = _attached[slot_name]
+    if img.nbytes > slot.size:
+        return img.shape, img
+
+    np.ndarray(img.shape, dtype=np.uint8, buffer=slot.buf)[...] = img
+    return img.shape, None
+
+
+class DecodePool(object):
+    """
+        Decodes images in `n_procs` processes, so decoding isn't bound by the GIL.
+
+        Pixels come back through a ring of `n_slots` preallocated shared memory
+        slots instead of being pickled.  A caller holds a slot from submission
+        until it has copied the pixels out, so at most `n_slots` decodes are in
+        flight.  Images larger than `slot_bytes` fall back to pickling.
+
+        The processes are started in the constructor (see `process_pool`).
+    """
+    def __init__(self, n_procs, n_slots, slot_bytes=2 ** 26):
+        self.executor = process_pool(n_procs)
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(n_slots)]
+
+        self.free = Queue()
+        for slot in self.slots:
+            self.free.put(slot)
+
+    def decode(self, src, buffers=None, **kwargs):
+        """ buffers: optional `BufferPool` to copy the pixels into """
+        slot = self.free.get()
+        try:
+            shape, img = self.executor.submit(_decode_to_slot, slot.name, src, kwargs).result()
+            if img is None:
+                pixels = np.ndarray(shape, dtype=np.uint8, buffer=slot.buf)
+                if buffers is None:
+                    img = pixels.copy()
+                else:
+                    img = buffers.get(shape)
+                    np.copyto(img, pixels)
+
+            return img
+        finally:
+            self.free.put(slot)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
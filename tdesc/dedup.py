@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+    dedup.py
+
+    Near-duplicate detection w/ perceptual hashes, so re-encoded and resized
+    copies of an image can reuse its result
+"""
+import io
+import threading
+import numpy as np
+
+from PIL import Image
+from collections import OrderedDict
+
+
+def dhash(src, hash_size=8):
+    """
+        Difference hash: sign of horizontal gradients of a (hash_size + 1) x
+        hash_size grayscale thumbnail, as an int of hash_size ** 2 bits.
+
+        JPEGs are decoded at 1/8 scale (draft mode), so this costs a small
+        fraction of a full decode.
+
+        src: path, file-like or bytes
+    """
+    return dhash_size(src, hash_size)[0]
+
+
+def dhash_size(src, hash_size=8):
+    """ (dhash, (width, height) of the full image) """
+    if isinstance(src, bytes):
+        src = io.BytesIO(src)
+
+    img = Image.open(src)
+    size = img.size
+    if img.format == 'JPEG':
+        img.draft('L', (8 * (hash_size + 1), 8 * hash_size))
+
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.BOX)
+    px = np.asarray(img, dtype=np.int16)
+
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    return int(''.join('1' if b else '0' for b in bits), 2), size
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class NearDuplicateIndex(object):
+    """
+        Multi-index hashing (Norouzi et al. 2012): codes are split into
+        `radius + 1` bands, each w/ its own exact-match table.  Two codes
+        within Hamming distance `radius` must agree exactly on at least one
+        band, so a lookup only checks codes sharing a band.
+
+        Holds at most `capacity` codes (least recently used are dropped),
+        each w/ a value -- eg a serialized featurize result.
+    """
+    def __init__(self, radius=4, n_bits=64, capacity=100000):
+        self.radius = radius
+        self.capacity = capacity
+
+        n_bands = radius + 1
+        bounds = np.linspace(0, n_bits, n_bands + 1).astype(int)
+        self.bands = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.bands]
+
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _keys(self, code):
+        return [(code >> shift) & mask for shift, mask in self.bands]
+
+    def get(self, code):
+        """ Value of the nearest stored code within `radius`, or None """
+        with self.lock:
+            best, best_dist = None, self.radius + 1
+            for table, key in zip(self.tables, self._keys(code)):
+                for other in table.get(key, ()):
+                    dist = hamming(code, other)
+                    if dist < best_dist:
+                        best, best_dist = other, dist
+
+            if best is None:
+                return None
+
+            self.values.move_to_end(best)
+            return self.values[best]
+
+    def put(self, code, value):
+        with self.lock:
+            self._put(code, value)
+
+    def _put(self, code, value):
+        if code in self.values:
+            self.values[code] = value
+            self.values.move_to_end(code)
+            return
+
+        self.values[code] = value
+        for table, key in zip(self.tables, self._keys(code)):
+            table.setdefault(key, set()).add(code)
+
+        while len(self.values) > self.capacity:
+            old, _ = self.values.popitem(last=False)
+            for table, key in zip(self.tables, self._keys(old)):
+                table[key].discard(old)
+                if not table[key]:
+                    del table[key]
+
+    def __len__(self):
+        return len(self.values)
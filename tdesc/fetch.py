@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""
+    fetch.py
+
+    Pooled HTTP(S) fetcher running on an asyncio loop in a background thread.
+
+    Connections are kept alive and reused per host, concurrency is capped
+    globally and per host, and failed requests are retried w/ exponential
+    backoff.  Slow requests can be hedged: after `hedge_after` seconds a
+    second copy is sent and whichever answers first wins.  Blocking callers
+    (the IO threads) use `fetch`/`prefetch`.
+"""
+import ssl
+import random
+import asyncio
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urljoin
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status):
+        super(HTTPError, self).__init__('HTTP %d: %s' % (status, url))
+        self.url = url
+        self.status = status
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, url, timeout):
+        super(DeadlineExceeded, self).__init__('no response after %ss: %s' % (timeout, url))
+        self.url = url
+
+
+class _Retryable(Exception):
+    pass
+
+
+def is_url(path):
+    return path[:7] == 'http://' or path[:8] == 'https://'
+
+
+class AsyncFetcher(object):
+
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_connections=32, max_per_host=8, retries=3, backoff=0.5,
+                 timeout=10, max_redirects=5, user_agent='tdesc', hedge_after=None):
+
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.hedge_after = hedge_after
+        self.n_hedged = 0
+
+        self._idle = defaultdict(list)
+        self._host_limits = {}
+        self._limit = None
+        self._prefetched = defaultdict(deque)
+        self._lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # --
+    # Blocking API
+
+    def submit(self, url):
+        """ Start fetching `url`; returns a concurrent.futures.Future of the body bytes """
+        return asyncio.run_coroutine_threadsafe(self._fetch(url), self.loop)
+
+    def prefetch(self, url):
+        """
+            Start fetching `url` now, to be picked up by a later `fetch(url)`.
+            Returns the future, for `discard` if it's never picked up.
+        """
+        future = self.submit(url)
+        with self._lock:
+            self._prefetched[url].append(future)
+
+        return future
+
+    def discard(self, url, future):
+        """ Cancel a `prefetch` that won't be fetched, eg its image timed out or hit the cache """
+        with self._lock:
+            queue = self._prefetched.get(url)
+            if queue is not None and future in queue:
+                queue.remove(future)
+                if not queue:
+                    del self._prefetched[url]
+
+        future.cancel()
+
+    def fetch(self, url, timeout=None):
+        """
+            Body of `url`, blocking.  timeout: overall seconds for this call,
+            across retries -- the request is cancelled and `DeadlineExceeded`
+            raised after that.
+        """
+        with self._lock:
+            queue = self._prefetched.get(url)
+            future = queue.popleft() if queue else None
+            if queue is not None and not queue:
+                del self._prefetched[url]
+
+        if future is None:
+            future = self.submit(url)
+
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            if future.done():
+                raise  # the last attempt timed out
+
+            if not self.loop.is_closed():
+                future.cancel()
+
+            raise DeadlineExceeded(url, timeout)
+
+    def close(self):
+        async def _cancel():
+            # abandoned requests, eg past their deadline
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # wait for the transports to close, or they're left to the GC
+            writers = [writer for conns in self._idle.values() for _, writer in conns]
+            self._idle.clear()
+            for writer in writers:
+                writer.close()
+
+            await asyncio.gather(*[writer.wait_closed() for writer in writers], return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(_cancel(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    # --
+    # Async internals
+
+    async def _fetch(self, url):
+        attempt = 0
+        while True:
+            try:
+                if self.hedge_after is None:
+                    return await self._attempt(url)
+                else:
+                    return await self._hedged(url)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, _Retryable):
+                if attempt >= self.retries:
+                    raise
+
+                # full jitter, so a burst of failures doesn't retry in lockstep
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                attempt += 1
+
+    async def _attempt(self, url):
+        return await asyncio.wait_for(self._get(url, self.max_redirects), self.timeout)
+
+    async def _hedged(self, url):
+        """ One attempt, plus a second copy if the first is slower than `hedge_after` """
+        pending = {asyncio.ensure_future(self._attempt(url))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if not done:
+                self.n_hedged += 1
+                pending.add(asyncio.ensure_future(self._attempt(url)))
+
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+
+                    error = task.exception()
+
+                if not pending:
+                    raise error
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _limits(self, key):
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.max_connections)
+
+        if key not in self._host_limits:
+            self._host_limits[key] = asyncio.Semaphore(self.max_per_host)
+
+        return self._limit, self._host_limits[key]
+
+    async def _get(self, url, redirects):
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        key = (parts.scheme, parts.hostname, port)
+
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        limit, host_limit = self._limits(key)
+        async with host_limit:
+            async with limit:
+                status, headers, body = await self._request(key, parts.netloc, target)
+
+        if status in self.redirect_codes and 'location' in headers:
+            if redirects <= 0:
+                raise HTTPError(url, status)
+
+            return await self._get(urljoin(url, headers['location']), redirects - 1)
+
+        if status == 429 or status >= 500:
+            raise _Retryable(url)
+
+        if status >= 400:
+            raise HTTPError(url, status)
+
+        return body
+
+    async def _request(self, key, host, target):
+        """
+            One GET on a pooled connection.  A reused keep-alive connection
+            may have been closed by the server while idle, so if one fails
+            before any response arrives, retry once on a fresh connection.
+        """
+        while True:
+            reader, writer, reused = await self._acquire(key)
+            try:
+                status, headers, body, keep_alive = await self._roundtrip(reader, writer, host, target)
+            except (OSError, EOFError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused and isinstance(e, (ConnectionError, EOFError, asyncio.IncompleteReadError)):
+                    continue
+
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if keep_alive:
+                self._idle[key].append((reader, writer))
+            else:
+                writer.close()
+
+            return status, headers, body
+
+    async def _acquire(self, key):
+        idle = self._idle[key]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+
+            writer.close()
+
+        scheme, hostname, port = key
+        ctx = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(hostname, port, ssl=ctx)
+        return reader, writer, False
+
+    async def _roundtrip(self, reader, writer, host, target):
+        writer.write(((
+            'GET %s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'User-Agent: %s\r\n'
+            'Accept-Encoding: identity\r\n'
+            'Connection: keep-alive\r\n'
+            '\r\n'
+        ) % (target, host, self.user_agent)).encode('latin-1'))
+        await writer.drain()
+
+        line = await reader.readline()
+        if not line:
+            raise EOFError('connection closed')
+
+        version, status = line.split(None, 2)[:2]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b''
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return status, headers, body, keep_alive
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                break
+
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+        # trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        return b''.join(chunks)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+"""
+    index.py
+
+    Nearest neighbor search over worker output
+
+        # build
+        python -m tdesc index build --input vgg16-crow --outpath crow.index --normalize
+        python -m tdesc index build --input faces.descriptors --meta-cols 5 --outpath faces.index \\
+            --type ivfpq --n-lists 1024 --n-subq 16
+
+        # query (writes query_id, rank, neighbor_id, score)
+        cat queries.descriptors | python -m tdesc index query --index crow.index --k 10
+
+    `--input` is either a `--output-format binary` prefix (memory mapped) or
+    TSV as written by the workers.  For TSV, `--meta-cols` is the number of
+    columns between the id and the descriptor (0 for vgg16, 5 for dlib_face).
+
+    `flat` does exact search w/ blocked BLAS matrix products; `ivfpq` is an
+    inverted file over k-means cells w/ product quantized residuals, for
+    corpora too big to scan.
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from tdesc.writers import BinaryReader, read_meta
+
+
+# --
+# IO
+
+def read_tsv(stream, meta_cols=0, chunk_size=10000, dtype=np.float32):
+    """ Parse worker TSV output in chunks.  Returns (ids, (n, dim) array) """
+    ids, chunks, lines = [], [], []
+
+    def parse(lines):
+        rows = [line.rstrip('\n').split('\t') for line in lines]
+        ids.extend(row[0] for row in rows)
+        chunks.append(np.array([row[1 + meta_cols:] for row in rows], dtype=dtype))
+
+    for line in stream:
+        lines.append(line)
+        if len(lines) == chunk_size:
+            parse(lines)
+            lines = []
+
+    if lines:
+        parse(lines)
+
+    descs = np.vstack(chunks) if chunks else np.zeros((0, 0), dtype=dtype)
+    return ids, descs
+
+
+def load_descriptors(path, meta_cols=0):
+    if read_meta(path) is not None:
+        reader = BinaryReader(path)
+        return reader.ids, reader.descs
+
+    if path == '-':
+        return read_tsv(sys.stdin, meta_cols=meta_cols)
+
+    with open(path) as f:
+        return read_tsv(f, meta_cols=meta_cols)
+
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _sq_dists(x, c, c_sq=None):
+    """ squared euclidean distances between rows of x and rows of c """
+    if c_sq is None:
+        c_sq = (c ** 2).sum(axis=1)
+
+    return (x ** 2).sum(axis=1, keepdims=True) - 2 * x.dot(c.T) + c_sq
+
+
+def _merge_topk(scores, labels, k):
+    """ keep the k highest scores in each row """
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(scores, part, axis=1)
+    labels = np.take_along_axis(labels, part, axis=1)
+
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+
+def kmeans(x, n_clusters, n_iter=20, batch_size=65536, seed=123):
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(x.shape[0], n_clusters, replace=x.shape[0] < n_clusters)].copy()
+
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, batch_size)
+
+        counts = np.bincount(assign, minlength=n_clusters)
+        empty = counts == 0
+
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        centroids[~empty] = np.add.reduceat(x[order], starts[~empty], axis=0) / counts[~empty, None]
+        centroids[empty] = x[rng.choice(x.shape[0], empty.sum())]
+
+    return centroids
+
+
+def assign_clusters(x, centroids, batch_size=65536):
+    c_sq = (centroids ** 2).sum(axis=1)
+    return np.concatenate([
+        _sq_dists(x[i:i + batch_size], centroids, c_sq).argmin(axis=1)
+        for i in range(0, x.shape[0], batch_size)
+    ])
+
+
+# --
+# Indexes
+
+class FlatIndex(object):
+    """
+        Exact search.  Queries are processed in batches against blocks of the
+        database, so each step is one BLAS matrix product.
+
+        metric='ip' ranks by inner product (cosine, if normalized); 'l2' by
+        (negative) squared euclidean distance.
+    """
+    kind = 'flat'
+
+    def __init__(self, metric='ip', normalize=False, block_size=65536):
+        self.metric = metric
+        self.normalize = normalize
+        self.block_size = block_size
+        self.ids = []
+        self.descs = None
+        self.sq_norms = None
+
+    def add(self, ids, descs):
+        descs = l2_normalize(descs) if self.normalize else np.asarray(descs, dtype=np.float32)
+        self.descs = descs if self.descs is None else np.vstack([self.descs, descs])
+        self.ids.extend(ids)
+        self.sq_norms = (self.descs ** 2).sum(axis=1) if self.metric == 'l2' else None
+
+    def _prep(self, queries):
+        return l2_normalize(queries) if self.normalize else np.asarray(queries, dtype=np.float32)
+
+    def search(self, queries, k=10):
+        """ Returns (scores, labels), each (n_queries, k), best first """
+        queries = self._prep(queries)
+        n = queries.shape[0]
+        q_sq = (queries ** 2).sum(axis=1, keepdims=True)
+
+        best_scores = np.full((n, 0), -np.inf, dtype=np.float32)
+        best_labels = np.zeros((n, 0), dtype=np.int64)
+
+        for start in range(0, self.descs.shape[0], self.block_size):
+            block = np.asarray(self.descs[start:start + self.block_size])
+            scores = queries.dot(block.T)
+            if self.metric == 'l2':
+                scores = 2 * scores - self.sq_norms[start:start + block.shape[0]] - q_sq
+
+            labels = np.broadcast_to(np.arange(start, start + block.shape[0]), scores.shape)
+            best_scores, best_labels = _merge_topk(
+                np.hstack([best_scores, scores]),
+                np.hstack([best_labels, labels]),
+                k
+            )
+
+        return best_scores, best_labels
+
+    def _arrays(self):
+        return {"descs" : self.descs}
+
+    def _load_arrays(self, arrays):
+        self.descs = arrays['descs']
+        self.sq_norms = (np.asarray(self.descs) ** 2).sum(axis=1) if self.metric == 'l2' else None
+
+    def _config(self):
+        return {"metric" : self.metric, "normalize" : self.normalize}
+
+
+class IVFPQIndex(FlatIndex):
+    """
+        Approximate search.  Vectors are assigned to one of `n_lists` k-means
+        cells, and the residual to the cell centroid is product quantized into
+        `n_subq` bytes.  Queries scan the `n_probe` closest cells, scoring
+        codes with per-query lookup tables (asymmetric distance).
+
+        Scores are negative squared euclidean distances -- use normalize=True
+        to rank by cosine.
+    """
+    kind = 'ivfpq'
+
+    def __init__(self, n_lists=256, n_subq=8, n_probe=8, normalize=False, n_iter=20):
+        self.n_lists = n_lists
+        self.n_subq = n_subq
+        self.n_probe = n_probe
+        self.normalize = normalize
+        self.n_iter = n_iter
+
+        self.ids = []
+        self.coarse = None
+        self.codebooks = None
+        self.codes = np.zeros((0, n_subq), dtype=np.uint8)
+        self.lists = np.zeros(0, dtype=np.int64)
+
+    def train(self, descs, max_train=100000, seed=123):
+        descs = self._prep(descs)
+        rng = np.random.RandomState(seed)
+        if descs.shape[0] > max_train:
+            descs = descs[np.sort(rng.choice(descs.shape[0], max_train, replace=False))]
+
+        assert descs.shape[1] % self.n_subq == 0, 'IVFPQIndex: dim must be divisible by n_subq'
+
+        self.coarse = kmeans(descs, self.n_lists, n_iter=self.n_iter, seed=seed)
+        residuals = descs - self.coarse[assign_clusters(descs, self.coarse)]
+
+        self.codebooks = np.stack([
+            kmeans(sub, 256, n_iter=self.n_iter, seed=seed)
+            for sub in np.split(residuals, self.n_subq, axis=1)
+        ])
+
+    def add(self, ids, descs):
+        if self.coarse is None:
+            self.train(descs)
+
+        descs = self._prep(descs)
+        lists = assign_clusters(descs, self.coarse)
+        residuals = descs - self.coarse[lists]
+
+        codes = np.stack([
+            assign_clusters(sub, codebook)
+            for sub, codebook in zip(np.split(residuals, self.n_subq, axis=1), self.codebooks)
+        ], axis=1).astype(np.uint8)
+
+        self.ids.extend(ids)
+        self.lists = np.concatenate([self.lists, lists])
+        self.codes = np.vstack([self.codes, codes])
+        self._order = None
+
+    def _build_lists(self):
+        """ CSR layout: rows of each cell are contiguous in `_order` """
+        self._order = np.argsort(self.lists, kind='stable')
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=self.n_lists))])
+
+    def search(self, queries, k=10):
+        if getattr(self, '_order', None) is None:
+            self._build_lists()
+
+        queries = self._prep(queries)
+        probes = np.argsort(_sq_dists(queries, self.coarse), axis=1)[:, :self.n_probe]
+
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        all_labels = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        subq = np.arange(self.n_subq)
+
+        for i, (query, probe) in enumerate(zip(queries, probes)):
+            rows = np.concatenate([self._order[self._offsets[p]:self._offsets[p + 1]] for p in probe])
+            if rows.shape[0] == 0:
+                continue
+
+            which = np.repeat(np.arange(len(probe)), self._offsets[probe + 1] - self._offsets[probe])
+
+            # lookup tables: (n_probe, n_subq, 256) squared distances from each
+            # query residual sub-vector to each code
+            residuals = (query - self.coarse[probe]).reshape(len(probe), self.n_subq, 1, -1)
+            luts = ((residuals - self.codebooks[None]) ** 2).sum(axis=-1)
+            dists = luts[which[:, None], subq, self.codes[rows]].sum(axis=1)
+
+            scores, labels = _merge_topk(-dists[None], rows[None], k)
+            all_scores[i, :scores.shape[1]] = scores[0]
+            all_labels[i, :labels.shape[1]] = labels[0]
+
+        return all_scores, all_labels
+
+    def _arrays(self):
+        return {
+            "coarse" : self.coarse,
+            "codebooks" : self.codebooks,
+            "codes" : self.codes,
+            "lists" : self.lists,
+        }
+
+    def _load_arrays(self, arrays):
+        self.coarse = arrays['coarse']
+        self.codebooks = arrays['codebooks']
+        self.codes = arrays['codes']
+        self.lists = arrays['lists']
+
+    def _config(self):
+        return {
+            "n_lists" : self.n_lists,
+            "n_subq" : self.n_subq,
+            "n_probe" : self.n_probe,
+            "normalize" : self.normalize,
+        }
+
+
+_index_types = {
+    FlatIndex.kind : FlatIndex,
+    IVFPQIndex.kind : IVFPQIndex,
+}
+
+
+def save_index(index, outpath):
+    """ A directory of .npy arrays, so large indexes can be memory mapped on load """
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+
+    with open(os.path.join(outpath, 'meta.json'), 'w') as f:
+        json.dump({"type" : index.kind, "config" : index._config()}, f)
+
+    with open(os.path.join(outpath, 'ids'), 'w') as f:
+        for id in index.ids:
+            f.write(id + '\n')
+
+    for name, array in index._arrays().items():
+        np.save(os.path.join(outpath, name + '.npy'), array)
+
+
+def load_index(path, mmap=True):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    index = _index_types[meta['type']](**meta['config'])
+    with open(os.path.join(path, 'ids')) as f:
+        index.ids = f.read().splitlines()
+
+    arrays = {}
+    for name in index._arrays():
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+
+    index._load_arrays(arrays)
+    return index
+
+
+# --
+# CLI
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='tdesc index')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build')
+    build.add_argument('--input', type=str, required=True)
+    build.add_argument('--outpath', type=str, required=True)
+    build.add_argument('--meta-cols', type=int, default=0)
+    build.add_argument('--type', type=str, default='flat', choices=sorted(_index_types))
+    build.add_argument('--metric', type=str, default='ip', choices=['ip', 'l2'])
+    build.add_argument('--normalize', action='store_true')
+    build.add_argument('--n-lists', type=int, default=256)
+    build.add_argument('--n-subq', type=int, default=8)
+    build.add_argument('--n-probe', type=int, default=8)
+    build.add_argument('--max-train', type=int, default=100000)
+
+    query = subparsers.add_parser('query')
+    query.add_argument('--index', type=str, required=True)
+    query.add_argument('--input', type=str, default='-')
+    query.add_argument('--meta-cols', type=int, default=0)
+    query.add_argument('--k', type=int, default=10)
+    query.add_argument('--batch-size', type=int, default=1024)
+    query.add_argument('--n-probe', type=int, default=None)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('expected `build` or `query`')
+
+    return args
+
+
+def build(args):
+    ids, descs = load_descriptors(args.input, meta_cols=args.meta_cols)
+
+    if args.type == 'flat':
+        index = FlatIndex(metric=args.metric, normalize=args.normalize)
+    else:
+        index = IVFPQIndex(n_lists=args.n_lists, n_subq=args.n_subq, n_probe=args.n_probe, normalize=args.normalize)
+        index.train(descs, max_train=args.max_train)
+
+    index.add(ids, descs)
+    save_index(index, args.outpath)
+    print('tdesc index: %d x %d -> %s' % (descs.shape[0], descs.shape[1], args.outpath), file=sys.stderr)
+
+
+def query(args):
+    index = load_index(args.index)
+    if args.n_probe is not None:
+        index.n_probe = args.n_probe
+
+    ids, queries = load_descriptors(args.input, meta_cols=args.meta_cols)
+    for start in range(0, queries.shape[0], args.batch_size):
+        scores, labels = index.search(queries[start:start + args.batch_size], k=args.k)
+        for query_id, row_scores, row_labels in zip(ids[start:start + args.batch_size], scores, labels):
+            for rank, (score, label) in enumerate(zip(row_scores, row_labels)):
+                if label >= 0:
+                    print('\t'.join((query_id, str(rank), index.ids[label], str(score))))
+
+    sys.stdout.flush()
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == 'build':
+        build(args)
+    else:
+        query(args)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""
+    metrics.py
+
+    Per-stage counters, latency histograms and queue depths, reported as
+    JSON lines and/or a Prometheus textfile
+"""
+import os
+import json
+import threading
+from time import time
+from bisect import bisect_left
+
+# Upper bounds in seconds: 100us .. ~105s, doubling
+BUCKETS = tuple(1e-4 * 2 ** i for i in range(21))
+
+STAGES = ('fetch', 'decode', 'prepare', 'queue_wait', 'inference', 'serialize')
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile """
+        if not self.count:
+            return None
+
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+
+        return self.max
+
+    def summary(self):
+        return {
+            "count" : self.count,
+            "mean" : self.sum / self.count if self.count else None,
+            "p50" : self.quantile(0.5),
+            "p90" : self.quantile(0.9),
+            "p99" : self.quantile(0.99),
+            "max" : self.max,
+        }
+
+
+class _Timer(object):
+    def __init__(self, metrics, stage, keys=None):
+        self.metrics = metrics
+        self.stage = stage
+        self.keys = keys
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time() - self.start
+        self.metrics.observe(self.stage, duration)
+        if self.metrics.tracer is not None:
+            self.metrics.tracer.span(self.stage, self.start, duration, self.keys)
+
+
+class Metrics(object):
+    """
+        Thread-safe collection of
+            - counters, eg images read, featurized, failed, cache hits
+            - a latency histogram per stage
+            - gauges, callables sampled at report time (queue depths)
+
+        `done(n)` counts finished images; every `interval` of them a report
+        is written as a JSON line to `stream` and/or as a Prometheus
+        textfile at `textfile`.  Recording costs a lock and a bisect, so
+        it's always on -- only reporting is opt-in.
+
+        tracer: optional `tdesc.trace.Tracer`, which gets every timed stage
+        of its sampled images
+    """
+    def __init__(self, stream=None, textfile=None, interval=25, prefix='tdesc', tracer=None):
+        self.stream = stream
+        self.textfile = textfile
+        self.interval = interval
+        self.prefix = prefix
+        self.tracer = tracer
+
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = dict((stage, Histogram()) for stage in STAGES)
+        self.gauges = {}
+        self._ready = {}
+
+        self.start_time = time()
+        self._next_report = interval
+
+    def timer(self, stage, keys=None):
+        """ Times a stage -- of `keys`, or of the image current on this thread """
+        return _Timer(self, stage, keys)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+
+            self.histograms[stage].observe(seconds)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def begin(self, key, image_id):
+        """ An image is picked up by an IO thread """
+        if self.tracer is not None:
+            self.tracer.begin(key, image_id)
+
+    def ready(self, key):
+        """ An image is decoded and waiting for the model """
+        self.incr('read')
+        self._ready[key] = time()
+
+    def drop(self, key):
+        """ An image that won't reach the model, eg it timed out """
+        with self.lock:
+            self._ready.pop(key, None)
+
+    def started(self, keys):
+        """ Images handed to the model -- records how long they queued """
+        now = time()
+        with self.lock:
+            self.counters['started'] = self.counters.get('started', 0) + len(keys)
+            for key in keys:
+                ready = self._ready.pop(key, None)
+                if ready is not None:
+                    self.histograms['queue_wait'].observe(now - ready)
+                    if self.tracer is not None:
+                        self.tracer.span('queue_wait', ready, now - ready, [key])
+
+    def done(self, n=1, key=None):
+        """ Images whose results have been handed off (and written) """
+        if self.tracer is not None and key is not None:
+            self.tracer.end(key)
+
+        self.incr('done', n)
+        if self.interval and self.counters['done'] >= self._next_report:
+            self._next_report = self.counters['done'] + self.interval
+            self.report()
+
+    # --
+    # Reporting
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time() - self.start_time
+            counters = dict(self.counters)
+            stages = dict(
+                (stage, hist.summary())
+                for stage, hist in self.histograms.items() if hist.count
+            )
+
+        queues = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                queues[name] = fn()
+            except Exception:
+                pass
+
+        return {
+            "time" : time(),
+            "elapsed" : elapsed,
+            "rate" : counters.get('done', 0) / elapsed if elapsed > 0 else None,
+            "counters" : counters,
+            "queues" : queues,
+            "stages" : stages,
+        }
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        p = self.prefix
+
+        lines = ['# TYPE %s_images_total counter' % p]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('%s_images_total{state="%s"} %d' % (p, name, value))
+
+        lines.append('# TYPE %s_queue_depth gauge' % p)
+        for name, value in sorted(snapshot['queues'].items()):
+            lines.append('%s_queue_depth{queue="%s"} %d' % (p, name, value))
+
+        lines.append('# TYPE %s_stage_seconds histogram' % p)
+        with self.lock:
+            for stage, hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append('%s_stage_seconds_bucket{stage="%s",le="%g"} %d' % (p, stage, bound, cumulative))
+
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (p, stage, hist.count))
+                lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (p, stage, hist.sum))
+                lines.append('%s_stage_seconds_count{stage="%s"} %d' % (p, stage, hist.count))
+
+        lines.append('# TYPE %s_elapsed_seconds gauge' % p)
+        lines.append('%s_elapsed_seconds %f' % (p, snapshot['elapsed']))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        if self.stream is not None:
+            print(json.dumps(self.snapshot()), file=self.stream)
+            self.stream.flush()
+
+        if self.textfile is not None:
+            # write + rename, so the node_exporter never sees a partial file
+            tmp = '%s.%d.tmp' % (self.textfile, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(self.to_prometheus())
+
+            os.rename(tmp, self.textfile)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullMetrics(object):
+    """ Stand-in when a worker is used outside of `run` """
+    tracer = None
+
+    def timer(self, stage, keys=None):
+        return _NullTimer()
+
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, name, n=1):
+        pass
+
+    def gauge(self, name, fn):
+        pass
+
+    def begin(self, key, image_id):
+        pass
+
+    def ready(self, key):
+        pass
+
+    def drop(self, key):
+        pass
+
+    def started(self, keys):
+        pass
+
+    def done(self, n=1, key=None):
+        pass
+
+    def report(self):
+        pass
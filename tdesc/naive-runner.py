@@ -13,7 +13,8 @@ import urllib.request, urllib.parse, urllib.error
 import io
 from time import time
 
-from .workers import VGG16Worker, DlibFaceWorker
+from tdesc.artifacts import ImageArtifact
+from tdesc.workers import VGG16Worker, DlibFaceWorker
 
 # --
 # Init
@@ -23,8 +24,6 @@ def parse_args():
     parser.add_argument('--model', type=str, default='vgg16')
     # VGG16 options
     parser.add_argument('--crow', action="store_true")
-    # DlibFace options
-    parser.add_argument('--outpath', type=str, default='./db.h5')
     return parser.parse_args()
 
 # --
@@ -34,9 +33,9 @@ if __name__ == "__main__":
     args = parse_args()
     
     if args.model == 'vgg16':
-        worker = VGG16Worker(args.crow)
+        worker = VGG16Worker(crow=args.crow)
     elif args.model == 'dlib_face':
-        worker = DlibFaceWorker(args.outpath)
+        worker = DlibFaceWorker()
     else:
         raise Exception()
     
@@ -45,7 +44,7 @@ if __name__ == "__main__":
         path = line.strip()
         
         try:
-            worker.featurize(path, worker.imread(path))
+            worker.featurize(ImageArtifact(path, path, save_results=False), worker.imread(path))
             
             if not (i + 1) % 100:
                 print("%d images | %f seconds " % (i, time() - start_time), file=sys.stderr)
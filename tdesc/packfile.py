@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+    packfile.py
+
+    Append-only packs of small blobs (eg face chips), w/ an offset index
+
+        <prefix>.00000.pack, <prefix>.00001.pack, ...   concatenated blobs
+        <prefix>.index                                  key, shard, offset, length (TSV)
+"""
+import os
+import mmap
+
+
+def shard_path(prefix, shard):
+    return '%s.%05d.pack' % (prefix, shard)
+
+
+def read_index(prefix):
+    """ Returns {key: (shard, offset, length)} """
+    index = {}
+    path = prefix + '.index'
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 4:
+                    continue  # partial last line from a killed run
+
+                key, shard, offset, length = parts
+                index[key] = (int(shard), int(offset), int(length))
+
+    return index
+
+
+class PackWriter(object):
+    """
+        Appends blobs to the current shard and starts a new one after
+        `shard_bytes`.  Re-opening an existing pack continues it, so it can be
+        used w/ `--resume`.  Index entries are only written once the blobs
+        they point to are flushed (every `flush_every` blobs), so a killed
+        run leaves at most some unindexed bytes at the end of a shard, and
+        a partial last index line, which is cut off on re-opening.
+    """
+    def __init__(self, prefix, shard_bytes=2 ** 30, flush_every=1000):
+        self.prefix = prefix
+        self.shard_bytes = shard_bytes
+        self.flush_every = flush_every
+        self.pending = []
+
+        dirname = os.path.dirname(prefix)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.shard = 0
+        while os.path.exists(shard_path(prefix, self.shard + 1)):
+            self.shard += 1
+
+        self._repair()
+
+        self.f = open(shard_path(prefix, self.shard), 'ab')
+        self.index = open(prefix + '.index', 'a')
+
+    def _repair(self):
+        """ Truncate `.index` to its complete lines, so appends start on a new line """
+        path = self.prefix + '.index'
+        if not os.path.exists(path):
+            return
+
+        n_bytes = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+
+                n_bytes += len(line)
+
+        with open(path, 'r+b') as f:
+            f.truncate(n_bytes)
+
+    def write(self, key, blob):
+        if self.f.tell() > 0 and self.f.tell() + len(blob) > self.shard_bytes:
+            self.flush()
+            self.f.close()
+            self.shard += 1
+            self.f = open(shard_path(self.prefix, self.shard), 'ab')
+
+        offset = self.f.tell()
+        self.f.write(blob)
+        self.pending.append('%s\t%d\t%d\t%d\n' % (key, self.shard, offset, len(blob)))
+
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+        self.index.write(''.join(self.pending))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.index.close()
+
+
+class PackReader(object):
+    """ Random access to a pack: each shard is mmap'd once, reads are slices """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = read_index(prefix)
+        self._maps = {}
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            with open(shard_path(self.prefix, shard), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._maps[shard]
+
+    def get(self, key):
+        shard, offset, length = self.index[key]
+        return self._map(shard)[offset:offset + length]
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        """ (key, blob), in shard and offset order """
+        for key, _ in sorted(self.index.items(), key=lambda x: x[1][:2]):
+            yield key, self.get(key)
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+
+        self._maps = {}
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+    pipeline.py
+
+    Helpers for moving image artifacts through the IO -> featurize stages
+"""
+from time import time
+from collections import OrderedDict
+from threading import Thread, BoundedSemaphore, Lock
+from concurrent.futures import TimeoutError as FutureTimeout
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+_done = object()
+
+
+class _Raise(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _start(target, *args):
+    thread = Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def imap(fn, iterable, executor, max_pending=64, ordered=True, deadline=None, on_timeout=None):
+    """
+        Lazy, bounded version of `executor.map`
+
+        Items are pulled from `iterable` on a background thread, so the input
+        can be an unbounded stream (eg stdin).  At most `max_pending` items
+        are in flight at once -- a slow consumer stalls the input instead of
+        growing memory.
+
+        ordered=False yields results as they complete, so one slow item
+        doesn't hold back the ones behind it.
+
+        deadline: seconds an item may take from submission.  An item that
+        isn't done by then is abandoned -- cancelled if it hasn't started,
+        otherwise left to finish on its thread w/ its result dropped -- and
+        `on_timeout(item)` is yielded in its place.  Abandoned items don't
+        count against `max_pending`.
+    """
+    if ordered:
+        return _imap_ordered(fn, iterable, executor, max_pending, deadline, on_timeout)
+    else:
+        return _imap_unordered(fn, iterable, executor, max_pending, deadline, on_timeout)
+
+
+def _imap_ordered(fn, iterable, executor, max_pending, deadline, on_timeout):
+    futures = Queue(maxsize=max_pending)
+
+    def feed():
+        try:
+            for item in iterable:
+                futures.put((item, time(), executor.submit(fn, item)))
+        except Exception as e:
+            futures.put(_Raise(e))
+        finally:
+            futures.put(_done)
+
+    _start(feed)
+    while True:
+        entry = futures.get()
+        if entry is _done:
+            break
+
+        if isinstance(entry, _Raise):
+            raise entry.exc
+
+        item, submitted, future = entry
+        if deadline is None:
+            yield future.result()
+            continue
+
+        try:
+            result = future.result(timeout=max(0, submitted + deadline - time()))
+        except FutureTimeout:
+            future.cancel()
+            yield on_timeout(item)
+        else:
+            yield result
+
+
+def _imap_unordered(fn, iterable, executor, max_pending, deadline, on_timeout):
+    slots = BoundedSemaphore(max_pending)
+    completed = Queue()
+
+    # future -> (item, submitted), in submission (so deadline) order
+    pending = OrderedDict()
+    lock = Lock()
+
+    def feed():
+        n_submitted = 0
+        try:
+            for item in iterable:
+                slots.acquire()
+                with lock:
+                    future = executor.submit(fn, item)
+                    pending[future] = (item, time())
+
+                future.add_done_callback(completed.put)
+                n_submitted += 1
+        except Exception as e:
+            completed.put(_Raise(e))
+        finally:
+            completed.put(n_submitted)
+
+    _start(feed)
+    n_yielded, n_total = 0, None
+    while n_total is None or n_yielded < n_total:
+        timeout = None
+        if deadline is not None:
+            with lock:
+                if pending:
+                    _, submitted = next(iter(pending.values()))
+                    timeout = max(0, submitted + deadline - time())
+
+        try:
+            future = completed.get(timeout=timeout)
+        except Empty:
+            now = time()
+            with lock:
+                expired = [(f, item) for f, (item, submitted) in pending.items() if submitted + deadline <= now]
+                for f, _ in expired:
+                    del pending[f]
+
+            for f, item in expired:
+                f.cancel()
+                slots.release()
+                n_yielded += 1
+                yield on_timeout(item)
+
+            continue
+
+        if isinstance(future, int):
+            n_total = future
+            continue
+
+        if isinstance(future, _Raise):
+            raise future.exc
+
+        with lock:
+            if pending.pop(future, None) is None:
+                continue  # already timed out
+
+        slots.release()
+        n_yielded += 1
+        yield future.result()
+
+
+class MicroBatcher(object):
+    """
+        Groups items from an iterator into lists of up to `batch_size` items.
+
+        A partial batch is flushed once its oldest item has waited `max_wait`
+        seconds, so a slow or bursty input doesn't hold finished images back.
+        The input iterator is drained on a background thread into a bounded
+        queue.
+
+        key: optional function of an item.  Items are batched separately per
+        key (eg image shape), and each bucket is flushed when it's full or
+        its own oldest item has waited `max_wait`.  Batches then come out of
+        input order -- see `reorder`.
+    """
+
+    def __init__(self, iterable, batch_size=16, max_wait=0.05, queue_size=None, key=None):
+        assert batch_size > 0
+
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.key = key
+        self.queue = Queue(maxsize=queue_size or 2 * batch_size)
+
+        self._thread = _start(self._fill, iterable)
+
+    def _fill(self, iterable):
+        try:
+            for item in iterable:
+                self.queue.put(item)
+        except Exception as e:
+            self.queue.put(_Raise(e))
+        finally:
+            self.queue.put(_done)
+
+    def __iter__(self):
+        # key -> (deadline, batch); buckets are created in deadline order
+        buckets = OrderedDict()
+        while True:
+            # checked every pass -- when the model is the bottleneck the queue
+            # is never empty, and a bucket for a rare key would never expire
+            now = time()
+            for k in [k for k, (deadline, _) in buckets.items() if deadline <= now]:
+                yield buckets.pop(k)[1]
+
+            try:
+                if buckets:
+                    deadline, _ = next(iter(buckets.values()))
+                    item = self.queue.get(timeout=max(0, deadline - time()))
+                else:
+                    item = self.queue.get()
+            except Empty:
+                continue
+
+            if item is _done:
+                break
+
+            if isinstance(item, _Raise):
+                raise item.exc
+
+            k = self.key(item) if self.key is not None else None
+            if k not in buckets:
+                buckets[k] = (time() + self.max_wait, [])
+
+            batch = buckets[k][1]
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield buckets.pop(k)[1]
+
+        for _, batch in buckets.values():
+            yield batch
+
+
+def reorder(pairs):
+    """
+        pairs: (i, x) with i = 0, 1, 2, ... in any order
+
+        Yields x in order of i, holding back anything that arrives early
+    """
+    pending, i = {}, 0
+    for j, x in pairs:
+        pending[j] = x
+        while i in pending:
+            yield pending.pop(i)
+            i += 1
+
+    for j in sorted(pending):
+        yield pending[j]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+    pooling.py
+
+    Pooled descriptors from batches of conv feature maps, shape (n, h, w, c)
+"""
+import numpy as np
+
+
+def _l2_normalize(x, axis=-1):
+    return x / np.maximum(np.linalg.norm(x, axis=axis, keepdims=True), 1e-12)
+
+
+def crow(maps):
+    """ sum pooling -- what `VGG16Worker(crow=True)` has always produced """
+    return maps.sum(axis=(1, 2))
+
+
+def weighted_crow(maps, a=2, b=2, eps=1e-6):
+    """
+        Cross-dimensional weighting (Kalantidis et al. 2016): spatial weights
+        from the normalized sum over channels, and idf-like channel weights
+        from the sparsity of each channel
+    """
+    spatial = maps.sum(axis=3, keepdims=True)
+    norm = (spatial ** a).sum(axis=(1, 2), keepdims=True) ** (1.0 / a)
+    spatial = (spatial / np.maximum(norm, eps)) ** (1.0 / b)
+
+    pooled = (maps * spatial).sum(axis=(1, 2))
+
+    nonzero = (maps > 0).mean(axis=(1, 2))
+    channel = np.log((nonzero.sum(axis=1, keepdims=True) + eps) / (nonzero + eps))
+
+    return pooled * channel
+
+
+def rmac_regions(h, w, levels=3, overlap=0.4):
+    """
+        Square regions at `levels` scales, w/ ~`overlap` between neighbors
+        (Tolias et al. 2016).  Returns a list of (y0, y1, x0, x1).
+    """
+    short = min(h, w)
+
+    # extra regions along the long side so they cover it w/ the right overlap
+    steps = np.arange(2, 8)
+    b = (max(h, w) - short) / (steps - 1.0)
+    n_extra = np.argmin(np.abs(((short ** 2 - short * b) / short ** 2) - overlap)) + 1
+    extra_h = n_extra if h > w else 0
+    extra_w = n_extra if w > h else 0
+
+    regions = []
+    for level in range(1, levels + 1):
+        size = int(np.floor(2 * short / (level + 1.0)))
+        if size < 1:
+            break
+
+        ny, nx = level + extra_h, level + extra_w
+        ys = np.linspace(0, h - size, ny).round().astype(int) if ny > 1 else [(h - size) // 2]
+        xs = np.linspace(0, w - size, nx).round().astype(int) if nx > 1 else [(w - size) // 2]
+        for y in ys:
+            for x in xs:
+                regions.append((y, y + size, x, x + size))
+
+    return regions
+
+
+def rmac(maps, levels=3):
+    """
+        Regional max pooling: max-pool each region, L2 normalize, sum over
+        regions, L2 normalize
+    """
+    _, h, w, _ = maps.shape
+
+    regional = np.stack([
+        maps[:, y0:y1, x0:x1].max(axis=(1, 2))
+        for y0, y1, x0, x1 in rmac_regions(h, w, levels)
+    ], axis=1)
+
+    return _l2_normalize(_l2_normalize(regional).sum(axis=1))
+
+
+poolers = {
+    "crow" : crow,
+    "wcrow" : weighted_crow,
+    "rmac" : rmac,
+}
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+    postprocess.py
+
+    Streaming descriptor post-processing: L2 normalization, PCA-whitening
+    fit incrementally on the stream, and float16 / int8 quantization.
+
+    `PostprocessWriter` sits in front of any writer from `tdesc.writers`,
+    buffers rows and transforms them in vectorized batches.  PCA statistics
+    are accumulated over the first `fit_size` rows; those rows are held back
+    until the fit, so there's no second pass over the data.
+"""
+import os
+import numpy as np
+
+
+class L2Normalize(object):
+    ready = True
+
+    def partial_fit(self, x):
+        pass
+
+    def transform(self, x):
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+class PCAWhitening(object):
+    """
+        Mean and covariance are accumulated batch by batch; the projection is
+        computed once `fit_size` rows have been seen.  `path` saves the fit
+        (or loads it, if it exists) so later runs use the same projection.
+    """
+    def __init__(self, dim, fit_size=10000, whiten=True, eps=1e-6, path=None):
+        self.dim = dim
+        self.fit_size = fit_size
+        self.whiten = whiten
+        self.eps = eps
+        self.path = path
+
+        self.n = 0
+        self._sum = None
+        self._outer = None
+
+        self.mean = None
+        self.projection = None
+        if path is not None and os.path.exists(path):
+            fit = np.load(path)
+            self.mean, self.projection = fit['mean'], fit['projection']
+
+    @property
+    def ready(self):
+        return self.projection is not None
+
+    def partial_fit(self, x):
+        if self.ready:
+            return
+
+        x = x.astype(np.float64)
+        if self._sum is None:
+            self._sum = np.zeros(x.shape[1])
+            self._outer = np.zeros((x.shape[1], x.shape[1]))
+
+        self.n += x.shape[0]
+        self._sum += x.sum(axis=0)
+        self._outer += x.T.dot(x)
+
+        if self.n >= self.fit_size:
+            self._fit()
+
+    def _fit(self):
+        mean = self._sum / self.n
+        cov = self._outer / self.n - np.outer(mean, mean)
+
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        order = np.argsort(eigvals)[::-1][:self.dim]
+
+        projection = eigvecs[:, order]
+        if self.whiten:
+            projection = projection / np.sqrt(np.maximum(eigvals[order], 0) + self.eps)
+
+        self.mean = mean.astype(np.float32)
+        self.projection = projection.astype(np.float32)
+        self._sum = self._outer = None
+
+        if self.path is not None:
+            with open(self.path, 'wb') as f:
+                np.savez(f, mean=self.mean, projection=self.projection)
+
+    def finish(self):
+        """ Fit on whatever has been seen, for streams shorter than `fit_size` """
+        if not self.ready and self.n > 0:
+            self._fit()
+
+    def transform(self, x):
+        return (x - self.mean).dot(self.projection)
+
+
+class Quantize(object):
+    """
+        float16, or int8 as round(127 * x) -- int8 expects values in [-1, 1],
+        eg after L2 normalization
+    """
+    ready = True
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+
+    def partial_fit(self, x):
+        pass
+
+    def transform(self, x):
+        if self.dtype == np.int8:
+            return np.clip(np.rint(x * 127), -127, 127).astype(np.int8)
+
+        return x.astype(self.dtype)
+
+
+class Pipeline(object):
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    @property
+    def ready(self):
+        return all(step.ready for step in self.steps)
+
+    def partial_fit(self, x):
+        """ Feed fitting steps, pushing `x` through the steps that are already fit """
+        for step in self.steps:
+            step.partial_fit(x)
+            if not step.ready:
+                return
+
+            x = step.transform(x)
+
+    def finish(self):
+        for step in self.steps:
+            if hasattr(step, 'finish'):
+                step.finish()
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for step in self.steps:
+            x = step.transform(x)
+
+        return x
+
+
+class _Rows(object):
+    """ Stands in for a worker, so `writer.write` picks up transformed rows """
+    def __init__(self, rows):
+        self._rows = rows
+
+    def rows(self, result):
+        return self._rows
+
+    def artifact(self, result):
+        return result[0]
+
+
+class PostprocessWriter(object):
+
+    def __init__(self, writer, pipeline, batch_size=256):
+        self.writer = writer
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self._buffer = []
+        self._n_rows = 0
+
+    def write(self, worker, result):
+        rows = list(worker.rows(result))
+        self._buffer.append((result, rows))
+        self._n_rows += len(rows)
+
+        if rows and not self.pipeline.ready:
+            self.pipeline.partial_fit(np.asarray([desc for _, _, _, desc in rows], dtype=np.float32))
+
+        if self.pipeline.ready and self._n_rows >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        rows = [row for _, r in self._buffer for row in r]
+        if rows:
+            descs = self.pipeline.transform([desc for _, _, _, desc in rows])
+
+        i = 0
+        for result, r in self._buffer:
+            transformed = [(id, k, bbox, descs[i + j]) for j, (id, k, bbox, _) in enumerate(r)]
+            self.writer.write(_Rows(transformed), result)
+            i += len(r)
+
+        self._buffer = []
+        self._n_rows = 0
+
+    def flush(self):
+        if self.pipeline.ready:
+            self._flush()
+
+        self.writer.flush()
+
+    def close(self):
+        self.pipeline.finish()
+        self._flush()
+        self.writer.close()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+"""
+    server.py
+
+    Long-running server: loads the model(s) once and featurizes images for
+    any number of clients, batching across them.
+
+        python -m tdesc serve --model vgg16 --socket /tmp/tdesc.sock --batch-size 16
+        cat filenames | python -m tdesc client --socket /tmp/tdesc.sock > feats
+
+    Protocol, over a Unix socket or localhost TCP (`--port`):
+        server -> client    `ok`, or `busy` (too many clients) and close
+        client -> server    one path / URL per line, then shutdown(SHUT_WR)
+        server -> client    results, in the same format as `python -m tdesc`,
+                            then close
+"""
+import io
+import os
+import sys
+import signal
+import socket
+import argparse
+import threading
+import traceback
+import socketserver
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from tdesc.pipeline import reorder
+
+
+class _Eof(object):
+    def __init__(self, n):
+        self.n = n
+
+
+class _Client(object):
+    """ One connection's images: admission slots, and results as (seq, result) """
+    def __init__(self, max_pending):
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.results = Queue()
+
+    def iter_results(self):
+        """ (seq, result) in completion order, until every submitted image is back """
+        n_received, n_total = 0, None
+        while n_total is None or n_received < n_total:
+            item = self.results.get()
+            if isinstance(item, _Eof):
+                n_total = item.n
+                continue
+
+            n_received += 1
+            yield item
+
+
+class Server(object):
+    """
+        All clients' images go into one `worker.run` stream, so concurrent
+        requests share micro-batches (`--batch-size`, `--max-wait`) and the
+        IO threads.  Results are routed back to their connection, in the
+        order that client sent them unless `ordered=False`.
+
+        Admission control:
+            max_clients     connections beyond this are answered `busy`
+            max_inflight    images in the pipeline, across clients
+            max_per_client  images in the pipeline per client, so one big
+                            request can't starve the others
+
+        An image holds its slots until its result is written to the
+        client, so a client over either limit -- or one that reads its
+        results slowly -- just isn't read from, ie it's pushed back through
+        the socket.
+
+        Failed and timed out images come back as nothing, like in
+        `python -m tdesc`.  They're noticed through the worker's dead-letter
+        hook, which also forwards to `run_kwargs['dead_letters']` if given.
+        Images the model fails on are skipped the same way (`skip_errors`),
+        so one bad image doesn't take the server down.
+    """
+    def __init__(self, worker, run_kwargs, make_writer, max_clients=64, max_inflight=256, max_per_client=64):
+        self.worker = worker
+        self.make_writer = make_writer
+        self.max_per_client = max_per_client
+
+        self.run_kwargs = dict(run_kwargs)
+        self.ordered = self.run_kwargs.pop('ordered', True)
+        self.dead_letters = self.run_kwargs.pop('dead_letters', None)
+
+        self.clients = threading.BoundedSemaphore(max_clients)
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+
+        self.queue = Queue()
+        self.generation = 0
+        self.pending = {}  # id(image_artifact) -> (client, seq)
+        self.lock = threading.Lock()
+
+    def submit(self, client, seq, path):
+        """ Blocks until `client` and the server have room for another image """
+        image_artifact = self.worker.artifact_class(path, path, save_results=False)
+
+        client.slots.acquire()
+        self.inflight.acquire()
+        with self.lock:
+            self.pending[id(image_artifact)] = (client, seq)
+
+        self.queue.put(image_artifact)
+
+    def _route(self, image_artifact, result):
+        with self.lock:
+            request = self.pending.pop(id(image_artifact), None)
+
+        if request is not None:  # else already failed by `_fail_pending`
+            client, seq = request
+            client.results.put((seq, result))
+
+    def _release(self, client):
+        self.inflight.release()
+        client.slots.release()
+
+    def write(self, image_artifact, stage, reason):
+        """ Dead-letter hook, see `BaseWorker.run` """
+        self._route(image_artifact, None)
+        if self.dead_letters is not None:
+            self.dead_letters.write(image_artifact, stage, reason)
+
+    def _inputs(self, generation):
+        while True:
+            image_artifact = self.queue.get()
+            if image_artifact is None:
+                return
+
+            if generation != self.generation:
+                # a crashed run's input thread -- leave it for the new run
+                self.queue.put(image_artifact)
+                return
+
+            yield image_artifact
+
+    def run(self):
+        """ The model loop -- across clients, results come out as soon as they're ready """
+        while True:
+            try:
+                results = self.worker.run(self._inputs(self.generation), ordered=False, dead_letters=self, skip_errors=True, **self.run_kwargs)
+                for result in results:
+                    if result is not None:
+                        self._route(self.worker.artifact(result), result)
+
+                return
+            except Exception:
+                # outside of featurization, eg a bug -- fail what's in flight and restart
+                traceback.print_exc()
+                self.generation += 1
+                self._fail_pending()
+
+    def _fail_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for client, seq in pending.values():
+            client.results.put((seq, None))
+
+    def handle(self, rfile, wfile):
+        if not self.clients.acquire(blocking=False):
+            wfile.write(b'busy\n')
+            return
+
+        try:
+            wfile.write(b'ok\n')
+
+            client = _Client(self.max_per_client)
+            thread = threading.Thread(target=self._read, args=(client, rfile))
+            thread.daemon = True
+            thread.start()
+
+            stream = io.TextIOWrapper(wfile, encoding='utf-8', write_through=True)
+            writer = self.make_writer(stream)
+
+            results = client.iter_results()
+            results = reorder(results) if self.ordered else (result for _, result in results)
+            try:
+                for result in results:
+                    try:
+                        if result is not None:
+                            writer.write(self.worker, result)
+                    finally:
+                        self._release(client)
+
+                writer.close()
+                stream.flush()
+                stream.detach()
+            finally:
+                # if the client went away, its images still have to come back
+                for _ in results:
+                    self._release(client)
+        finally:
+            self.clients.release()
+
+    def _read(self, client, rfile):
+        seq = 0
+        try:
+            for line in rfile:
+                path = line.decode('utf-8').strip()
+                if path:
+                    self.submit(client, seq, path)
+                    seq += 1
+        except (OSError, UnicodeDecodeError) as e:
+            print('tdesc: dropping rest of request (%s)' % e, file=sys.stderr)
+        finally:
+            client.results.put(_Eof(seq))
+
+    def close(self):
+        self.queue.put(None)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.server.tdesc.handle(self.rfile, self.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away; its images still drain through the pipeline
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(worker, run_kwargs, make_writer, socket_path=None, port=None, **kwargs):
+    """
+        Serve on `socket_path` (Unix socket) or 127.0.0.1:`port` until
+        SIGINT / SIGTERM.  kwargs go to `Server`.
+    """
+    server = Server(worker, run_kwargs, make_writer, **kwargs)
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        listener = _UnixServer(socket_path, _Handler)
+        address = socket_path
+    else:
+        listener = _TCPServer(('127.0.0.1', port), _Handler)
+        address = '127.0.0.1:%d' % listener.server_address[1]
+
+    listener.tdesc = server
+
+    thread = threading.Thread(target=listener.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print('tdesc: serving on %s' % address, file=sys.stderr)
+
+    try:
+        server.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        listener.shutdown()
+        listener.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        server.close()
+        worker.close()
+        if server.dead_letters is not None:
+            server.dead_letters.close()
+
+
+# --
+# Client
+
+def parse_client_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m tdesc client')
+    parser.add_argument('--socket', type=str, default=None)
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    assert (args.socket is None) != (args.port is None), 'tdesc client: needs one of --socket or --port'
+    return args
+
+
+def _send(sock, stream):
+    try:
+        for line in stream:
+            sock.sendall(line if line.endswith(b'\n') else line + b'\n')
+    finally:
+        sock.shutdown(socket.SHUT_WR)
+
+
+def client(argv):
+    """
+        Drop-in for `python -m tdesc` against a running server: paths on
+        stdin, results on stdout.  Returns an exit status.
+    """
+    args = parse_client_args(argv)
+
+    if args.socket is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+    else:
+        sock = socket.create_connection(('127.0.0.1', args.port))
+
+    rfile = sock.makefile('rb')
+    status = rfile.readline()
+    if status != b'ok\n':
+        print('tdesc client: server is %s' % (status.strip().decode('utf-8') or 'gone'), file=sys.stderr)
+        return 1
+
+    thread = threading.Thread(target=_send, args=(sock, sys.stdin.buffer))
+    thread.daemon = True
+    thread.start()
+
+    out = sys.stdout.buffer
+    while True:
+        chunk = rfile.read1(65536)
+        if not chunk:
+            break
+
+        out.write(chunk)
+        out.flush()
+
+    sock.close()
+    return 0
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+    store.py
+
+    Sharded HDF5 descriptor store.
+
+    Descriptors for many artifacts go into a fixed number of chunked,
+    compressed HDF5 shards, picked by a prefix of the md5 of the artifact id.
+    Appends are buffered per shard and written in bulk.  Each flush takes an
+    exclusive lock on the shard, so several processes can write to the same
+    store.
+
+        <root>/shard-<i>.h5
+            desc  (n, dim) descriptors
+            ids   (n,)     artifact ids
+            k     (n,)     descriptor index within the image, -1 if none
+            bbox  (n, 4)   top, bottom, left, right, -1 if none
+            attrs['descriptor']  descriptor name, if the worker names them
+"""
+import os
+import fcntl
+import h5py
+import hashlib
+import threading
+import numpy as np
+
+from tdesc.writers import _cast
+
+
+class ShardedStore(object):
+
+    def __init__(self, root, n_shards=16, dtype='float32', chunk_rows=1024,
+                 compression='gzip', buffer_rows=256, descriptor=None):
+
+        self.root = root
+        self.n_shards = n_shards
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.buffer_rows = buffer_rows
+        self.descriptor = descriptor
+
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+
+        self._buffers = [[] for _ in range(n_shards)]
+        self._locks = [threading.Lock() for _ in range(n_shards)]
+
+    def shard_for(self, id):
+        return int(hashlib.md5(id.encode('utf-8')).hexdigest()[:8], 16) % self.n_shards
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, 'shard-%04d.h5' % shard)
+
+    def append(self, image_artifact, rows):
+        """
+            rows: list of (id, k, bbox, desc), as from `worker.rows`
+
+            `image_artifact.rows` is set to (shard, start, stop) once the
+            rows have been written.
+        """
+        if not rows:
+            return
+
+        shard = self.shard_for(image_artifact.id)
+        image_artifact.store = self
+
+        with self._locks[shard]:
+            buf = self._buffers[shard]
+            buf.append((image_artifact, rows))
+            if sum(len(r) for _, r in buf) >= self.buffer_rows:
+                self._flush(shard)
+
+    def _flush(self, shard):
+        buf = self._buffers[shard]
+        if not buf:
+            return
+
+        rows = [row for _, r in buf for row in r]
+        descs = _cast([desc for _, _, _, desc in rows], self.dtype)
+        ids = [id for id, _, _, _ in rows]
+        ks = np.array([-1 if k is None else k for _, k, _, _ in rows], dtype=np.int32)
+        bboxes = np.array([[-1] * 4 if bbox is None else bbox for _, _, bbox, _ in rows], dtype=np.int32)
+
+        path = self.shard_path(shard)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with h5py.File(path, 'a') as f:
+                    if 'desc' not in f:
+                        self._create(f, descs.shape[1])
+                        if self.descriptor is not None:
+                            f.attrs['descriptor'] = self.descriptor
+
+                    assert descs.shape[1] == f['desc'].shape[1], \
+                        'ShardedStore: expected dim=%d, got %d' % (f['desc'].shape[1], descs.shape[1])
+
+                    start = f['desc'].shape[0]
+                    stop = start + len(rows)
+                    for name, values in (('desc', descs), ('ids', ids), ('k', ks), ('bbox', bboxes)):
+                        f[name].resize(stop, axis=0)
+                        f[name][start:stop] = values
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        for image_artifact, r in buf:
+            image_artifact.rows = (shard, start, start + len(r))
+            start += len(r)
+
+        self._buffers[shard] = []
+
+    def _create(self, f, dim):
+        chunks = self.chunk_rows
+        f.create_dataset('desc', shape=(0, dim), maxshape=(None, dim), dtype=self.dtype,
+                         chunks=(chunks, dim), compression=self.compression)
+        f.create_dataset('ids', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                         chunks=(chunks,), compression=self.compression)
+        f.create_dataset('k', shape=(0,), maxshape=(None,), dtype=np.int32,
+                         chunks=(chunks,), compression=self.compression)
+        f.create_dataset('bbox', shape=(0, 4), maxshape=(None, 4), dtype=np.int32,
+                         chunks=(chunks, 4), compression=self.compression)
+
+    def flush(self):
+        for shard in range(self.n_shards):
+            with self._locks[shard]:
+                self._flush(shard)
+
+    def read(self, shard, start, stop):
+        """ Returns the (stop - start, dim) descriptors of a row range """
+        path = self.shard_path(shard)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                with h5py.File(path, 'r') as f:
+                    return f['desc'][start:stop]
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def close(self):
+        self.flush()
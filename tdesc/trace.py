@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+    trace.py
+
+    Per-image timelines in Chrome trace event format -- open the output in
+    chrome://tracing or https://ui.perfetto.dev
+"""
+import os
+import json
+import zlib
+import threading
+
+
+class Tracer(object):
+    """
+        Records a complete ("X") event per stage for a sample of images.
+
+        An image is sampled if crc32 of its id falls in the first `sample`
+        fraction, so the same images are traced across runs.  Unsampled
+        images cost one crc32.  Events are streamed to `path` every
+        `flush_every` events, and recording stops after `max_events`, so
+        memory and file size stay bounded on long runs.
+
+        Keys are whatever the caller uses to identify an in-flight image
+        (`BaseWorker` uses `id(image_artifact)`).
+    """
+    def __init__(self, path, sample=1.0, flush_every=1000, max_events=10 ** 6):
+        self.path = path
+        self.threshold = int(sample * 2 ** 32)
+        self.flush_every = flush_every
+        self.max_events = max_events
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.labels = {}
+        self.threads = set()
+        self.events = []
+        self.n_events = 0
+
+        self.pid = os.getpid()
+        self.f = open(path, 'w')
+        self.f.write('[\n')
+        self._first = True
+
+    def begin(self, key, image_id):
+        """ Start tracking an image, and make it current on this thread """
+        if zlib.crc32(str(image_id).encode('utf-8')) < self.threshold:
+            self.labels[key] = str(image_id)
+            self.local.key = key
+        else:
+            self.local.key = None
+
+    def end(self, key):
+        self.labels.pop(key, None)
+
+    def span(self, name, start, duration, keys=None):
+        """
+            Record `name` from `start` for `duration` seconds, for each sampled
+            image in `keys` (default: the image current on this thread)
+        """
+        if keys is None:
+            keys = [getattr(self.local, 'key', None)]
+
+        labels = [self.labels[key] for key in keys if key in self.labels]
+        if not labels:
+            return
+
+        tid = threading.get_ident()
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({
+                    "name" : "thread_name", "ph" : "M", "pid" : self.pid, "tid" : tid,
+                    "args" : {"name" : threading.current_thread().name},
+                })
+
+            for label in labels:
+                if self.n_events >= self.max_events:
+                    break
+
+                self.n_events += 1
+                self.events.append({
+                    "name" : name,
+                    "cat" : "tdesc",
+                    "ph" : "X",
+                    "ts" : start * 1e6,
+                    "dur" : duration * 1e6,
+                    "pid" : self.pid,
+                    "tid" : tid,
+                    "args" : {"id" : label, "n" : len(keys)},
+                })
+
+            if len(self.events) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        for event in self.events:
+            if not self._first:
+                self.f.write(',\n')
+
+            self.f.write(json.dumps(event))
+            self._first = False
+
+        self.events = []
+        self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.f.write('\n]\n')
+            self.f.close()
@@ -1,14 +1,53 @@
+"""
+    Workers are imported on first use (PEP 562), so `import tdesc.workers`
+    doesn't pay for keras, dlib and darknet unless they're needed
+"""
 from __future__ import print_function, absolute_import
 
-import sys
+import importlib
 
-from .base import BaseWorker
+# class name -> module
+_workers = {
+    "BaseWorker" : ".base",
+    "DlibFaceWorker" : ".dlib_worker",
+    "DlibFaceBatchWorker" : ".dlib_batch_worker",
+    "DlibFaceShardedWorker" : ".dlib_sharded_worker",
+    "DlibAlignWorker" : ".dlib_align_worker",
+    "YoloWorker" : ".yolo_worker",
+    "VGG16Worker" : ".vgg16_worker",
+    "MultiWorker" : ".multi_worker",
+    "StubWorker" : ".stub_worker",
+}
 
-try:
-    from .dlib_worker import DlibFaceWorker
-    from .dlib_batch_worker import DlibFaceBatchWorker
-except:
-    print('cannot load dlib workers')
+# backend each module needs, for error messages
+_requires = {
+    ".dlib_worker" : "dlib",
+    ".dlib_batch_worker" : "dlib",
+    ".dlib_sharded_worker" : "dlib",
+    ".dlib_align_worker" : "dlib",
+    ".yolo_worker" : "libpydarknet",
+    ".vgg16_worker" : "keras",
+}
 
-from .yolo_worker import YoloWorker
-from .vgg16_worker import VGG16Worker
+__all__ = sorted(_workers)
+
+
+def __getattr__(name):
+    if name not in _workers:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    module_name = _workers[name]
+    try:
+        module = importlib.import_module(module_name, __name__)
+    except ImportError as e:
+        raise ImportError('tdesc: %s needs %s, which failed to import (%s)' % (
+            name, _requires.get(module_name, 'a missing dependency'), e
+        ))
+
+    worker = getattr(module, name)
+    globals()[name] = worker
+    return worker
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_workers))
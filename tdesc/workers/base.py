@@ -3,52 +3,525 @@
 """
     base.py
 
-    !! Need to figure out how to handle timeouts, since sometimes this wants
-    to be run on a stream coming from the internet that's slow or bursty
+    Base class for workers: IO threads read and decode images, the model
+    featurizes them (optionally in micro-batches).  Sources can be a slow or
+    bursty stream from the internet, so each image gets a deadline and
+    failures are reported to a dead-letter file instead of stalling the run.
 """
-import os
-import sys
-import json
-import itertools
-from time import time
+import hashlib
+import threading
+from contextlib import nullcontext
 from concurrent.futures import ThreadPoolExecutor
 
+from tdesc.pipeline import MicroBatcher, imap, reorder
+from tdesc.decode import load_rgb, DecodePool, BufferPool
+from tdesc.fetch import AsyncFetcher, DeadlineExceeded, is_url
+from tdesc.cache import DescriptorCache
+from tdesc.dedup import NearDuplicateIndex, dhash_size
+from tdesc.metrics import Metrics, NullMetrics
+from tdesc.artifacts import ImageArtifact
+
+
+_lock = threading.Lock()
+
+
+class CacheHit(object):
+    def __init__(self, blob, scale=None):
+        self.blob = blob
+        self.scale = scale
+
+
+
 class BaseWorker(object):
 
     print_interval = 25
+    artifact_class = ImageArtifact
+    decode_pool = None
+    buffers = None
+    fetcher = None
+    cache = None
+    dedup = None
+    metrics = NullMetrics()
+    dead_letters = None
+    deadline = None
+    skip_errors = False
+    _prefetches = {}
+    _leases = {}
+    draft = True
 
-    def run(self, image_artifacts, io_threads=5, timeout=10, chunk_size=10000):
-        start_time = time()
-        pool = ThreadPoolExecutor(max_workers=io_threads)
-        gen = (ia for ia in image_artifacts)
-        total_images = len(image_artifacts)
-        i = 0
+    # stage `featurize` / `featurize_batch` calls are timed as -- None for
+    # workers that time their inference elsewhere
+    inference_stage = 'inference'
+
+    def run(self, image_artifacts, io_threads=5, timeout=10, max_pending=None,
+            ordered=True, batch_size=1, max_wait=0.05, decode_procs=0,
+            fetch_connections=32, fetch_per_host=8, fetch_retries=3,
+            cache_path=None, cache_size=10000, dedup_radius=None, dedup_size=100000,
+            metrics=None, deadline=None, hedge_after=None, fetch_backoff=0.5, dead_letters=None,
+            skip_errors=False):
+        """
+            image_artifacts can be any iterable, including an unbounded
+            stream.  At most `max_pending` images are read ahead of the model.
+
+            ordered=False yields results as soon as they're ready, instead of
+            in input order.
+
+            batch_size > 1 groups decoded images into micro-batches (flushed
+            when full or after `max_wait` seconds) and hands them to
+            `featurize_batch`.  Workers that need equally sized batches
+            bucket them with `batch_key`.
+
+            decode_procs > 0 moves decoding off the IO threads into a pool of
+            processes (see `tdesc.decode.DecodePool`)
+
+            URLs are fetched by a pooled `tdesc.fetch.AsyncFetcher`, starting
+            as soon as they're pulled from the input, so up to `max_pending`
+            (capped by `fetch_connections`) downloads overlap regardless of
+            `io_threads`.  `timeout` applies to each fetch attempt; failed
+            attempts are retried up to `fetch_retries` times, w/ jittered
+            exponential backoff starting at `fetch_backoff` seconds.
+            hedge_after: seconds after which a slow fetch is sent again, the
+            first response winning.
+
+            deadline: seconds each image may spend being read (fetch, decode
+            and prepare, incl. waiting for an IO thread).  Images that miss it
+            are dropped, so a hung read costs at most `deadline` instead of
+            stalling ordered output.  An image stuck on a local read keeps its
+            IO thread until the read returns.
+
+            dead_letters: a `tdesc.writers.DeadLetterWriter`, which gets every
+            image that failed or missed its deadline, w/ the reason.
+
+            skip_errors: if featurization raises, retry the batch one image at
+            a time and yield None for (and dead-letter) the images that still
+            fail, instead of ending the run.
+
+            cache_path enables a `tdesc.cache.DescriptorCache` keyed by the
+            md5 of the image bytes (or `image_artifact.md5`, if given) and
+            `cache_config()`.  Hits skip decoding and featurization.
+
+            dedup_radius enables near-duplicate skipping: each image's
+            perceptual hash (`tdesc.dedup.dhash`) is looked up among the last
+            `dedup_size` featurized images, and one within `dedup_radius`
+            bits gets a copy of that image's result (via `to_cache` /
+            `from_cache`, then `rescale` if the two differ in size) instead
+            of being featurized.
+
+            metrics: a `tdesc.metrics.Metrics` to record per-stage latencies,
+            counters and queue depths into.  It's reported every
+            `print_interval` images if it was given a stream or textfile.
+        """
+        self.metrics = metrics if metrics is not None else Metrics(interval=0)
+        self._add_gauges()
+
+        self.deadline = deadline
+        self.dead_letters = dead_letters
+        self.skip_errors = skip_errors
+        self._prefetches = {}
+        self._leases = {}
+
+        if cache_path is not None:
+            # decoding changes the pixels the model sees, so it's part of the key
+            config = dict(self.cache_config(), decode=self._decode_kwargs())
+            self.cache = DescriptorCache(cache_path, config, capacity=cache_size)
+
+        if dedup_radius is not None:
+            self.dedup = NearDuplicateIndex(radius=dedup_radius, capacity=dedup_size)
+
+        if decode_procs > 0:
+            self.decode_pool = DecodePool(decode_procs, n_slots=io_threads)
+            self.buffers = BufferPool()
+
+        self.fetcher = AsyncFetcher(
+            max_connections=fetch_connections,
+            max_per_host=fetch_per_host,
+            retries=fetch_retries,
+            backoff=fetch_backoff,
+            timeout=timeout,
+            hedge_after=hedge_after,
+        )
+
+        try:
+            decoded = self._decoded(self._prefetched(image_artifacts), io_threads, max_pending or 4 * io_threads, ordered)
+
+            if batch_size <= 1:
+                for item in decoded:
+                    for result in self._featurize_items([item], batched=False):
+                        yield result
+                        self.metrics.done(key=self._key(result))
+            else:
+                batches = MicroBatcher(enumerate(decoded), batch_size=batch_size, max_wait=max_wait, key=self._batch_key)
+                results = self._featurize_batches(batches)
+                results = reorder(results) if ordered else (result for _, result in results)
+                for result in results:
+                    yield result
+                    self.metrics.done(key=self._key(result))
+        finally:
+            if self.fetcher.n_hedged:
+                self.metrics.incr('hedged', self.fetcher.n_hedged)
+
+            self.metrics.report()
+            self.metrics = NullMetrics()
+            self.dead_letters = None
+            self.deadline = None
+            self.skip_errors = False
+
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+
+            self.dedup = None
+
+            if self.decode_pool is not None:
+                self.decode_pool.close()
+                self.decode_pool = None
+                self.buffers = None
+
+            self.fetcher.close()
+            self.fetcher = None
 
-        for chunk in self._chunker(gen, chunk_size):
-            for image_artifact, imread_results in pool.map(self.do_io, chunk):
+    def _key(self, result):
+        """ How `metrics` identifies the image behind `result` """
+        return id(self.artifact(result)) if result is not None else None
 
+    def _add_gauges(self):
+        counters = self.metrics.counters
+        self.metrics.gauge('io', lambda: (
+            counters.get('input', 0) - counters.get('read', 0) - counters.get('failed', 0) - counters.get('timed_out', 0)
+        ))
+        self.metrics.gauge('model', lambda: counters.get('read', 0) - counters.get('started', 0))
+        self.metrics.gauge('decode_slots', lambda: (
+            len(self.decode_pool.slots) - self.decode_pool.free.qsize() if self.decode_pool is not None else 0
+        ))
+
+    def _prefetched(self, image_artifacts):
+        for image_artifact in image_artifacts:
+            self.metrics.incr('input')
+            if is_url(image_artifact.filepath):
+                future = self.fetcher.prefetch(image_artifact.filepath)
+                with _lock:
+                    self._prefetches[id(image_artifact)] = future
+
+            yield image_artifact
+
+    def _decoded(self, image_artifacts, io_threads, max_pending, ordered):
+        pool = ThreadPoolExecutor(max_workers=io_threads)
+
+        try:
+            i = 0
+            for image_artifact, imread_results in imap(self.do_io, image_artifacts, pool,
+                                                       max_pending=max_pending, ordered=ordered,
+                                                       deadline=self.deadline, on_timeout=self._timed_out):
                 i += 1
 
-                self.logger.debug('{} of {}'.format(i, total_images))
+                self.logger.debug('{} images read'.format(i))
 
                 if imread_results is not None:
 
                     self.logger.debug(self._detection_message(image_artifact))
 
-                    yield self.featurize(*(image_artifact, imread_results))
+                    yield image_artifact, imread_results
+        finally:
+            pool.shutdown(wait=False)
+
+    def _batch_key(self, item):
+        _, (_, obj) = item
+        return None if isinstance(obj, CacheHit) else self.batch_key(obj)
+
+    def _featurize_batches(self, batches):
+        """ batches of (i, item) -> (i, result) """
+        for batch in batches:
+            seqs, items = zip(*batch)
+            for i, result in zip(seqs, self._featurize_items(list(items), batched=True)):
+                yield i, result
+
+    def _featurize_items(self, items, batched):
+        """ Featurize cache misses and fill in cache hits, preserving order """
+        self.metrics.started([id(ia) for ia, _ in items])
+
+        misses = [(ia, obj) for ia, obj in items if not isinstance(obj, CacheHit)]
+        if len(misses) < len(items):
+            self.metrics.incr('cache_hits', len(items) - len(misses))
+
+        timer = self.metrics.timer(self.inference_stage, [id(ia) for ia, _ in misses]) if self.inference_stage else nullcontext()
+        with timer:
+            try:
+                if batched:
+                    results = self.featurize_batch(misses) if misses else []
+                else:
+                    results = [self.featurize(ia, obj) for ia, obj in misses]
+            except Exception:
+                if not self.skip_errors:
+                    raise
+
+                results = [self._featurize_or_none(ia, obj) for ia, obj in misses]
+
+        self.metrics.incr('featurized', len(misses))
+
+        for image_artifact, _ in misses:
+            self._release_buffer(image_artifact)
+
+        if self.cache is not None or self.dedup is not None:
+            for (image_artifact, _), result in zip(misses, results):
+                if result is None:
+                    continue
+
+                blob = self.to_cache(result)
+                if self.cache is not None:
+                    self.cache.put(image_artifact.md5, blob)
+                if self.dedup is not None and image_artifact.phash is not None:
+                    self.dedup.put(image_artifact.phash, (blob, image_artifact.size))
+
+        results = iter(results)
+        return [
+            self._from_cache_hit(ia, obj) if isinstance(obj, CacheHit) else next(results)
+            for ia, obj in items
+        ]
+
+    def _from_cache_hit(self, image_artifact, hit):
+        result = self.from_cache(image_artifact, hit.blob)
+        if hit.scale is not None:
+            result = self.rescale(result, *hit.scale)
 
-    def _chunker(self, iterable, chunk_size):
-        while True:
-            yield itertools.chain([next(iterable)], itertools.islice(iterable, chunk_size-1))
+        return result
+
+    def _featurize_or_none(self, image_artifact, obj):
+        try:
+            return self.featurize(image_artifact, obj)
+        except Exception as e:
+            self.logger.error('Failed to featurize {}'.format(image_artifact.filepath))
+            self.metrics.incr('featurize_failed')  # not `failed`, which counts reads (see the `io` gauge)
+            self._dead_letter(image_artifact, 'featurize', '%s: %s' % (e.__class__.__name__, e))
+            return None
+
+    def _detection_message(self, image_artifact):
+        return "Featurizing: {}".format(image_artifact.filepath)
+
+    def _timed_out(self, image_artifact):
+        """ Give up on an image -- called at most once per image, by `imap` or `do_io` """
+        with _lock:
+            if image_artifact.timed_out:
+                return image_artifact, None
+
+            image_artifact.timed_out = True
+
+        self._discard_prefetch(image_artifact)
+        self._release_buffer(image_artifact)
+        self.logger.error('Timed out reading {}'.format(image_artifact.filepath))
+        self.metrics.incr('timed_out')
+        self.metrics.drop(id(image_artifact))
+        self._dead_letter(image_artifact, 'deadline', 'no result after %ss' % self.deadline)
+        return image_artifact, None
+
+    def _discard_prefetch(self, image_artifact):
+        """ Drop the prefetch of an image that's done w/ IO, in case it wasn't used """
+        with _lock:
+            future = self._prefetches.pop(id(image_artifact), None)
+
+        if future is not None and self.fetcher is not None:
+            self.fetcher.discard(image_artifact.filepath, future)
+
+    def _dead_letter(self, image_artifact, stage, reason):
+        if self.dead_letters is not None:
+            self.dead_letters.write(image_artifact, stage, reason)
 
     def do_io(self, image_artifact):
         results = None
+        self.metrics.begin(id(image_artifact), image_artifact.id)
 
         try:
-            results = self.imread(image_artifact.filepath)
+            if self.cache is None and self.dedup is None:
+                results = self._decode_and_prepare(self.read_source(image_artifact.filepath), image_artifact)
+            else:
+                results = self._cached_imread(image_artifact)
+        except DeadlineExceeded:
+            self._timed_out(image_artifact)
         except Exception as e:
             self.logger.error('Failed to read {}'.format(image_artifact.filepath))
-            pass
+            if not image_artifact.timed_out:
+                self._dead_letter(image_artifact, 'io', '%s: %s' % (e.__class__.__name__, e))
+        else:
+            if results is None and not image_artifact.timed_out:
+                self._dead_letter(image_artifact, 'io', 'no result')
+
+        self._discard_prefetch(image_artifact)
+
+        if image_artifact.timed_out or results is None:
+            self._release_buffer(image_artifact)
+
+        if image_artifact.timed_out:
+            return (image_artifact, None)  # already given up on, see `_timed_out`
+
+        if results is None:
+            self.metrics.incr('failed')
+        else:
+            self.metrics.ready(id(image_artifact))
+            if image_artifact.timed_out:
+                # gave up on between the check above and `ready`
+                self.metrics.drop(id(image_artifact))
 
         return (image_artifact, results)
 
+    def imread(self, path):
+        return self._decode_and_prepare(self.read_source(path))
+
+    def _decode_and_prepare(self, src, image_artifact=None):
+        with self.metrics.timer('decode'):
+            img = self.decode(src)
+
+        with self.metrics.timer('prepare'):
+            obj = self.prepare(img)
+
+        if self.buffers is not None and image_artifact is not None:
+            with _lock:
+                self._leases[id(image_artifact)] = img
+
+        return obj
+
+    def _release_buffer(self, image_artifact):
+        """ Give an image's decode buffer back to `self.buffers`, once it's featurized or dropped """
+        with _lock:
+            buf = self._leases.pop(id(image_artifact), None)
+
+        if buf is not None and self.buffers is not None:
+            self.buffers.put(buf)
+
+    def _read_bytes(self, path):
+        src = self.read_source(path)
+        if not isinstance(src, bytes):
+            with self.metrics.timer('fetch'):
+                with open(src, 'rb') as f:
+                    src = f.read()
+
+        return src
+
+    def _cached_imread(self, image_artifact):
+        """ imread, but check the descriptor cache, then near-duplicates, first """
+        src = None
+        if self.cache is not None:
+            if image_artifact.md5 is None:
+                src = self._read_bytes(image_artifact.filepath)
+                image_artifact.md5 = hashlib.md5(src).hexdigest()
+
+            blob = self.cache.get(image_artifact.md5)
+            if blob is not None:
+                return CacheHit(blob)
+
+        if self.dedup is not None:
+            if src is None:
+                src = self._read_bytes(image_artifact.filepath)
+
+            with self.metrics.timer('phash'):
+                image_artifact.phash, image_artifact.size = dhash_size(src)
+
+            value = self.dedup.get(image_artifact.phash)
+            if value is not None:
+                self.metrics.incr('near_duplicates')
+                blob, size = value
+                if size == image_artifact.size:
+                    return CacheHit(blob)
+
+                w, h = image_artifact.size
+                return CacheHit(blob, scale=(float(w) / size[0], float(h) / size[1]))
+
+        if src is None:
+            src = self.read_source(image_artifact.filepath)
+
+        return self._decode_and_prepare(src, image_artifact)
+
+    def read_source(self, path):
+        """ Returns something `decode` can read: a local path, or the bytes behind a URL """
+        if is_url(path):
+            if self.fetcher is None:
+                self.fetcher = AsyncFetcher()
+
+            with self.metrics.timer('fetch'):
+                return self.fetcher.fetch(path, timeout=self.deadline)
+
+        return path
+
+    def decode(self, src):
+        if self.decode_pool is not None:
+            return self.decode_pool.decode(src, buffers=self.buffers, **self._decode_kwargs())
+        else:
+            return load_rgb(src, **self._decode_kwargs())
+
+    def _decode_kwargs(self):
+        kwargs = {"draft" : self.draft}
+        kwargs.update(self.decode_args())
+        return kwargs
+
+    def decode_args(self):
+        """ kwargs for `tdesc.decode.load_rgb` -- must be picklable """
+        return {}
+
+    def prepare(self, img):
+        """
+            Turn a decoded HxWx3 uint8 array into whatever `featurize` expects.
+
+            Runs once per image on the IO threads.  Keep images uint8 here
+            and do dtype conversion and normalization once per batch in
+            `featurize_batch` -- float32 quadruples the bytes in flight.
+            With `decode_procs`, `img` goes back to `self.buffers` once the
+            image is featurized, so results mustn't hold on to it.
+        """
+        return img
+
+    def batch_key(self, obj):
+        """
+            Only images w/ the same key (of their `imread` results) are
+            batched together.  Default: any images can share a batch.
+        """
+        return None
+
+    def featurize_batch(self, batch):
+        """
+            batch: list of (image_artifact, imread_results)
+
+            Returns a list of featurize results.  Workers whose models can
+            predict on several images at once should override this.
+        """
+        return [self.featurize(image_artifact, obj) for image_artifact, obj in batch]
+
+    def artifact(self, result):
+        """ The image_artifact a featurize result belongs to """
+        return result[0]
+
+    def rows(self, result):
+        """ Yields (id, k, bbox, desc) per descriptor in `result` -- see `tdesc.writers` """
+        raise NotImplementedError('%s does not produce descriptor rows' % self.__class__.__name__)
+
+    def to_dict(self, result):
+        """ JSON-able representation of a featurize result """
+        image_artifact = self.artifact(result)
+        return {
+            "_id" : image_artifact.id,
+            "descriptors" : [
+                {"k" : k, "bbox" : bbox, "desc" : [float(x) for x in desc]}
+                for _, k, bbox, desc in self.rows(result)
+            ]
+        }
+
+    def cache_config(self):
+        """ Everything about the model that changes its output, as a JSON-able dict """
+        raise NotImplementedError('%s does not support caching' % self.__class__.__name__)
+
+    def to_cache(self, result):
+        """ Serialize a featurize result to bytes """
+        raise NotImplementedError
+
+    def from_cache(self, image_artifact, blob):
+        """ Rebuild a featurize result for `image_artifact` from `to_cache` bytes """
+        raise NotImplementedError
+
+    def rescale(self, result, sx, sy):
+        """
+            Adapt a near-duplicate's result to this image, which is its size
+            scaled by (sx, sy).  Workers whose results are in the image's
+            pixel coordinates (eg face bboxes) must override this.
+        """
+        return result
+
+    def close(self):
+        pass
+
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+    dlib_align_worker.py
+
+    Detect faces and cut out aligned face chips (what `utils/quick-align.py`
+    does), for writing into a `tdesc.packfile`
+"""
+import io
+import os
+import sys
+import dlib
+import logging
+import numpy as np
+
+from PIL import Image
+
+from .base import BaseWorker
+
+
+class DlibAlignWorker(BaseWorker):
+    """
+        HOG detection, landmarks, alignment and JPEG encoding all run in
+        `prepare`, ie on the IO threads.  Results are
+        (image_artifact, [{"k", "bbox", "conf", "chip"}]) where chip is JPEG
+        bytes.
+
+        best_face: keep only the highest scoring face
+    """
+    def __init__(self, size=150, padding=0.25, det_threshold=0.0, upsample=0, best_face=False,
+                 quality=90, logger=None):
+        ppath = os.path.join(os.environ['HOME'], '.tdesc')
+
+        self.detector = dlib.get_frontal_face_detector()
+
+        shapepath = os.path.join(ppath, 'models/dlib/shape_predictor_68_face_landmarks.dat')
+        self.sp = dlib.shape_predictor(shapepath)
+
+        self.size = size
+        self.padding = padding
+        self.det_threshold = det_threshold
+        self.upsample = upsample
+        self.best_face = best_face
+        self.quality = quality
+        self.logger = logger or logging
+
+        print('DlibAlignWorker: ready (size=%d | padding=%f)' % (size, padding), file=sys.stderr)
+
+    def prepare(self, img):
+        dets, confs, _ = self.detector.run(img, self.upsample, self.det_threshold)
+
+        faces = []
+        for k, (d, conf) in enumerate(sorted(zip(dets, confs), key=lambda x: -x[1]) if self.best_face else zip(dets, confs)):
+            chip = dlib.get_face_chip(img, self.sp(img, d), size=self.size, padding=self.padding)
+
+            buf = io.BytesIO()
+            Image.fromarray(np.asarray(chip, dtype=np.uint8)).save(buf, format='JPEG', quality=self.quality)
+
+            faces.append({
+                "k" : k,
+                "bbox" : [d.top(), d.bottom(), d.left(), d.right()],
+                "conf" : float(conf),
+                "chip" : buf.getvalue(),
+            })
+
+            if self.best_face:
+                break
+
+        return faces
+
+    def featurize(self, image_artifact, faces):
+        return image_artifact, faces
+
+    def to_dict(self, result):
+        image_artifact, faces = result
+        return {
+            "_id" : image_artifact.id,
+            "faces" : [dict((k, v) for k, v in face.items() if k != 'chip') for face in faces],
+        }
+
+    def close(self):
+        print('DlibAlignWorker: terminating', file=sys.stderr)
@@ -8,58 +8,113 @@ import sys
 import numpy as np
 import dlib
 from .dlib_worker import DlibFaceWorker
+from tdesc.decode import resize
 
 
 class DlibFaceBatchWorker(DlibFaceWorker):
     """
         compute dlib face descriptors
+
+        The batched MMOD detector needs equally sized images.  By default
+        images are bucketed by shape (see `BaseWorker.batch_key`).  With
+        `canonical_sizes` (list of (width, height)), each image is instead
+        scaled to fit the size w/ the closest aspect ratio and zero padded,
+        so mixed-resolution input still makes full batches.  Detections are
+        mapped back to original coordinates, and landmarks and descriptors
+        are computed on the original image.
     """
 
-    def __init__(self, num_jitters=10, batch_size=10):
-        super(DlibFaceBatchWorker, self).__init__(num_jitters=num_jitters, dnn=True)
+    def __init__(self, num_jitters=10, logger=None, canonical_sizes=None):
+        super(DlibFaceBatchWorker, self).__init__(num_jitters=num_jitters, dnn=True, logger=logger)
         self.num_jitters = num_jitters
-        self.batch_size = batch_size
-
-        self.path_buffer = []
-        self.img_buffer = []
+        self.canonical_sizes = [tuple(size) for size in canonical_sizes] if canonical_sizes else None
 
         print('DlibFaceBatchWorker: ready (dnn=%d | num_jitters=%d)' % (1, int(num_jitters)), file=sys.stderr)
 
-    def featurize(self, path, obj, return_feat=False):
+    def batch_key(self, obj):
         img, _ = obj
-
-        self.path_buffer.append(path)
-        self.img_buffer.append(img)
-
-        if not len(self.img_buffer) % self.batch_size:
-            self._featurize()
-
-    def _featurize(self):
-        all_dets, _ = list(zip(*self.detector(self.img_buffer)))
+        h, w = img.shape[:2]
+        if self.canonical_sizes is None:
+            return (w, h)
+
+        aspect = np.log(float(w) / h)
+        return min(self.canonical_sizes, key=lambda size: abs(np.log(float(size[0]) / size[1]) - aspect))
+
+    def _letterbox(self, img, size):
+        """ Scale `img` to fit in `size` and pad bottom/right.  Returns (padded, scale) """
+        h, w = img.shape[:2]
+        if (w, h) == size:
+            return img, 1.0
+
+        scale = min(float(size[0]) / w, float(size[1]) / h)
+        resized = resize(img, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))))
+
+        padded = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        padded[:resized.shape[0], :resized.shape[1]] = resized
+        return padded, scale
+
+    def _detect(self, imgs):
+        """ Runs the detector once per batch key, in original coordinates """
+        groups = {}
+        for i, img in enumerate(imgs):
+            groups.setdefault(self.batch_key((img, None)), []).append(i)
+
+        all_dets = [None] * len(imgs)
+        for size, idxs in groups.items():
+            boxed = [self._letterbox(imgs[i], size) for i in idxs]
+            dets, _ = list(zip(*self.detector([padded for padded, _ in boxed])))
+
+            for i, (_, scale), img_dets in zip(idxs, boxed, dets):
+                if scale == 1.0:
+                    all_dets[i] = img_dets
+                    continue
+
+                h, w = imgs[i].shape[:2]
+                all_dets[i] = [
+                    dlib.rectangle(
+                        int(max(0, det.left() / scale)),
+                        int(max(0, det.top() / scale)),
+                        int(min(w - 1, det.right() / scale)),
+                        int(min(h - 1, det.bottom() / scale)),
+                    ) for det in img_dets
+                ]
+
+        return all_dets
+
+    def cache_config(self):
+        config = super(DlibFaceBatchWorker, self).cache_config()
+        config['canonical_sizes'] = self.canonical_sizes
+        return config
+
+    def featurize(self, image_artifact, obj):
+        return self.featurize_batch([(image_artifact, obj)])[0]
+
+    def featurize_batch(self, batch):
+        imgs = [img for _, (img, _) in batch]
+
+        all_dets = self._detect(imgs)
 
         all_shapes = []
-        for img, dets in zip(self.img_buffer, all_dets):
+        for img, dets in zip(imgs, all_dets):
             all_shapes.append([self.sp(img, det) for det in dets])
 
-        all_face_descriptors = self.facerec.compute_batch_face_descriptors(self.img_buffer, all_shapes)
+        all_face_descriptors = self.facerec.compute_batch_face_descriptors(imgs, all_shapes)
 
         i = 0
-        for path, dets in zip(self.path_buffer, all_dets):
+        results = []
+        for (image_artifact, _), dets in zip(batch, all_dets):
+            feats = []
             for ind, det in enumerate(dets):
-                face_descriptor = all_face_descriptors[i]
-                print('\t'.join((
-                    path,
-                    str(ind),
-                    '\t'.join(map(str, [det.top(), det.bottom(), det.left(), det.right()])),
-                    '\t'.join(map(str, face_descriptor))
-                )))
-                sys.stdout.flush()
+                feats.append({
+                    "k" : ind,
+                    "bbox" : [det.top(), det.bottom(), det.left(), det.right()],
+                    "desc" : np.array(all_face_descriptors[i])
+                })
                 i += 1
 
-        self.path_buffer = []
-        self.img_buffer = []
+            results.append((image_artifact, feats))
+
+        return results
 
     def close(self):
-        if len(self.path_buffer) > 0:
-            self._featurize()
         print('DlibFaceBatchWorker: terminating', file=sys.stderr)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+    dlib_sharded_worker.py
+
+    Run `dlib` face featurization in a pool of processes
+"""
+import sys
+import logging
+
+from .base import BaseWorker
+from .dlib_worker import DlibFaceWorker
+from tdesc.decode import load_rgb, process_pool
+
+# --
+# Runs in the worker processes
+
+_worker = None
+
+
+def _init(worker_kwargs):
+    global _worker
+    _worker = DlibFaceWorker(**worker_kwargs)
+
+
+def _describe(src, decode_kwargs):
+    img = load_rgb(src, **decode_kwargs)
+    _, feats = _worker.featurize(None, _worker.prepare(img))
+    return feats
+
+# --
+
+
+class DlibFaceShardedWorker(BaseWorker):
+    """
+        Same output as `DlibFaceWorker`, but decoding, detection, shape
+        prediction and `compute_face_descriptor` all run in `n_procs`
+        processes, each of which loads the dlib models once.
+
+        The IO threads fetch bytes and hand each image to a process, so
+        `run` uses at least `n_procs` IO threads.  Results are merged back
+        into one stream, in input order unless `ordered=False`.
+
+        The processes are started (and load their models) in the
+        constructor, from a forkserver -- forking the multi-threaded parent
+        later, from an IO thread, isn't safe.  Their time shows up as the
+        `inference` stage.
+    """
+    inference_stage = None
+
+    # same results as `DlibFaceWorker`, so they're cached and rescaled the same way
+    cache_config = DlibFaceWorker.cache_config
+    to_cache = DlibFaceWorker.to_cache
+    from_cache = DlibFaceWorker.from_cache
+    rescale = DlibFaceWorker.rescale
+
+    def __init__(self, n_procs=4, num_jitters=10, dnn=False, det_threshold=0.0, upsample=0, logger=None):
+        self.n_procs = n_procs
+        self.worker_kwargs = {
+            "num_jitters" : num_jitters,
+            "dnn" : dnn,
+            "det_threshold" : det_threshold,
+            "upsample" : upsample,
+        }
+        self.num_jitters = num_jitters
+        self.dnn = dnn
+        self.det_threshold = det_threshold
+        self.upsample = upsample
+        self.logger = logger or logging
+
+        self.executor = process_pool(n_procs, initializer=_init, initargs=(self.worker_kwargs,))
+
+        print('DlibFaceShardedWorker: ready (n_procs=%d | dnn=%d | num_jitters=%d)' % (
+            n_procs, int(dnn), int(num_jitters)), file=sys.stderr)
+
+    def run(self, image_artifacts, io_threads=5, **kwargs):
+        return super(DlibFaceShardedWorker, self).run(image_artifacts, io_threads=max(io_threads, self.n_procs), **kwargs)
+
+    def _decode_and_prepare(self, src, image_artifact=None):
+        with self.metrics.timer('inference'):
+            return self.executor.submit(_describe, src, self._decode_kwargs()).result()
+
+    def featurize(self, image_artifact, feats):
+        return image_artifact, feats
+
+    def rows(self, result):
+        image_artifact, feats = result
+        for feat in feats:
+            yield image_artifact.filepath, feat['k'], feat['bbox'], feat['desc']
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        print('DlibFaceShardedWorker: terminating', file=sys.stderr)
@@ -10,9 +10,9 @@
 import dlib
 import os
 import sys
-
-from skimage import io
-from skimage import color
+import json
+import logging
+import numpy as np
 
 from .base import BaseWorker
 
@@ -21,7 +21,7 @@ class DlibFaceWorker(BaseWorker):
     """
         compute dlib face descriptors
     """
-    def __init__(self, num_jitters=10, dnn=False, det_threshold=0.0, upsample=0):
+    def __init__(self, num_jitters=10, dnn=False, det_threshold=0.0, upsample=0, logger=None):
         ppath = os.path.join(os.environ['HOME'], '.tdesc')
 
         if not dnn:
@@ -40,16 +40,11 @@ class DlibFaceWorker(BaseWorker):
         self.dnn = dnn
         self.det_threshold = det_threshold
         self.upsample = upsample
+        self.logger = logger or logging
 
         print('DlibFaceWorker: ready (dnn=%d | num_jitters=%d)' % (int(dnn), int(num_jitters)), file=sys.stderr)
 
-    def imread(self, path):
-        img = io.imread(path)
-        if img.shape[-1] == 4:
-            img = color.rgba2rgb(img)
-        elif len(img.shape) == 2:
-            img = color.grey2rgb(img)
-
+    def prepare(self, img):
         if not self.dnn:
             dets, _, _ = self.detector.run(img, self.upsample, self.det_threshold)
         else:
@@ -57,7 +52,7 @@ class DlibFaceWorker(BaseWorker):
 
         return img, dets
 
-    def featurize(self, path, obj, return_feat=False):
+    def featurize(self, image_artifact, obj):
         img, dets = obj
         if self.dnn:
             dets, _ = self.detector(img)
@@ -67,23 +62,49 @@ class DlibFaceWorker(BaseWorker):
             shape = self.sp(img, d)
             face_descriptor = self.facerec.compute_face_descriptor(img, shape, self.num_jitters)
 
-            if not return_feat:
-                print('\t'.join((
-                    path,
-                    str(k),
-                    '\t'.join(map(str, [d.top(),d.bottom(),d.left(),d.right()])),
-                    '\t'.join(map(str, face_descriptor))
-                )))
-                sys.stdout.flush()
-            else:
-                feats.append({
-                    "k" : k,
-                    "bbox" : [d.top(),d.bottom(),d.left(),d.right()],
-                    "desc" : face_descriptor
-                })
-
-        if return_feat:
-            return path, feats
+            feats.append({
+                "k" : k,
+                "bbox" : [d.top(),d.bottom(),d.left(),d.right()],
+                "desc" : np.array(face_descriptor)
+            })
+
+        return image_artifact, feats
+
+    def rows(self, result):
+        image_artifact, feats = result
+        for feat in feats:
+            yield image_artifact.filepath, feat['k'], feat['bbox'], feat['desc']
+
+    def cache_config(self):
+        return {
+            "model" : "dlib_face",
+            "dnn" : self.dnn,
+            "num_jitters" : self.num_jitters,
+            "det_threshold" : self.det_threshold,
+            "upsample" : self.upsample,
+        }
+
+    def to_cache(self, result):
+        _, feats = result
+        return json.dumps([
+            {"k" : feat['k'], "bbox" : feat['bbox'], "desc" : [float(x) for x in feat['desc']]}
+            for feat in feats
+        ]).encode('utf-8')
+
+    def from_cache(self, image_artifact, blob):
+        feats = json.loads(blob.decode('utf-8'))
+        for feat in feats:
+            feat['desc'] = np.array(feat['desc'])
+
+        return image_artifact, feats
+
+    def rescale(self, result, sx, sy):
+        image_artifact, feats = result
+        for feat in feats:
+            top, bottom, left, right = feat['bbox']
+            feat['bbox'] = [int(round(top * sy)), int(round(bottom * sy)), int(round(left * sx)), int(round(right * sx))]
+
+        return image_artifact, feats
 
     def close(self):
         print('DlibFaceWorker: terminating', file=sys.stderr)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+    multi_worker.py
+
+    Run several workers over each image in one pass
+"""
+import sys
+import logging
+
+from .base import BaseWorker
+from tdesc.decode import resize
+
+
+class MultiWorker(BaseWorker):
+    """
+        Fetches and decodes each image once, at native resolution.  Each
+        sub-worker resizes from the shared decoded buffer to its own input
+        size (224 for vgg16, 416 for yolo, native for dlib), runs its model,
+        and the results are merged per image.
+
+        workers: list of (name, worker)
+    """
+    def __init__(self, workers, logger=None):
+        self.workers = list(workers)
+        self.logger = logger or logging
+
+        print('MultiWorker: ready (%s)' % ','.join(name for name, _ in self.workers), file=sys.stderr)
+
+    def decode_args(self):
+        return {}
+
+    def prepare(self, img):
+        return dict(
+            (name, worker.prepare(resize(img, **worker.decode_args())))
+            for name, worker in self.workers
+        )
+
+    def _sub_artifact(self, worker, image_artifact):
+        return worker.artifact_class(image_artifact.id, image_artifact.filepath, save_results=False)
+
+    def featurize(self, image_artifact, obj):
+        return self.featurize_batch([(image_artifact, obj)])[0]
+
+    def featurize_batch(self, batch):
+        merged = [(image_artifact, {}) for image_artifact, _ in batch]
+
+        for name, worker in self.workers:
+            sub_batch = [(self._sub_artifact(worker, image_artifact), obj[name]) for image_artifact, obj in batch]
+            for (_, results), result in zip(merged, worker.featurize_batch(sub_batch)):
+                results[name] = result
+
+        return merged
+
+    def to_dict(self, result):
+        image_artifact, results = result
+
+        out = {"_id" : image_artifact.id}
+        for name, worker in self.workers:
+            sub = worker.to_dict(results[name])
+            sub.pop('_id', None)
+            out[name] = sub
+
+        return out
+
+    def close(self):
+        for _, worker in self.workers:
+            worker.close()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""
+    stub_worker.py
+
+    Model-free worker with configurable latency, for benchmarking the
+    pipeline w/o a GPU
+"""
+import sys
+import logging
+import numpy as np
+from time import sleep
+
+from .base import BaseWorker
+
+
+class StubWorker(BaseWorker):
+    """
+        Takes `latency` seconds per featurize call plus `item_latency` per
+        image, so a batch of n costs latency + n * item_latency -- roughly
+        how a GPU model behaves.  Descriptors are a deterministic function of
+        the pixels, so results can be compared across runs.
+    """
+    def __init__(self, latency=0.0, item_latency=0.0, dim=512, target_dim=224, logger=None):
+        self.latency = latency
+        self.item_latency = item_latency
+        self.dim = dim
+        self.target_dim = target_dim
+        self.logger = logger or logging
+
+        print('StubWorker: ready (latency=%f | item_latency=%f)' % (latency, item_latency), file=sys.stderr)
+
+    def decode_args(self):
+        return {"target_size" : (self.target_dim, self.target_dim)}
+
+    def _predict(self, imgs):
+        batch = np.asarray(imgs, dtype=np.float32)
+        sleep(self.latency + self.item_latency * batch.shape[0])
+        means = batch.mean(axis=(1, 2))
+        return np.tile(means, (1, self.dim // means.shape[1] + 1))[:, :self.dim]
+
+    def featurize(self, image_artifact, img):
+        return (image_artifact, self._predict([img])[0])
+
+    def featurize_batch(self, batch):
+        image_artifacts, imgs = zip(*batch)
+        return list(zip(image_artifacts, self._predict(imgs)))
+
+    def rows(self, result):
+        image_artifact, feat = result
+        yield image_artifact.filepath, None, None, feat
+
+    def cache_config(self):
+        return {"model" : "stub", "dim" : self.dim, "target_dim" : self.target_dim}
+
+    def to_cache(self, result):
+        return result[1].astype(np.float32).tobytes()
+
+    def from_cache(self, image_artifact, blob):
+        return (image_artifact, np.frombuffer(blob, dtype=np.float32))
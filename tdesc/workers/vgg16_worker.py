@@ -3,30 +3,30 @@
 """
     vgg16_worker.py
 """
-import contextlib
 import io
 import logging
 import os
 import numpy as np
 import sys
-import urllib
 
+from PIL import Image
 
 from .base import BaseWorker
+from tdesc.cache import config_digest
+from tdesc.pooling import poolers
+
+# `preprocess_input`'s ImageNet channel means, BGR
+MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
 
 
 def import_vgg16():
     global VGG16
     global Model
     global load_model
-    global image
-    global preprocess_input
     global K
 
     from keras.applications import VGG16
     from keras.models import Model, load_model
-    from keras.preprocessing import image
-    from keras.applications.vgg16 import preprocess_input
 
     from keras import backend as K
 
@@ -36,8 +36,19 @@ class VGG16Worker(BaseWorker):
         compute late VGG16 features
 
         either densely connected (default) or crow (sum-pooled conv5)
+
+        `descriptors` (eg ['fc2', 'crow', 'rmac']) computes several at once
+        from one forward pass: the model outputs both the conv5 maps and fc2,
+        and the conv5 descriptors are pooled from the same activations (see
+        `tdesc.pooling`).  Results are then (image_artifact, {name: feat}).
+
+        If `model_cache` (a directory) is given, built models are saved there
+        and loaded from there on later runs, which skips loading the full
+        ImageNet model and cutting it down.  Each is a full copy of the
+        weights, so it's opt-in.
     """
-    def __init__(self, crow, target_dim=224, logger=None, model_path=None):
+    def __init__(self, crow, target_dim=224, logger=None, model_path=None, descriptors=None,
+                 model_cache=None):
 
         try:
             import_vgg16()
@@ -50,10 +61,19 @@ class VGG16Worker(BaseWorker):
 
         self.crow = crow
         self.model_path = model_path
+        self.descriptors = descriptors
+        self.model_cache = model_cache
+        self.logger = logger or logging
+
+        if descriptors:
+            unknown = set(descriptors) - set(poolers) - {'fc2'}
+            assert not unknown, 'VGG16Worker: unknown descriptors %s' % ','.join(sorted(unknown))
+            assert target_dim == 224, 'VGG16Worker: fc2 needs target_dim=224'
+
         self.model = self._get_model()
         self.target_dim = target_dim
+        self._batch_buf = np.empty((0, target_dim, target_dim, 3), dtype=np.float32)
         self._warmup()
-        self.logger = logger or logging
 
         if self.logger:
             self.logger.info(
@@ -61,13 +81,57 @@ class VGG16Worker(BaseWorker):
             )
 
     def _get_model(self):
+        if self.model_path and not (self.descriptors or self.crow):
+            return load_model(self.model_path)
+
+        cache_path = self._model_cache_path()
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                return load_model(cache_path)
+            except Exception as e:
+                self.logger.warning('VGG16Worker: rebuilding unreadable cached model %s (%s)' % (cache_path, e))
+
+        model = self._build_model()
+
+        if cache_path is not None:
+            try:
+                if not os.path.exists(self.model_cache):
+                    os.makedirs(self.model_cache)
+
+                # save + rename, so concurrent jobs never load a partial file
+                tmp_path = '%s.%d.tmp.h5' % (cache_path, os.getpid())
+                model.save(tmp_path)
+                os.rename(tmp_path, cache_path)
+            except Exception as e:
+                self.logger.warning('VGG16Worker: could not cache model at %s (%s)' % (cache_path, e))
+
+        return model
+
+    def _model_cache_path(self):
+        if self.model_cache is None:
+            return None
+
+        import keras
+        digest = config_digest({
+            "crow" : self.crow,
+            "descriptors" : self.descriptors,
+            "keras" : keras.__version__,
+            "backend" : K.backend(),
+        })
+        return os.path.join(self.model_cache, 'vgg16-%s.h5' % digest)
+
+    def _build_model(self):
         model = None
 
-        if self.crow:
-            model = VGG16(weights='imagenet', include_top=False)
+        if self.descriptors:
+            whole_model = VGG16(weights='imagenet', include_top=True)
+            model = Model(inputs=whole_model.input, outputs=[
+                whole_model.get_layer('block5_pool').output,
+                whole_model.get_layer('fc2').output,
+            ])
 
-        elif self.model_path:
-            model = load_model(self.model_path)
+        elif self.crow:
+            model = VGG16(weights='imagenet', include_top=False)
 
         else:
             whole_model = VGG16(weights='imagenet', include_top=True)
@@ -93,24 +157,81 @@ class VGG16Worker(BaseWorker):
     def _warmup(self):
         self.model.predict(np.zeros((1, self.target_dim, self.target_dim, 3)))
 
-    def imread(self, path):
+    def decode_args(self):
+        # keras' load_img resizes w/ nearest neighbor
+        return {
+            "target_size" : (self.target_dim, self.target_dim),
+            "resample" : Image.NEAREST,
+        }
 
-        if path[:4] == 'http':
-            with contextlib.closing(urllib.request.urlopen(path)) as req:
-                path = io.StringIO(req.read())
+    def prepare(self, img):
+        # stays uint8 until `_to_batch`
+        return img
 
-        img = image.load_img(path, target_size=(self.target_dim, self.target_dim))
+    def _to_batch(self, imgs):
+        """
+            uint8 RGB images -> float32 BGR, mean subtracted, ie
+            `preprocess_input`, in one pass into a reused buffer
+        """
+        if self._batch_buf.shape[0] < len(imgs):
+            self._batch_buf = np.empty((len(imgs),) + imgs[0].shape, dtype=np.float32)
 
-        img = image.img_to_array(img)
-        img = np.expand_dims(img, axis=0)
-        img = preprocess_input(img)
+        batch = self._batch_buf[:len(imgs)]
+        for i, img in enumerate(imgs):
+            batch[i] = img[..., ::-1]
 
-        return img
+        batch -= MEAN_BGR
+        return batch
 
     def featurize(self, image_artifact, img):
-        feat = self.model.predict(img).squeeze()
+        return self.featurize_batch([(image_artifact, img)])[0]
+
+    def featurize_batch(self, batch):
+        image_artifacts, imgs = zip(*batch)
+        feats = self.model.predict(self._to_batch(imgs), batch_size=len(imgs))
+
+        if self.descriptors:
+            maps, fc2 = feats
+            feats = dict((name, fc2 if name == 'fc2' else poolers[name](maps)) for name in self.descriptors)
+            return [
+                (image_artifact, dict((name, feat[i]) for name, feat in feats.items()))
+                for i, image_artifact in enumerate(image_artifacts)
+            ]
 
         if self.crow:
-            feat = feat.sum(axis=(0, 1))
+            feats = feats.sum(axis=(1, 2))
 
-        return (image_artifact, feat)
+        return list(zip(image_artifacts, feats))
+
+    def rows(self, result):
+        image_artifact, feat = result
+        if self.descriptors:
+            for name in self.descriptors:
+                yield image_artifact.filepath, name, None, feat[name]
+        else:
+            yield image_artifact.filepath, None, None, feat
+
+    def cache_config(self):
+        return {
+            "model" : "vgg16",
+            "crow" : self.crow,
+            "target_dim" : self.target_dim,
+            "model_path" : self.model_path,
+            "descriptors" : self.descriptors,
+        }
+
+    def to_cache(self, result):
+        _, feat = result
+        if self.descriptors:
+            buf = io.BytesIO()
+            np.savez(buf, **dict((name, f.astype(np.float32)) for name, f in feat.items()))
+            return buf.getvalue()
+
+        return feat.astype(np.float32).tobytes()
+
+    def from_cache(self, image_artifact, blob):
+        if self.descriptors:
+            feats = np.load(io.BytesIO(blob))
+            return (image_artifact, dict((name, feats[name]) for name in self.descriptors))
+
+        return (image_artifact, np.frombuffer(blob, dtype=np.float32))
@@ -5,6 +5,7 @@
 """
 import sys
 import io
+import json
 import numpy as np
 import os
 import logging
@@ -12,7 +13,7 @@ import logging
 from PIL import Image
 
 from .base import BaseWorker
-from tdesc.artifacts import YoloFeature
+from tdesc.artifacts import YoloArtifact
 
 
 def _import_yolo():
@@ -20,21 +21,12 @@ def _import_yolo():
     from libpydarknet import DarknetObjectDetector
 
 
-class DetBBox(object):
-
-    def __init__(self, bbox):
-        self.left = bbox.left
-        self.right = bbox.right
-        self.top = bbox.top
-        self.bottom = bbox.bottom
-        self.confidence = bbox.confidence
-        self.cls = bbox.cls
-
-
 class YoloWorker(BaseWorker):
 
+    artifact_class = YoloArtifact
+
     def __init__(self, cfg_path, weight_path, name_path,
-                 thresh=0.1, nms=0.3, target_dim=416,
+                 thresh=0.1, nms=0.3, target_dim=416, columns=False,
                  logger=None, *args, **kwargs):
         _import_yolo()
 
@@ -43,42 +35,110 @@ class YoloWorker(BaseWorker):
         DarknetObjectDetector.set_device(int(os.environ.get("CUDA_VISIBLE_DEVICES", "")))
 
         self.target_dim = target_dim
+        self.columns = columns
+        self.cfg_path = cfg_path
+        self.weight_path = weight_path
+        self.thresh = thresh
+        self.nms = nms
         self.class_names = open(name_path).read().splitlines()
         self.det = DarknetObjectDetector(cfg_path, weight_path, thresh, nms, 0)
 
+        self._chw = None
+        self._pass_buffer = True
+
         self.logger.debug('YoloWorker: ready')
 
     def _detection_message(self, yolo_artifact):
         return "Yolo Objects Detected: {}".format(yolo_artifact.filepath)
 
-    def imread(self, path):
-
-        img = Image.open(path).convert('RGB')
-        img = img.resize((self.target_dim, self.target_dim), Image.BILINEAR)
+    def decode_args(self):
+        return {
+            "target_size" : (self.target_dim, self.target_dim),
+            "resample" : Image.BILINEAR,
+        }
 
+    def _detect(self, img):
+        """
+            darknet wants planar (CHW) uint8 pixels.  They're transposed into
+            a reused buffer, which is handed to the binding as is -- only if
+            it won't take a buffer do we fall back to a bytes copy.
+        """
+        h, w = img.shape[:2]
+        if self._chw is None or self._chw.shape != (3, h, w):
+            self._chw = np.empty((3, h, w), dtype=np.uint8)
 
-        data = np.array(img).transpose([2,0,1]).astype(np.uint8).tostring()
+        np.copyto(self._chw, img.transpose(2, 0, 1))
 
-        return data, (img.size[0], img.size[1])
+        if self._pass_buffer:
+            try:
+                return self.det.detect_object(self._chw, w, h, 3).content
+            except TypeError:
+                self.logger.info('YoloWorker: detect_object does not take buffers, passing bytes')
+                self._pass_buffer = False
 
-    def featurize(self, yolo_artifact, obj):
+        return self.det.detect_object(self._chw.tobytes(), w, h, 3).content
 
-        data, size = obj
+    def featurize(self, yolo_artifact, img):
 
-        bboxes = [
-            DetBBox(x)
-            for x in self.det.detect_object(str(data), size[0], size[1], 3).content
-        ]
+        self._add_features(yolo_artifact, self._detect(img))
 
-        feats = []
+        return yolo_artifact
 
-        for bbox in bboxes:
-            yolo_artifact.features.append(
-                YoloFeature(
-                    self.class_names[bbox.cls],
-                    bbox.confidence,
-                    [bbox.top, bbox.bottom, bbox.left, bbox.right],
-                )
-            )
+    def featurize_batch(self, batch):
+        """
+            libpydarknet only exposes single image detection, so run the
+            detector back-to-back over the batch
+        """
+        for yolo_artifact, img in batch:
+            self._add_features(yolo_artifact, self._detect(img))
+
+        return [yolo_artifact for yolo_artifact, _ in batch]
+
+    def _add_features(self, yolo_artifact, bboxes):
+        """ Copy the binding's detections straight into the artifact's columns """
+        yolo_artifact.set_detections(
+            [bbox.cls for bbox in bboxes],
+            [bbox.confidence for bbox in bboxes],
+            [(bbox.top, bbox.bottom, bbox.left, bbox.right) for bbox in bboxes],
+            self.class_names,
+        )
+
+    def artifact(self, yolo_artifact):
+        return yolo_artifact
 
+    def to_dict(self, yolo_artifact):
+        if self.columns:
+            return yolo_artifact.to_columns()
+
+        return yolo_artifact.to_dict()
+
+    def cache_config(self):
+        return {
+            "model" : "yolo",
+            "cfg_path" : self.cfg_path,
+            "weight_path" : self.weight_path,
+            "class_names" : self.class_names,
+            "thresh" : self.thresh,
+            "nms" : self.nms,
+            "target_dim" : self.target_dim,
+        }
+
+    def to_cache(self, yolo_artifact):
+        return json.dumps({
+            "cls" : yolo_artifact.cls.tolist(),
+            "confidence" : yolo_artifact.confidence.tolist(),
+            "bbox" : yolo_artifact.bbox.tolist(),
+        }).encode('utf-8')
+
+    def from_cache(self, yolo_artifact, blob):
+        cached = json.loads(blob.decode('utf-8'))
+        if isinstance(cached, list):
+            # entries written before detections were columnar: (class_name, confidence, bbox)
+            cached = {
+                "cls" : [self.class_names.index(class_name) for class_name, _, _ in cached],
+                "confidence" : [confidence for _, confidence, _ in cached],
+                "bbox" : [bbox for _, _, bbox in cached],
+            }
+
+        yolo_artifact.set_detections(cached['cls'], cached['confidence'], cached['bbox'], self.class_names)
         return yolo_artifact
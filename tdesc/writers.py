@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+"""
+    writers.py
+
+    Output formats for worker results.
+
+    Descriptor workers expose `worker.rows(result)`, yielding one
+    (id, k, bbox, desc) row per descriptor -- `k` and `bbox` are None for
+    whole-image descriptors.  `k` can also be a descriptor name (eg
+    `VGG16Worker` w/ `descriptors`); the binary formats hold a single
+    descriptor, whose name goes in their metadata instead.
+"""
+import os
+import sys
+import json
+import threading
+import numpy as np
+from time import time
+
+
+class TSVWriter(object):
+    """
+        id [k bbox...] desc... -- one line per descriptor
+    """
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+
+    def write(self, worker, result):
+        for id, k, bbox, desc in worker.rows(result):
+            fields = [id]
+            if k is not None:
+                fields.append(str(k))
+            if bbox is not None:
+                fields.extend(map(str, bbox))
+
+            fields.extend(map(str, desc))
+            self.stream.write('\t'.join(fields) + '\n')
+
+        self.stream.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONWriter(object):
+    """
+        one JSON object per image, from `worker.to_dict(result)`
+    """
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+
+    def write(self, worker, result):
+        self.stream.write(json.dumps(worker.to_dict(result)) + '\n')
+        self.stream.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DeadLetterWriter(object):
+    """
+        one JSON object per image that couldn't be featurized:
+            {"_id", "filepath", "stage", "reason", "time"}
+
+        stage is `io` (read / decode failed), `deadline` (timed out) or
+        `featurize` (the model failed on it, w/ `skip_errors`).
+        Called from the IO threads, so writes are locked.  Failed inputs
+        can be retried w/ eg `jq -r .filepath dead.jsonl | python -m tdesc`.
+    """
+    def __init__(self, path):
+        self.stream = open(path, 'a')
+        self.lock = threading.Lock()
+        self.n = 0
+
+    def write(self, image_artifact, stage, reason):
+        line = json.dumps({
+            "_id" : image_artifact.id,
+            "filepath" : image_artifact.filepath,
+            "stage" : stage,
+            "reason" : reason,
+            "time" : time(),
+        })
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+            self.n += 1
+
+    def close(self):
+        self.stream.close()
+
+
+class BinaryWriter(object):
+    """
+        Appendable descriptor matrix
+
+            <prefix>.desc  -- raw row-major (n, dim) matrix of `dtype` (float32, float16 or int8)
+            <prefix>.index -- one line per row: id, k, top, bottom, left, right
+            <prefix>.json  -- dim, dtype and descriptor name (if any)
+
+        Re-opening an existing prefix appends to it.  Index lines are only
+        written once the rows they describe are flushed (every `flush_every`
+        rows, or on `flush`), so a killed run can only leave extra rows at
+        the end of `.desc` -- those, and any partial index line, are cut off
+        when the prefix is re-opened.  `flush` fsyncs both files, so rows
+        a `tdesc.checkpoint.Checkpoint` has recorded survive a power loss.
+    """
+    def __init__(self, prefix, dtype='float32', flush_every=1024):
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+        self.dim = None
+        self.descriptor = None
+        self.pending = []
+
+        meta = read_meta(prefix)
+        if meta is not None:
+            assert np.dtype(meta['dtype']) == self.dtype, 'BinaryWriter: %s has dtype %s' % (prefix, meta['dtype'])
+            self.dim = meta['dim']
+            self.descriptor = meta.get('descriptor')
+
+        self._repair()
+
+        self.desc_file = open(prefix + '.desc', 'ab')
+        self.index_file = open(prefix + '.index', 'a')
+
+    def _repair(self):
+        """ Truncate `.desc` and `.index` to the rows both of them have """
+        desc_path, index_path = self.prefix + '.desc', self.prefix + '.index'
+
+        n_lines, index_bytes = 0, 0
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # partial last line
+
+                    n_lines += 1
+                    index_bytes += len(line)
+
+        n_rows = 0
+        if os.path.exists(desc_path) and self.dim is not None:
+            n_rows = os.path.getsize(desc_path) // (self.dim * self.dtype.itemsize)
+
+        if n_rows < n_lines:
+            # shouldn't happen w/ this writer, but older runs flushed `.index` on its own
+            index_bytes = 0
+            with open(index_path, 'rb') as f:
+                for _ in range(n_rows):
+                    index_bytes += len(f.readline())
+
+            n_lines = n_rows
+
+        if os.path.exists(index_path):
+            with open(index_path, 'r+b') as f:
+                f.truncate(index_bytes)
+
+        if os.path.exists(desc_path):
+            with open(desc_path, 'r+b') as f:
+                f.truncate(n_lines * (self.dim or 0) * self.dtype.itemsize)
+
+    def write(self, worker, result):
+        rows = list(worker.rows(result))
+        if not rows:
+            return
+
+        rows, self.descriptor = _split_k(rows, self.descriptor)
+        descs = _cast([desc for _, _, _, desc in rows], self.dtype)
+        if self.dim is None:
+            self.dim = descs.shape[1]
+            self._write_meta()
+
+        assert descs.shape[1] == self.dim, 'BinaryWriter: expected dim=%d, got %d' % (self.dim, descs.shape[1])
+
+        self.desc_file.write(descs.tobytes())
+        for id, k, bbox, _ in rows:
+            bbox = bbox if bbox is not None else ('', '', '', '')
+            self.pending.append('\t'.join([id, '' if k is None else str(k)] + list(map(str, bbox))) + '\n')
+
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def _write_meta(self):
+        with open(self.prefix + '.json', 'w') as f:
+            json.dump({"dim" : self.dim, "dtype" : self.dtype.name, "descriptor" : self.descriptor}, f)
+
+    def flush(self):
+        self.desc_file.flush()
+        os.fsync(self.desc_file.fileno())
+
+        self.index_file.write(''.join(self.pending))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.desc_file.close()
+        self.index_file.close()
+
+
+class StoreWriter(object):
+    """
+        Appends to a `tdesc.store.ShardedStore`; each artifact ends up
+        pointing at its row range
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def write(self, worker, result):
+        rows, self.store.descriptor = _split_k(list(worker.rows(result)), self.store.descriptor)
+        self.store.append(worker.artifact(result), rows)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+class ChipWriter(object):
+    """
+        Face chips into a `tdesc.packfile.PackWriter` under `<id>-<k>`, plus
+        the quick-align TSV (id, k, top, bottom, left, right, conf) on `stream`
+    """
+    def __init__(self, pack, stream=sys.stdout):
+        self.pack = pack
+        self.stream = stream
+
+    def write(self, worker, result):
+        image_artifact, faces = result
+        for face in faces:
+            self.pack.write('%s-%d' % (image_artifact.id, face['k']), face['chip'])
+            self.stream.write('\t'.join([image_artifact.id, str(face['k'])] + list(map(str, face['bbox'])) + [str(face['conf'])]) + '\n')
+
+        self.stream.flush()
+
+    def flush(self):
+        self.pack.flush()
+
+    def close(self):
+        self.pack.close()
+
+
+def _cast(descs, dtype):
+    """ Refuses to cast floats to an integer dtype -- they'd wrap, see `postprocess.Quantize` """
+    descs = np.asarray(descs)
+    if dtype.kind == 'i' and descs.dtype.kind == 'f':
+        raise ValueError('tdesc: can only write %s descriptors that are already quantized' % dtype.name)
+
+    return descs.astype(dtype, copy=False)
+
+
+def _split_k(rows, name):
+    """ Move a descriptor name out of the `k` column -- returns (rows, name) """
+    out = []
+    for id, k, bbox, desc in rows:
+        if isinstance(k, str):
+            assert name in (None, k), 'tdesc: binary output holds one descriptor (%s), got %s' % (name, k)
+            name, k = k, None
+
+        out.append((id, k, bbox, desc))
+
+    return out, name
+
+
+class DetectionWriter(object):
+    """
+        Appendable columnar detections, eg from `YoloWorker`
+
+            <prefix>.dets  -- raw float32 (n, 6) matrix: class, confidence, top, bottom, left, right
+            <prefix>.index -- one line per image: id, start row, stop row, created
+            <prefix>.json  -- class names
+
+        Artifacts are buffered and written `flush_every` at a time, w/ one
+        write per file, straight from their columns.  Like `BinaryWriter`,
+        `.dets` is fsync'd before the index lines that point into it, and
+        re-opening cuts off anything a killed run left past the last
+        complete index line.
+    """
+    def __init__(self, prefix, flush_every=256):
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.buffer = []
+
+        self.n_rows = self._repair()
+
+        self.dets = open(prefix + '.dets', 'ab')
+        self.index = open(prefix + '.index', 'a')
+
+    def _repair(self):
+        """ Truncate `.index` to complete lines w/ their rows in `.dets`, and `.dets` to those rows """
+        dets_path, index_path = self.prefix + '.dets', self.prefix + '.index'
+
+        n_dets = os.path.getsize(dets_path) // (6 * 4) if os.path.exists(dets_path) else 0
+
+        n_rows, index_bytes = 0, 0
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # partial last line
+
+                    stop = int(line.split(b'\t')[2])
+                    if stop > n_dets:
+                        break
+
+                    n_rows = stop
+                    index_bytes += len(line)
+
+            with open(index_path, 'r+b') as f:
+                f.truncate(index_bytes)
+
+        if os.path.exists(dets_path):
+            with open(dets_path, 'r+b') as f:
+                f.truncate(n_rows * 6 * 4)
+
+        return n_rows
+
+    def write(self, worker, result):
+        yolo_artifact = worker.artifact(result)
+        if not os.path.exists(self.prefix + '.json'):
+            with open(self.prefix + '.json', 'w') as f:
+                json.dump({"class_names" : yolo_artifact.class_names or worker.class_names}, f)
+
+        self.buffer.append(yolo_artifact)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        lines = []
+        for yolo_artifact in self.buffer:
+            lines.append('%s\t%d\t%d\t%s\n' % (yolo_artifact.id, self.n_rows, self.n_rows + len(yolo_artifact), yolo_artifact.created))
+            self.n_rows += len(yolo_artifact)
+
+        table = np.column_stack([
+            np.concatenate([ya.cls for ya in self.buffer]),
+            np.concatenate([ya.confidence for ya in self.buffer]),
+            np.concatenate([ya.bbox for ya in self.buffer]),
+        ]).astype(np.float32)
+
+        self.dets.write(table.tobytes())
+        self.dets.flush()
+        os.fsync(self.dets.fileno())
+
+        self.index.write(''.join(lines))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.dets.close()
+        self.index.close()
+
+
+def read_detections(prefix):
+    """
+        Returns (dets, index, class_names): dets is a memmap'd (n, 6) float32
+        matrix, index a list of (id, start, stop, created)
+    """
+    with open(prefix + '.json') as f:
+        class_names = json.load(f)['class_names']
+
+    index = []
+    with open(prefix + '.index') as f:
+        for line in f:
+            id, start, stop, created = line.rstrip('\n').split('\t')
+            index.append((id, int(start), int(stop), created))
+
+    n_rows = index[-1][2] if index else 0
+    dets = np.memmap(prefix + '.dets', dtype=np.float32, mode='r', shape=(n_rows, 6)) if n_rows else np.zeros((0, 6), dtype=np.float32)
+    return dets, index, class_names
+
+
+def read_meta(prefix):
+    if not os.path.exists(prefix + '.json'):
+        return None
+
+    with open(prefix + '.json') as f:
+        return json.load(f)
+
+
+class BinaryReader(object):
+    """
+        Reads `BinaryWriter` output.  `descs` is a read-only memmap, so
+        loading is free and rows are paged in on demand.
+    """
+    def __init__(self, prefix):
+        meta = read_meta(prefix)
+        self.dim = meta['dim']
+        self.dtype = np.dtype(meta['dtype'])
+        self.descriptor = meta.get('descriptor')
+
+        # Size from the file, not the index, so a partially written trailing
+        # row (eg from a killed run) is ignored
+        n = os.path.getsize(prefix + '.desc') // (self.dim * self.dtype.itemsize)
+        if n > 0:
+            self.descs = np.memmap(prefix + '.desc', dtype=self.dtype, mode='r', shape=(n, self.dim))
+        else:
+            self.descs = np.zeros((0, self.dim), dtype=self.dtype)
+
+        self.prefix = prefix
+        self._index = None
+
+    def __len__(self):
+        return self.descs.shape[0]
+
+    @property
+    def index(self):
+        """ list of (id, k, bbox) per row """
+        if self._index is None:
+            self._index = []
+            with open(self.prefix + '.index') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    k = int(fields[1]) if fields[1] else None
+                    bbox = list(map(int, fields[2:6])) if fields[2] else None
+                    self._index.append((fields[0], k, bbox))
+
+            self._index = self._index[:len(self)]
+
+        return self._index
+
+    @property
+    def ids(self):
+        return [id for id, _, _ in self.index]
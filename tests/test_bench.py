@@ -0,0 +1,42 @@
+import gc
+import json
+import warnings
+
+from tdesc import bench
+
+
+def _write(path, records):
+    with open(str(path), 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def test_compare_keeps_latency_settings_apart(tmp_path, capsys):
+    record = {"kind" : "e2e", "source" : "file", "io_threads" : 4, "batch_size" : 16, "images_per_sec" : 100.0}
+    _write(tmp_path / 'base.jsonl', [dict(record, latency=0.005), dict(record, latency=0.05, images_per_sec=10.0)])
+    _write(tmp_path / 'new.jsonl', [dict(record, latency=0.005, images_per_sec=200.0)])
+
+    bench.compare(str(tmp_path / 'base.jsonl'), str(tmp_path / 'new.jsonl'))
+    lines = capsys.readouterr().out.strip().split('\n')
+    assert len(lines) == 1
+    assert 'latency=0.005' in lines[0] and lines[0].endswith('2.00x')
+
+
+def test_run(tmp_path, capsys):
+    args = bench.parse_args([
+        '--n-images', '8', '--image-size', '64x48', '--corpus-dir', str(tmp_path / 'corpus'),
+        '--source', 'file,http', '--io-threads', '2', '--batch-size', '4', '--latency', '0', '--item-latency', '0',
+    ])
+
+    # files and sockets left to the garbage collector warn when collected
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        bench.run(args)
+        gc.collect()
+
+    assert [w for w in caught if issubclass(w.category, ResourceWarning)] == []
+
+    records = [json.loads(line) for line in capsys.readouterr().out.strip().split('\n')]
+    assert set(r['stage'] for r in records if r['kind'] == 'stage') == set([
+        'fetch', 'decode', 'prepare', 'inference', 'serialize_tsv', 'serialize_binary'])
+    assert [r['n_done'] for r in records if r['kind'] == 'e2e'] == [8, 8]
@@ -0,0 +1,64 @@
+import sys
+import pytest
+
+from tdesc.__main__ import parse_args
+from tdesc.cache import DescriptorCache
+
+
+def test_lru_eviction(tmp_path):
+    cache = DescriptorCache(str(tmp_path / 'cache.db'), {"model" : "stub"}, capacity=2)
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    assert cache.get('a') == b'1'  # now most recently used
+    cache.put('c', b'3')
+
+    assert list(cache._lru) == ['a', 'c']
+
+    # evicted from memory, but still in SQLite
+    assert cache.get('b') == b'2'
+    assert list(cache._lru) == ['c', 'b']
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    assert cache.get('d') is None
+    assert cache.misses == 1
+    cache.close()
+
+
+def test_persists_across_reopen(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = DescriptorCache(path, {"model" : "stub"}, flush_every=1000)
+    for i in range(10):
+        cache.put('md5-%d' % i, b'blob-%d' % i)
+    cache.close()
+
+    cache = DescriptorCache(path, {"model" : "stub"})
+    assert cache._lru == {}
+    assert [cache.get('md5-%d' % i) for i in range(10)] == [b'blob-%d' % i for i in range(10)]
+    cache.close()
+
+
+def test_config_change_invalidates(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = DescriptorCache(path, {"model" : "stub", "target_dim" : 32})
+    cache.put('a', b'1')
+    cache.close()
+
+    cache = DescriptorCache(path, {"model" : "stub", "target_dim" : 64})
+    assert cache.get('a') is None
+    cache.put('a', b'2')
+    cache.close()
+
+    # key order doesn't matter
+    cache = DescriptorCache(path, {"target_dim" : 32, "model" : "stub"})
+    assert cache.get('a') == b'1'
+    cache.close()
+
+
+@pytest.mark.parametrize('model', ['stub,stub', 'dlib_align'])
+def test_reject_uncacheable(model, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['tdesc', '--model', model, '--cache', 'x', '--outpath', 'x'])
+    with pytest.raises(AssertionError):
+        parse_args()
+
+    monkeypatch.setattr(sys, 'argv', ['tdesc', '--model', 'stub', '--cache', 'x'])
+    parse_args()
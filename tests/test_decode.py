@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+
+from PIL import Image
+
+from tdesc.bench import make_corpus
+from tdesc.artifacts import ImageArtifact
+from tdesc.decode import DecodePool, BufferPool, load_rgb
+from tdesc.workers.stub_worker import StubWorker
+
+
+def test_decode_pool_matches_inline(tmp_path):
+    paths = make_corpus(str(tmp_path / 'images'), 6, size=(64, 48))
+    with open(paths[1], 'rb') as f:
+        srcs = [paths[0], f.read()] + paths[2:]
+
+    # slots big enough for 32x32 images but not 64x48, to cover the pickling fallback
+    pool = DecodePool(2, n_slots=2, slot_bytes=32 * 32 * 3)
+    try:
+        for src in srcs:
+            assert np.array_equal(pool.decode(src, target_size=(32, 32)), load_rgb(src, target_size=(32, 32)))
+            assert np.array_equal(pool.decode(src), load_rgb(src))
+
+        # decoding from several threads at once, as the IO threads do
+        buffers = BufferPool()
+        out = {}
+        def decode(i):
+            out[i] = pool.decode(srcs[i], buffers=buffers, target_size=(24, 16))
+
+        threads = [threading.Thread(target=decode, args=(i,)) for i in range(len(srcs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i, src in enumerate(srcs):
+            assert np.array_equal(out[i], load_rgb(src, target_size=(24, 16)))
+
+        assert pool.free.qsize() == len(pool.slots)
+    finally:
+        pool.close()
+
+
+def test_draft_decode(tmp_path):
+    path = make_corpus(str(tmp_path / 'images'), 1, size=(800, 600))[0]
+
+    draft = load_rgb(path, target_size=(100, 75))
+    full = load_rgb(path, target_size=(100, 75), draft=False)
+    assert draft.shape == full.shape == (75, 100, 3)
+    assert np.abs(draft.astype(np.float32) - full.astype(np.float32)).mean() < 4
+
+    # only JPEGs have draft modes
+    png = str(tmp_path / 'image.png')
+    Image.open(path).save(png)
+    assert np.array_equal(load_rgb(png, target_size=(100, 75)), load_rgb(png, target_size=(100, 75), draft=False))
+
+    # native size: no draft scaling
+    assert load_rgb(path).shape == (600, 800, 3)
+
+
+def test_buffer_pool():
+    pool = BufferPool()
+    buf = pool.get((4, 4, 3))
+    pool.put(np.empty((4, 4, 3), dtype=np.uint8))  # not from the pool
+    assert pool.free == {}
+
+    pool.put(buf)
+    pool.put(buf)  # only once
+    assert pool.free[(4, 4, 3)] == [buf]
+    assert pool.get((4, 4, 3)) is buf
+
+    # buffers that are never put back are just freed
+    pool.get((2, 2, 3))
+    assert len(pool.issued) == 1
+
+
+class TupleWorker(StubWorker):
+    """ `prepare` returns a tuple, like `DlibFaceWorker` """
+    seen = []
+
+    def prepare(self, img):
+        return img, img.shape
+
+    def featurize(self, image_artifact, obj):
+        self.seen.append(obj[0])
+        self.pool = self.buffers
+        return StubWorker.featurize(self, image_artifact, obj[0])
+
+    def featurize_batch(self, batch):
+        return [self.featurize(image_artifact, obj) for image_artifact, obj in batch]
+
+
+def test_buffers_recycled(tmp_path):
+    paths = make_corpus(str(tmp_path / 'images'), 8, size=(64, 48))
+
+    worker = TupleWorker(target_dim=32)
+    results = list(worker.run(
+        [ImageArtifact(path, path, save_results=False) for path in paths], io_threads=1, decode_procs=1
+    ))
+    assert len(results) == 8
+
+    # every buffer came back, and was reused for later images
+    assert len(worker.pool.issued) == 0
+    assert len(set(id(buf) for buf in worker.seen)) < 8
+    assert worker._leases == {}
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import pytest
+import subprocess
+
+from PIL import Image
+
+from tdesc.bench import make_corpus
+from tdesc.dedup import NearDuplicateIndex, dhash, hamming
+from tdesc.artifacts import ImageArtifact
+from tdesc.metrics import Metrics
+from tdesc.workers.stub_worker import StubWorker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BoxWorker(StubWorker):
+    """ One box covering the whole image, in its pixel coordinates, like a face bbox """
+    def featurize(self, image_artifact, img):
+        h, w = img.shape[:2]
+        return image_artifact, [0, h, 0, w]
+
+    def featurize_batch(self, batch):
+        return [self.featurize(image_artifact, img) for image_artifact, img in batch]
+
+    def decode_args(self):
+        return {}
+
+    def to_cache(self, result):
+        return json.dumps(result[1]).encode('utf-8')
+
+    def from_cache(self, image_artifact, blob):
+        return image_artifact, json.loads(blob.decode('utf-8'))
+
+    def rescale(self, result, sx, sy):
+        image_artifact, (top, bottom, left, right) = result
+        return image_artifact, [int(round(top * sy)), int(round(bottom * sy)), int(round(left * sx)), int(round(right * sx))]
+
+
+def test_index():
+    index = NearDuplicateIndex(radius=2, capacity=2)
+    index.put(0b1111, 'a')
+    assert index.get(0b1101) == 'a'
+    assert index.get(0b0000) is None
+
+    index.put(1 << 40, 'b')
+    index.put(1 << 50, 'c')
+    assert index.get(0b1111) is None
+    assert len(index) == 2
+
+
+def test_resized_duplicate_gets_scaled_boxes(tmp_path):
+    path, = make_corpus(str(tmp_path), 1, size=(640, 480))
+    small = str(tmp_path / 'small.jpg')
+    Image.open(path).resize((320, 240), Image.BILINEAR).save(small, quality=75)
+    assert hamming(dhash(path), dhash(small)) <= 4
+
+    def artifacts():
+        yield ImageArtifact(path, path, save_results=False)
+        time.sleep(0.2)  # so the original is featurized before its copy is read
+        yield ImageArtifact(small, small, save_results=False)
+
+    metrics = Metrics(interval=0)
+    results = list(BoxWorker().run(artifacts(), io_threads=1, dedup_radius=4, metrics=metrics))
+
+    assert metrics.counters['near_duplicates'] == 1
+    assert [box for _, box in results] == [[0, 480, 0, 640], [0, 240, 0, 320]]
+
+
+def _cli(args, paths):
+    return subprocess.run(
+        [sys.executable, '-m', 'tdesc', '--target-dim', '32'] + args,
+        input=('\n'.join(paths) + '\n').encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT
+    )
+
+
+def test_cli_dedup(tmp_path):
+    paths = make_corpus(str(tmp_path), 3, size=(64, 48))
+
+    proc = _cli(['--model', 'stub', '--dedup-radius', '4'], paths + paths)
+    assert proc.returncode == 0
+    assert len(proc.stdout.decode().strip().split('\n')) == 6
+
+
+@pytest.mark.parametrize('model', ['stub,stub', 'dlib_align'])
+def test_cli_rejects_workers_wo_cache_hooks(tmp_path, model):
+    paths = make_corpus(str(tmp_path), 3, size=(64, 48))
+
+    # before any work starts, rather than on the first near-duplicate
+    proc = _cli(['--model', model, '--dedup-radius', '4', '--outpath', str(tmp_path / 'chips')], paths)
+    assert proc.returncode != 0
+    assert proc.stdout == b''
+    assert b'--dedup-radius need a single model' in proc.stderr
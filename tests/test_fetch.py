@@ -0,0 +1,175 @@
+import gc
+import time
+import pytest
+import warnings
+import threading
+
+from tdesc import bench
+from tdesc.fetch import AsyncFetcher, HTTPError, DeadlineExceeded
+
+
+class Handler(bench._Handler):
+    """ bench's stand-in server, plus a few fault-injecting paths """
+    connections = 0
+    calls = {}
+    lock = threading.Lock()
+
+    def setup(self):
+        bench._Handler.setup(self)
+        with self.lock:
+            Handler.connections += 1
+
+    def do_GET(self):
+        with self.lock:
+            n = Handler.calls[self.path] = Handler.calls.get(self.path, 0) + 1
+
+        if self.path == '/flaky' and n <= 2:
+            return self._send(503, b'')
+
+        if self.path == '/flaky':
+            return self._send(200, b'finally')
+
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/a.txt')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in (b'hello ', b'chunked ', b'world'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+            self.wfile.write(b'0\r\n\r\n')
+            return
+
+        if self.path == '/slow-once':
+            time.sleep(2 if n == 1 else 0)
+            return self._send(200, b'slow %d' % n)
+
+        if self.path == '/hang':
+            time.sleep(2)
+            return self._send(200, b'late')
+
+        return bench._Handler.do_GET(self)
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / 'a.txt').write_bytes(b'a' * 1000)
+    (tmp_path / 'b.txt').write_bytes(b'b' * 100000)
+
+    Handler.connections, Handler.calls = 0, {}
+    server, base = bench.serve(str(tmp_path), handler=Handler)
+    yield base
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = AsyncFetcher(retries=3, backoff=0.01, timeout=5)
+    yield fetcher
+    fetcher.close()
+
+
+def test_fetch(server, fetcher):
+    assert fetcher.fetch(server + '/a.txt') == b'a' * 1000
+    assert fetcher.fetch(server + '/b.txt') == b'b' * 100000
+
+
+def test_keep_alive(server, fetcher):
+    for _ in range(10):
+        fetcher.fetch(server + '/a.txt')
+
+    assert Handler.connections == 1
+
+
+def test_close_closes_connections(server):
+    fetcher = AsyncFetcher()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        for _ in range(3):
+            fetcher.fetch(server + '/a.txt')
+
+        fetcher.close()
+        del fetcher
+        gc.collect()
+
+    assert [w for w in caught if issubclass(w.category, ResourceWarning)] == []
+
+
+def test_prefetch(server, fetcher):
+    futures = [fetcher.prefetch(server + '/a.txt') for _ in range(3)]
+    assert [fetcher.fetch(server + '/a.txt') for _ in range(3)] == [b'a' * 1000] * 3
+    assert all(future.done() for future in futures)
+    assert dict(fetcher._prefetched) == {}
+
+    future = fetcher.prefetch(server + '/b.txt')
+    fetcher.discard(server + '/b.txt', future)
+    assert dict(fetcher._prefetched) == {}
+
+
+def test_retries(server, fetcher):
+    assert fetcher.fetch(server + '/flaky') == b'finally'
+    assert Handler.calls['/flaky'] == 3
+
+
+def test_redirect(server, fetcher):
+    assert fetcher.fetch(server + '/moved') == b'a' * 1000
+
+
+def test_chunked(server, fetcher):
+    assert fetcher.fetch(server + '/chunked') == b'hello chunked world'
+    assert fetcher.fetch(server + '/a.txt') == b'a' * 1000
+
+
+def test_404(server, fetcher):
+    with pytest.raises(HTTPError) as e:
+        fetcher.fetch(server + '/missing.txt')
+
+    assert e.value.status == 404
+    assert Handler.calls['/missing.txt'] == 1
+
+
+def test_deadline(server, fetcher):
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        fetcher.fetch(server + '/hang', timeout=0.2)
+
+    assert time.time() - start < 1
+
+
+def test_attempt_timeout(server):
+    fetcher = AsyncFetcher(retries=1, backoff=0.01, timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            fetcher.fetch(server + '/hang')
+    finally:
+        fetcher.close()
+
+    assert Handler.calls['/hang'] == 2
+
+
+def test_hedge(server):
+    fetcher = AsyncFetcher(timeout=5, hedge_after=0.1)
+    try:
+        fetcher.fetch(server + '/a.txt')
+        assert fetcher.n_hedged == 0
+
+        # the hedged second request answers first
+        start = time.time()
+        assert fetcher.fetch(server + '/slow-once') == b'slow 2'
+        assert time.time() - start < 1
+        assert fetcher.n_hedged == 1
+    finally:
+        fetcher.close()
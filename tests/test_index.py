@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from tdesc.index import FlatIndex, IVFPQIndex, save_index, load_index
+
+
+def _data(n=2000, dim=32, n_queries=50, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(20, dim).astype(np.float32) * 3
+    descs = centers[rng.randint(0, 20, n)] + rng.randn(n, dim).astype(np.float32)
+    queries = descs[rng.choice(n, n_queries, replace=False)] + 0.1 * rng.randn(n_queries, dim).astype(np.float32)
+    return ['img-%d' % i for i in range(n)], descs, queries
+
+
+@pytest.mark.parametrize('metric', ['ip', 'l2'])
+def test_flat_is_exact(metric):
+    ids, descs, queries = _data()
+
+    # small blocks, so results are merged across blocks
+    index = FlatIndex(metric=metric, block_size=300)
+    index.add(ids[:1000], descs[:1000])
+    index.add(ids[1000:], descs[1000:])
+    scores, labels = index.search(queries, k=10)
+
+    if metric == 'ip':
+        expected = queries.dot(descs.T)
+    else:
+        expected = -((queries[:, None] - descs[None]) ** 2).sum(axis=-1)
+
+    assert np.array_equal(labels, np.argsort(-expected, axis=1)[:, :10])
+    assert np.allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :10], rtol=1e-4, atol=1e-2)
+
+
+def test_flat_save_load(tmp_path):
+    ids, descs, queries = _data(n=500)
+    index = FlatIndex(metric='l2', normalize=True)
+    index.add(ids, descs)
+    save_index(index, str(tmp_path / 'flat.index'))
+
+    loaded = load_index(str(tmp_path / 'flat.index'))
+    assert loaded.ids == ids
+    for a, b in zip(index.search(queries), loaded.search(queries)):
+        assert np.array_equal(a, b)
+
+
+def test_ivfpq_recall():
+    ids, descs, queries = _data()
+
+    flat = FlatIndex(metric='l2')
+    flat.add(ids, descs)
+    _, truth = flat.search(queries, k=1)
+
+    index = IVFPQIndex(n_lists=16, n_subq=8, n_probe=4, n_iter=10)
+    index.add(ids, descs)
+    _, labels = index.search(queries, k=10)
+
+    # the exact nearest neighbour is in the top 10 for (nearly) every query
+    recall = np.mean([t in row for t, row in zip(truth[:, 0], labels)])
+    assert recall >= 0.95
@@ -0,0 +1,87 @@
+import os
+
+from tdesc.packfile import PackWriter, PackReader, read_index, shard_path
+
+
+def _blobs(n, start=0):
+    return [('key-%d' % i, os.urandom(10 + i % 7)) for i in range(start, start + n)]
+
+
+def test_round_trip(tmp_path):
+    prefix = str(tmp_path / 'chips')
+    blobs = _blobs(50)
+
+    writer = PackWriter(prefix, flush_every=7)
+    for key, blob in blobs:
+        writer.write(key, blob)
+    writer.close()
+
+    reader = PackReader(prefix)
+    assert len(reader) == 50 and 'key-3' in reader
+    assert reader.get('key-3') == dict(blobs)['key-3']
+    assert list(reader) == blobs
+    reader.close()
+
+
+def test_shard_rollover(tmp_path):
+    prefix = str(tmp_path / 'chips')
+    blobs = _blobs(20)
+
+    writer = PackWriter(prefix, shard_bytes=64)
+    for key, blob in blobs:
+        writer.write(key, blob)
+    writer.close()
+
+    index = read_index(prefix)
+    shards = sorted(set(shard for shard, _, _ in index.values()))
+    assert len(shards) > 1 and shards == list(range(len(shards)))
+    assert all(os.path.getsize(shard_path(prefix, shard)) <= 64 for shard in shards)
+
+    reader = PackReader(prefix)
+    assert list(reader) == blobs
+    reader.close()
+
+
+def test_reopen_appends(tmp_path):
+    prefix = str(tmp_path / 'chips')
+    blobs = _blobs(30)
+
+    writer = PackWriter(prefix, shard_bytes=128)
+    for key, blob in blobs[:10]:
+        writer.write(key, blob)
+    writer.close()
+
+    # continues the last shard
+    writer = PackWriter(prefix, shard_bytes=128)
+    last = max(shard for shard, _, _ in read_index(prefix).values())
+    assert writer.shard == last
+    for key, blob in blobs[10:]:
+        writer.write(key, blob)
+    writer.close()
+
+    reader = PackReader(prefix)
+    assert list(reader) == blobs
+    reader.close()
+
+
+def test_reopen_after_torn_index_line(tmp_path):
+    prefix = str(tmp_path / 'chips')
+    blobs = _blobs(10)
+
+    writer = PackWriter(prefix)
+    for key, blob in blobs[:5]:
+        writer.write(key, blob)
+    writer.close()
+
+    # a run killed halfway through writing an index line
+    with open(prefix + '.index', 'a') as f:
+        f.write('key-5\t0\t12')
+
+    writer = PackWriter(prefix)
+    for key, blob in blobs[5:]:
+        writer.write(key, blob)
+    writer.close()
+
+    reader = PackReader(prefix)
+    assert list(reader) == blobs
+    reader.close()
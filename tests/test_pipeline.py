@@ -0,0 +1,62 @@
+import time
+
+from tdesc.pipeline import MicroBatcher, imap, reorder
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_microbatcher_batches():
+    batches = list(MicroBatcher(iter(range(10)), batch_size=4, max_wait=1))
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_imap():
+    def fn(x):
+        if x == 2:
+            time.sleep(0.2)
+
+        return x
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(imap(fn, range(5), pool, max_pending=2)) == [0, 1, 2, 3, 4]
+
+        out = list(imap(fn, range(5), pool, ordered=False))
+        assert sorted(out) == [0, 1, 2, 3, 4]
+        assert out[-1] == 2
+
+
+def test_microbatcher_flushes_rare_bucket_under_load():
+    # one 'rare' item, then a steady stream of 'common' ones and a slow consumer,
+    # so the input queue is never empty
+    items = ['rare'] + ['common'] * 400
+    batcher = MicroBatcher(iter(items), batch_size=4, max_wait=0.05, key=lambda x: x)
+
+    start = time.time()
+    for batch in batcher:
+        if batch == ['rare']:
+            break
+
+        time.sleep(0.01)
+
+    assert time.time() - start < 0.5
+
+
+def test_reorder():
+    assert list(reorder([(2, 'c'), (0, 'a'), (1, 'b'), (3, 'd')])) == ['a', 'b', 'c', 'd']
+
+
+def test_imap_deadline():
+    def fn(x):
+        if x == 2:
+            time.sleep(1)
+
+        return x
+
+    for ordered in (True, False):
+        with ThreadPoolExecutor(4) as pool:
+            start = time.time()
+            out = list(imap(fn, range(5), pool, ordered=ordered, deadline=0.2, on_timeout=lambda x: -x))
+            assert time.time() - start < 0.9
+
+        assert sorted(out) == [-2, 0, 1, 3, 4]
+        if ordered:
+            assert out == [0, 1, -2, 3, 4]
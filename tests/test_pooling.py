@@ -0,0 +1,69 @@
+import numpy as np
+
+from tdesc.pooling import crow, weighted_crow, rmac, rmac_regions, poolers
+
+
+def _maps():
+    """ one 2x2 map w/ 2 channels; channel 1 is only active in the bottom right """
+    maps = np.zeros((1, 2, 2, 2), dtype=np.float32)
+    maps[0, :, :, 0] = [[1, 2], [3, 4]]
+    maps[0, :, :, 1] = [[0, 0], [0, 5]]
+    return maps
+
+
+def test_shapes():
+    maps = np.random.RandomState(0).rand(3, 7, 5, 16).astype(np.float32)
+    for name, pool in poolers.items():
+        assert pool(maps).shape == (3, 16), name
+
+    assert np.allclose(np.linalg.norm(rmac(maps), axis=1), 1)
+
+
+def test_crow():
+    assert np.allclose(crow(_maps()), [[10, 5]])
+
+
+def test_weighted_crow():
+    # spatial weights: sqrt of the channel sums over their L2 norm
+    spatial = np.sqrt(np.array([1, 2, 3, 9]) / np.sqrt(1 + 4 + 9 + 81))
+    pooled = [np.dot([1, 2, 3, 4], spatial), 5 * spatial[3]]
+
+    # channel weights: log(total sparsity / channel sparsity); 4/4 and 1/4 of pixels are nonzero
+    channel = [np.log(1.25 / 1), np.log(1.25 / 0.25)]
+
+    assert np.allclose(weighted_crow(_maps()), [np.multiply(pooled, channel)], rtol=1e-4)
+
+
+def test_rmac_regions_square():
+    assert rmac_regions(3, 3) == [(0, 3, 0, 3)] + [
+        (y, y + 2, x, x + 2) for y in (0, 1) for x in (0, 1)
+    ] + [
+        (y, y + 1, x, x + 1) for y in (0, 1, 2) for x in (0, 1, 2)
+    ]
+
+
+def test_rmac_regions_non_square():
+    # one extra region along the long side at every level
+    assert rmac_regions(4, 6) == [(0, 4, 0, 4), (0, 4, 2, 6)] + [
+        (y, y + 2, x, x + 2) for y in (0, 2) for x in (0, 2, 4)
+    ] + [
+        (y, y + 2, x, x + 2) for y in (0, 1, 2) for x in (0, 1, 3, 4)
+    ]
+
+    for h, w in [(4, 6), (6, 4), (7, 10), (14, 9)]:
+        covered = np.zeros((h, w), dtype=bool)
+        for y0, y1, x0, x1 in rmac_regions(h, w):
+            assert 0 <= y0 < y1 <= h and 0 <= x0 < x1 <= w
+            assert y1 - y0 == x1 - x0
+            covered[y0:y1, x0:x1] = True
+
+        assert covered.all()
+
+
+def test_rmac():
+    # regions of a 2x2 map: the whole map (max [4, 5]), then each pixel once at
+    # level 2, and at level 3 pixel (0, 0) four times, (0, 1) and (1, 0) twice,
+    # (1, 1) once.  Only (1, 1) and the whole map have channel 1.
+    both = np.array([4, 5]) / np.sqrt(41)
+    total = 3 * both + np.array([11, 0])
+    assert np.allclose(rmac(_maps()), [total / np.linalg.norm(total)], rtol=1e-4)
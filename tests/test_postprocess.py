@@ -0,0 +1,115 @@
+import numpy as np
+
+from tdesc.artifacts import ImageArtifact
+from tdesc.postprocess import L2Normalize, PCAWhitening, Quantize, Pipeline, PostprocessWriter
+
+
+def _correlated(n=20000, dim=16, seed=0):
+    rng = np.random.RandomState(seed)
+    mixing = rng.randn(dim, dim).astype(np.float32)
+    return (rng.randn(n, dim).astype(np.float32) * np.linspace(5, 0.5, dim)).dot(mixing) + 3
+
+
+class ListWriter(object):
+    def __init__(self):
+        self.rows = []
+
+    def write(self, worker, result):
+        self.rows.extend(worker.rows(result))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RowWorker(object):
+    def rows(self, result):
+        image_artifact, descs = result
+        for k, desc in enumerate(descs):
+            yield image_artifact.id, k, [k, k, k, k], desc
+
+
+def _results(x, per_image=2):
+    return [
+        (ImageArtifact('img-%d' % i, 'img-%d' % i, save_results=False), x[i * per_image:(i + 1) * per_image])
+        for i in range(x.shape[0] // per_image)
+    ]
+
+
+def test_whitened_covariance_is_identity():
+    x = _correlated()
+    pca = PCAWhitening(8, fit_size=x.shape[0])
+    for batch in np.array_split(x, 37):
+        pca.partial_fit(batch)
+
+    assert pca.ready
+    y = pca.transform(x)
+    assert y.shape == (x.shape[0], 8)
+    assert np.allclose(y.mean(axis=0), 0, atol=1e-3)
+    assert np.allclose(np.cov(y, rowvar=False, bias=True), np.eye(8), atol=1e-3)
+
+
+def test_quantize_error_bounded():
+    x = L2Normalize().transform(_correlated(n=1000))
+
+    int8 = Quantize('int8').transform(x)
+    assert int8.dtype == np.int8
+    assert np.abs(int8 / 127.0 - x).max() <= 0.5 / 127 + 1e-6
+
+    float16 = Quantize('float16').transform(x)
+    assert float16.dtype == np.float16
+    assert np.abs(float16.astype(np.float32) - x).max() <= 2 ** -11
+
+
+def test_writer_holds_rows_until_fit():
+    x = _correlated(n=1000)
+    writer = ListWriter()
+    pipeline = Pipeline([L2Normalize(), PCAWhitening(4, fit_size=500), L2Normalize()])
+    post = PostprocessWriter(writer, pipeline, batch_size=64)
+
+    results = _results(x)
+    for result in results[:200]:
+        post.write(RowWorker(), result)
+    assert writer.rows == []
+
+    for result in results[200:]:
+        post.write(RowWorker(), result)
+    post.close()
+
+    # every row, in order, w/ its metadata, through the fit from the first 500
+    assert [(id, k, bbox) for id, k, bbox, _ in writer.rows] == [
+        (ia.id, k, [k] * 4) for ia, descs in results for k in range(len(descs))
+    ]
+    assert np.allclose(np.array([desc for _, _, _, desc in writer.rows]), pipeline.transform(x), atol=1e-5)
+
+
+def test_short_stream_fits_on_close():
+    writer = ListWriter()
+    post = PostprocessWriter(writer, Pipeline([PCAWhitening(4, fit_size=10000)]))
+    for result in _results(_correlated(n=100)):
+        post.write(RowWorker(), result)
+    post.close()
+
+    assert len(writer.rows) == 100 and writer.rows[0][3].shape == (4,)
+
+
+def test_fit_reused_on_reopen(tmp_path):
+    path = str(tmp_path / 'pca.npz')
+    x = _correlated(n=2000)
+
+    pca = PCAWhitening(8, fit_size=1000, path=path)
+    pca.partial_fit(x[:1000])
+    assert pca.ready
+
+    reopened = PCAWhitening(8, fit_size=1000, path=path)
+    assert reopened.ready
+    assert np.array_equal(reopened.transform(x), pca.transform(x))
+
+    # so a resumed run writes rows straight away, w/ the same projection
+    writer = ListWriter()
+    post = PostprocessWriter(writer, Pipeline([PCAWhitening(8, fit_size=1000, path=path)]), batch_size=1)
+    post.write(RowWorker(), _results(x[1000:])[0])
+    assert len(writer.rows) == 2
+    assert np.allclose(writer.rows[0][3], pca.transform(x[1000:1001])[0])
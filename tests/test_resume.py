@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+import numpy as np
+
+from tdesc.bench import make_corpus
+from tdesc.artifacts import ImageArtifact
+from tdesc.checkpoint import Checkpoint
+from tdesc.writers import BinaryWriter, BinaryReader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RowWorker(object):
+    def rows(self, result):
+        image_artifact, desc = result
+        yield image_artifact.id, None, None, desc
+
+
+def _result(i, dim=4):
+    return ImageArtifact('img-%d' % i, 'img-%d' % i, save_results=False), np.full(dim, i, dtype=np.float32)
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / 'progress')
+    checkpoint = Checkpoint(path, sync_every=2)
+    for i in range(5):
+        checkpoint.mark('img-%d' % i)
+    checkpoint.close()
+
+    # a partial trailing record, as from a crash mid-write
+    with open(path, 'ab') as f:
+        f.write(b'\1\2\3')
+
+    checkpoint = Checkpoint(path)
+    assert len(checkpoint) == 5 and 'img-3' in checkpoint and 'img-5' not in checkpoint
+
+    todo = [ImageArtifact('img-%d' % i, 'img-%d' % i, save_results=False) for i in range(8)]
+    assert [ia.id for ia in checkpoint.filter(todo)] == ['img-5', 'img-6', 'img-7']
+    assert checkpoint.n_skipped == 5
+    checkpoint.close()
+
+
+def test_binary_repair_after_torn_write(tmp_path):
+    prefix = str(tmp_path / 'out')
+    writer = BinaryWriter(prefix, flush_every=2)
+    for i in range(5):
+        writer.write(RowWorker(), _result(i))
+
+    # killed before the last row's index line was written
+    writer.desc_file.flush()
+    assert open(prefix + '.index').read().count('\n') == 4
+
+    # plus a partial index line
+    with open(prefix + '.index', 'a') as f:
+        f.write('img-4\t')
+
+    writer = BinaryWriter(prefix)
+    writer.write(RowWorker(), _result(4))
+    writer.close()
+
+    reader = BinaryReader(prefix)
+    assert reader.ids == ['img-%d' % i for i in range(5)]
+    assert list(reader.descs[:, 0]) == [0, 1, 2, 3, 4]
+
+
+def _tdesc(args, **kwargs):
+    return subprocess.Popen(
+        [sys.executable, '-m', 'tdesc', '--model', 'stub', '--target-dim', '32'] + args,
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT, **kwargs
+    )
+
+
+def _run(args, paths):
+    proc = _tdesc(args)
+    proc.communicate(('\n'.join(paths) + '\n').encode())
+    assert proc.returncode == 0
+
+
+def _by_id(reader):
+    return dict((id, np.array(reader.descs[i])) for i, id in enumerate(reader.ids))
+
+
+def test_binary_resume_after_kill(tmp_path):
+    paths = make_corpus(str(tmp_path / 'images'), 200, size=(64, 48))
+
+    ref = str(tmp_path / 'ref')
+    _run(['--output-format', 'binary', '--outpath', ref], paths)
+
+    out, prog = str(tmp_path / 'out'), str(tmp_path / 'prog')
+    args = ['--output-format', 'binary', '--outpath', out, '--resume', prog]
+
+    proc = _tdesc(args + ['--stub-latency', '0.02'])
+    proc.stdin.write(('\n'.join(paths) + '\n').encode())
+    proc.stdin.flush()
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if os.path.exists(out + '.desc') and os.path.getsize(out + '.desc') > 16 * 1024:
+            break
+
+        time.sleep(0.01)
+
+    os.kill(proc.pid, signal.SIGKILL)
+    proc.wait()
+
+    _run(args, paths)
+
+    reader = BinaryReader(out)
+    assert len(reader) == len(reader.index)
+
+    expected = _by_id(BinaryReader(ref))
+    assert set(reader.ids) == set(expected)
+    for id, desc in _by_id(reader).items():
+        np.testing.assert_array_equal(desc, expected[id])
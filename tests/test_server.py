@@ -0,0 +1,115 @@
+import io
+import time
+import socket
+import threading
+import pytest
+
+from tdesc.bench import make_corpus
+from tdesc.artifacts import ImageArtifact
+from tdesc.writers import TSVWriter
+from tdesc.server import Server, _Handler, _UnixServer
+from tdesc.workers.stub_worker import StubWorker
+
+
+class FlakyWorker(StubWorker):
+    """ Fails on images in a 'broken' directory """
+    def featurize(self, image_artifact, img):
+        if '/broken/' in image_artifact.filepath:
+            raise ValueError('bad image')
+
+        return StubWorker.featurize(self, image_artifact, img)
+
+    def featurize_batch(self, batch):
+        return [self.featurize(image_artifact, img) for image_artifact, img in batch]
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = make_corpus(str(tmp_path / 'images'), 12, size=(64, 48))
+    bad = make_corpus(str(tmp_path / 'broken'), 1, size=(64, 48))
+    return paths, bad[0]
+
+
+@pytest.fixture
+def server(tmp_path):
+    worker = FlakyWorker(target_dim=32)
+    server = Server(worker, {"batch_size" : 4, "max_wait" : 0.01}, TSVWriter, max_inflight=8, max_per_client=4)
+
+    path = str(tmp_path / 'tdesc.sock')
+    listener = _UnixServer(path, _Handler)
+    listener.tdesc = server
+    threading.Thread(target=listener.serve_forever, daemon=True).start()
+    threading.Thread(target=server.run, daemon=True).start()
+
+    yield server, path
+
+    listener.shutdown()
+    listener.server_close()
+    server.close()
+
+
+def _request(path, lines):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(''.join(line + '\n' for line in lines).encode())
+    sock.shutdown(socket.SHUT_WR)
+
+    out = sock.makefile('rb').read().decode()
+    sock.close()
+    assert out.startswith('ok\n')
+    return out[3:]
+
+
+def _expected(paths):
+    stream = io.StringIO()
+    writer = TSVWriter(stream)
+    worker = StubWorker(target_dim=32)
+    for result in worker.run([ImageArtifact(p, p, save_results=False) for p in paths]):
+        writer.write(worker, result)
+
+    return stream.getvalue()
+
+
+def test_concurrent_clients(server, paths):
+    server, path = server
+    paths, _ = paths
+
+    outs = [None] * 4
+
+    def client(i):
+        outs[i] = _request(path, paths)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outs == [_expected(paths)] * 4
+
+
+def test_bad_image_keeps_serving(server, paths):
+    server, path = server
+    paths, bad = paths
+
+    assert _request(path, paths[:3] + [bad, '/missing.jpg'] + paths[3:]) == _expected(paths)
+    assert _request(path, paths) == _expected(paths)
+
+
+def test_slots_released(server, paths):
+    server, path = server
+    paths, _ = paths
+
+    # a client that sends a request and goes away without reading
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(''.join(p + '\n' for p in paths).encode())
+    sock.shutdown(socket.SHUT_WR)
+    sock.close()
+
+    deadline = time.time() + 5
+    while time.time() < deadline and (server.pending or server.inflight._value < 8):
+        time.sleep(0.05)
+
+    assert server.inflight._value == 8
+    assert _request(path, paths) == _expected(paths)
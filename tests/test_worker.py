@@ -0,0 +1,232 @@
+import io
+import os
+import sys
+import json
+import logging
+import subprocess
+import pytest
+import numpy as np
+
+from PIL import Image
+
+from tdesc.bench import serve
+from tdesc.trace import Tracer
+from tdesc.metrics import Metrics
+from tdesc.artifacts import ImageArtifact
+from tdesc.writers import DeadLetterWriter
+from tdesc.__main__ import parse_args
+from tdesc.workers.base import BaseWorker
+from tdesc.workers.multi_worker import MultiWorker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MeanWorker(BaseWorker):
+    """ Model-free worker: each descriptor is the mean pixel, repeated `dim` times """
+    def __init__(self, target_dim=32, dim=4):
+        self.target_dim = target_dim
+        self.dim = dim
+        self.logger = logging
+
+    def decode_args(self):
+        return {"target_size" : (self.target_dim, self.target_dim)}
+
+    def prepare(self, img):
+        return np.expand_dims(img.astype(np.float32), axis=0)
+
+    def featurize(self, image_artifact, img):
+        return self.featurize_batch([(image_artifact, img)])[0]
+
+    def featurize_batch(self, batch):
+        image_artifacts, imgs = zip(*batch)
+        means = np.concatenate(imgs, axis=0).mean(axis=(1, 2))
+        return [(image_artifact, np.resize(mean, self.dim)) for image_artifact, mean in zip(image_artifacts, means)]
+
+    def rows(self, result):
+        image_artifact, feat = result
+        yield image_artifact.id, None, None, feat
+
+
+def _images(outdir, n_images, size=(64, 48)):
+    os.makedirs(outdir)
+
+    rng = np.random.RandomState(123)
+    paths = []
+    for i in range(n_images):
+        path = os.path.join(outdir, '%06d.jpg' % i)
+        Image.fromarray((rng.rand(size[1], size[0], 3) * 255).astype(np.uint8)).save(path)
+        paths.append(path)
+
+    return paths
+
+
+def _artifacts(paths):
+    return [ImageArtifact(path, path, save_results=False) for path in paths]
+
+
+class CountingMultiWorker(MultiWorker):
+    n_decoded = 0
+
+    def decode(self, src):
+        self.n_decoded += 1
+        return MultiWorker.decode(self, src)
+
+
+def test_multi_worker_one_pass(tmp_path):
+    paths = _images(str(tmp_path / 'images'), 5)
+
+    worker = CountingMultiWorker([
+        ('small', MeanWorker(target_dim=16, dim=8)),
+        ('large', MeanWorker(target_dim=32, dim=4)),
+    ])
+    results = list(worker.run(_artifacts(paths), batch_size=2, max_wait=0.01))
+    assert worker.n_decoded == len(paths)
+
+    out = [worker.to_dict(result) for result in results]
+    assert [o['_id'] for o in out] == paths
+
+    # same descriptors as each model run on its own (w/o draft decoding, which
+    # MultiWorker doesn't do, since it decodes once at native size)
+    for name, target_dim, dim in [('small', 16, 8), ('large', 32, 4)]:
+        alone = MeanWorker(target_dim=target_dim, dim=dim)
+        alone.draft = False
+        expected = [alone.to_dict(result) for result in alone.run(_artifacts(paths))]
+        for o, e in zip(out, expected):
+            assert o[name]['descriptors'] == e['descriptors']
+            assert len(o[name]['descriptors'][0]['desc']) == dim
+
+
+
+def test_reject_sharded_face_in_multi(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['tdesc', '--model', 'vgg16,dlib_face', '--face-procs', '4'])
+    with pytest.raises(AssertionError):
+        parse_args()
+
+    monkeypatch.setattr(sys, 'argv', ['tdesc', '--model', 'dlib_face', '--face-procs', '4'])
+    assert parse_args().face_procs == 4
+
+def test_metrics(tmp_path):
+    paths = _images(str(tmp_path / 'images'), 5)
+    stream, textfile = io.StringIO(), str(tmp_path / 'tdesc.prom')
+
+    worker = MeanWorker()
+    metrics = Metrics(stream=stream, textfile=textfile, interval=2)
+    assert len(list(worker.run(_artifacts(paths), batch_size=2, max_wait=0.01, metrics=metrics))) == 5
+
+    reports = [json.loads(line) for line in stream.getvalue().strip().split('\n')]
+    assert len(reports) == 3  # after 2 and 4 images, and at the end
+
+    last = reports[-1]
+    for name in ('input', 'read', 'started', 'featurized', 'done'):
+        assert last['counters'][name] == 5
+
+    assert last['stages']['decode']['count'] == 5
+    assert last['stages']['queue_wait']['count'] == 5
+    assert 1 <= last['stages']['inference']['count'] <= 5
+
+    with open(textfile) as f:
+        assert 'tdesc_images_total{state="done"} 5' in f.read().split('\n')
+
+
+def test_trace(tmp_path):
+    paths = _images(str(tmp_path / 'images'), 4)
+    path = str(tmp_path / 'trace.json')
+
+    tracer = Tracer(path, sample=1.0, flush_every=3)
+    worker = MeanWorker()
+    list(worker.run(_artifacts(paths), batch_size=2, max_wait=0.01, metrics=Metrics(interval=0, tracer=tracer)))
+    tracer.close()
+
+    with open(path) as f:
+        events = [e for e in json.load(f) if e['ph'] == 'X']
+
+    for stage in ('decode', 'prepare', 'queue_wait', 'inference'):
+        assert sorted(e['args']['id'] for e in events if e['name'] == stage) == paths
+
+    # nothing is traced w/ sample=0
+    tracer = Tracer(path, sample=0.0)
+    list(MeanWorker().run(_artifacts(paths), metrics=Metrics(interval=0, tracer=tracer)))
+    tracer.close()
+
+    with open(path) as f:
+        assert [e for e in json.load(f) if e['ph'] == 'X'] == []
+
+
+def test_workers_imported_lazily():
+    code = '; '.join([
+        'import sys, tdesc.workers',
+        'from tdesc.workers import StubWorker',
+        'print(sorted(m for m in sys.modules if m.startswith("tdesc.workers.")))',
+    ])
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    assert out.decode().strip() == "['tdesc.workers.base', 'tdesc.workers.stub_worker']"
+
+
+def test_deadline_drops_slow_urls(tmp_path):
+    paths = _images(str(tmp_path / 'images'), 4)
+    server, base = serve(str(tmp_path / 'images'), latency=1.0)
+    urls = ['%s/%s' % (base, os.path.basename(path)) for path in paths]
+
+    worker = MeanWorker()
+    dead_letters = DeadLetterWriter(str(tmp_path / 'dead.jsonl'))
+    try:
+        # local files first, so the URLs queued behind them time out before
+        # the one IO thread gets to them
+        results, fetcher = [], None
+        for result in worker.run(_artifacts(paths + urls), io_threads=1, deadline=0.5, dead_letters=dead_letters):
+            results.append(result)
+            fetcher = worker.fetcher
+    finally:
+        dead_letters.close()
+        server.shutdown()
+
+    assert [ia.id for ia, _ in results] == paths
+
+    # prefetches of timed out images are cancelled, not left holding bodies
+    assert dict(fetcher._prefetched) == {}
+
+    with open(str(tmp_path / 'dead.jsonl')) as f:
+        dead = [json.loads(line) for line in f]
+
+    assert sorted(d['_id'] for d in dead) == sorted(urls)
+    assert set(d['stage'] for d in dead) == {'deadline'}
+
+
+def test_timed_out_after_read_forgets_ready_time(tmp_path):
+    # imap can give up on an image just as its read finishes
+    paths = _images(str(tmp_path / 'images'), 1)
+    image_artifact = _artifacts(paths)[0]
+
+    worker = MeanWorker()
+    worker.metrics = Metrics(interval=0)
+
+    _, img = worker.do_io(image_artifact)
+    assert img is not None and id(image_artifact) in worker.metrics._ready
+
+    worker._timed_out(image_artifact)
+    assert worker.metrics._ready == {}
+
+
+class FailingWorker(MeanWorker):
+    """ Fails on the second image """
+    def featurize(self, image_artifact, img):
+        if image_artifact.id.endswith('000001.jpg'):
+            raise ValueError('bad image')
+
+        return MeanWorker.featurize_batch(self, [(image_artifact, img)])[0]
+
+    def featurize_batch(self, batch):
+        return [self.featurize(image_artifact, img) for image_artifact, img in batch]
+
+
+def test_skip_errors_counts_featurize_failures(tmp_path):
+    paths = _images(str(tmp_path / 'images'), 4)
+    metrics = Metrics(interval=0)
+
+    worker = FailingWorker()
+    results = list(worker.run(_artifacts(paths), batch_size=2, max_wait=0.01, skip_errors=True, metrics=metrics))
+    assert [result is None for result in results] == [False, True, False, False]
+
+    assert metrics.counters['featurize_failed'] == 1
+    assert metrics.counters.get('failed', 0) == 0
+    assert metrics.gauges['io']() == 0
@@ -0,0 +1,247 @@
+import os
+import sys
+import h5py
+import pytest
+import numpy as np
+
+from tdesc.__main__ import parse_args
+from tdesc.artifacts import ImageArtifact, YoloArtifact
+from tdesc.store import ShardedStore
+from tdesc.writers import BinaryWriter, BinaryReader, StoreWriter, DetectionWriter, read_detections
+
+
+class NamedWorker(object):
+    """ Rows like `VGG16Worker` w/ a single `descriptors` entry """
+    def __init__(self, name='crow', dim=8):
+        self.name = name
+        self.dim = dim
+
+    def artifact(self, result):
+        return result[0]
+
+    def rows(self, result):
+        image_artifact, desc = result
+        yield image_artifact.id, self.name, None, desc
+
+
+class FaceWorker(object):
+    """ Rows like `DlibFaceWorker`: one per face, w/ k and a bbox """
+    def artifact(self, result):
+        return result[0]
+
+    def rows(self, result):
+        image_artifact, descs = result
+        for k, desc in enumerate(descs):
+            yield image_artifact.id, k, [k, k + 10, k + 20, k + 30], desc
+
+
+def _results(n, dim=8):
+    return [(ImageArtifact('img-%d' % i, 'img-%d' % i, save_results=False), np.full((i % 3, dim), i, dtype=np.float32)) for i in range(n)]
+
+
+def _named_results(n, dim=8):
+    return [(ImageArtifact('img-%d' % i, 'img-%d' % i, save_results=False), np.full(dim, i, dtype=np.float32)) for i in range(n)]
+
+
+def test_binary_round_trip(tmp_path):
+    prefix = str(tmp_path / 'out')
+    writer = BinaryWriter(prefix)
+    for result in _results(4):
+        writer.write(FaceWorker(), result)
+    writer.close()
+
+    # re-opening appends
+    writer = BinaryWriter(prefix)
+    for result in _results(6)[4:]:
+        writer.write(FaceWorker(), result)
+    writer.close()
+
+    reader = BinaryReader(prefix)
+    assert len(reader) == 1 + 2 + 1 + 2
+    assert reader.ids == ['img-1', 'img-2', 'img-2', 'img-4', 'img-5', 'img-5']
+    assert reader.index[2] == ('img-2', 1, [1, 11, 21, 31])
+    assert list(reader.descs[:, 0]) == [1, 2, 2, 4, 5, 5]
+
+    # a partially written trailing row is ignored
+    with open(prefix + '.desc', 'ab') as f:
+        f.write(b'\0' * 5)
+
+    reader = BinaryReader(prefix)
+    assert len(reader) == 6
+    assert len(reader.index) == 6
+
+
+def test_store_round_trip(tmp_path):
+    store = ShardedStore(str(tmp_path / 'store'), n_shards=2, buffer_rows=2)
+    writer = StoreWriter(store)
+    results = _results(6)
+    for result in results:
+        writer.write(FaceWorker(), result)
+    writer.close()
+
+    for image_artifact, descs in results:
+        if len(descs):
+            assert np.array_equal(image_artifact.load(), descs)
+        else:
+            assert image_artifact.rows is None
+
+    shard, start, stop = results[5][0].rows
+    with h5py.File(store.shard_path(shard), 'r') as f:
+        assert list(f['ids'].asstr()[start:stop]) == ['img-5', 'img-5']
+        assert list(f['k'][start:stop]) == [0, 1]
+        assert f['bbox'][start + 1].tolist() == [1, 11, 21, 31]
+
+
+def test_binary_named_descriptor(tmp_path):
+    prefix = str(tmp_path / 'out')
+    writer = BinaryWriter(prefix)
+    for result in _named_results(5):
+        writer.write(NamedWorker(), result)
+    writer.close()
+
+    reader = BinaryReader(prefix)
+    assert reader.descriptor == 'crow'
+    assert reader.index == [('img-%d' % i, None, None) for i in range(5)]
+    assert reader.descs[3, 0] == 3
+
+    writer = BinaryWriter(prefix)
+    with pytest.raises(AssertionError):
+        writer.write(NamedWorker('fc2'), _named_results(1)[0])
+
+
+def test_store_named_descriptor(tmp_path):
+    store = ShardedStore(str(tmp_path / 'store'), n_shards=2)
+    writer = StoreWriter(store)
+    results = _named_results(4)
+    for result in results:
+        writer.write(NamedWorker(), result)
+    writer.close()
+
+    assert results[2][0].load()[0, 0] == 2
+    with h5py.File(store.shard_path(store.shard_for('img-2')), 'r') as f:
+        assert f.attrs['descriptor'] == 'crow'
+        assert set(f['k'][:]) == {-1}
+
+def test_binary_flush_syncs_both_files(tmp_path, monkeypatch):
+    prefix = str(tmp_path / 'out')
+    writer = BinaryWriter(prefix)
+    for result in _results(3):
+        writer.write(FaceWorker(), result)
+
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    writer.flush()
+    assert synced == [writer.desc_file.fileno(), writer.index_file.fileno()]
+    writer.close()
+
+
+def _parse_args(monkeypatch, argv):
+    monkeypatch.setattr(sys, 'argv', ['tdesc'] + argv)
+    return parse_args()
+
+
+@pytest.mark.parametrize('argv', [
+    ['--descriptors', 'fc2,crow', '--l2-norm'],
+    ['--descriptors', 'fc2,crow', '--pca-dim', '64'],
+    ['--descriptors', 'fc2,crow', '--output-format', 'binary', '--outpath', 'x'],
+])
+def test_reject_mixed_descriptors(argv, monkeypatch):
+    with pytest.raises(AssertionError):
+        _parse_args(monkeypatch, argv)
+
+def test_int8_needs_quantize(tmp_path, monkeypatch):
+    with pytest.raises(AssertionError):
+        _parse_args(monkeypatch, ['--output-format', 'binary', '--outpath', 'x', '--output-dtype', 'int8'])
+
+    assert _parse_args(monkeypatch, ['--output-format', 'binary', '--outpath', 'x', '--l2-norm', '--quantize', 'int8']).output_dtype == 'int8'
+
+    floats = np.array([[300.7, -5000.2, 0.4, 1e6]])
+    writer = BinaryWriter(str(tmp_path / 'out'), dtype='int8')
+    with pytest.raises(ValueError):
+        writer.write(FaceWorker(), (ImageArtifact('a', 'a'), floats))
+
+    store = ShardedStore(str(tmp_path / 'store'), n_shards=1, dtype='int8', buffer_rows=1)
+    with pytest.raises(ValueError):
+        StoreWriter(store).write(FaceWorker(), (ImageArtifact('a', 'a'), floats))
+
+
+@pytest.mark.parametrize('model', ['yolo', 'dlib_align', 'vgg16,dlib_face'])
+def test_reject_postprocess_json(model, monkeypatch):
+    with pytest.raises(AssertionError):
+        _parse_args(monkeypatch, ['--model', model, '--l2-norm', '--outpath', 'x',
+                                  '--yolo-cfg-path', 'c', '--yolo-weight-path', 'w'])
+
+
+class DetectionWorker(object):
+    class_names = ['person', 'car', 'dog']
+
+    def artifact(self, result):
+        return result
+
+
+def _detections(n, start=0):
+    out = []
+    for i in range(start, start + n):
+        ya = YoloArtifact('img-%d' % i, 'img-%d' % i, save_results=False)
+        n_dets = i % 3
+        ya.set_detections(
+            [i % 3] * n_dets,
+            [0.5 + 0.1 * j for j in range(n_dets)],
+            [[j, j + 10, i, i + 20] for j in range(n_dets)],
+            DetectionWorker.class_names,
+        )
+        out.append(ya)
+
+    return out
+
+
+def _check_detections(prefix, yolo_artifacts):
+    dets, index, class_names = read_detections(prefix)
+    assert class_names == DetectionWorker.class_names
+    assert [(id, created) for id, _, _, created in index] == [(ya.id, str(ya.created)) for ya in yolo_artifacts]
+
+    for (_, start, stop, _), ya in zip(index, yolo_artifacts):
+        assert stop - start == len(ya)
+        assert np.array_equal(dets[start:stop, 0], ya.cls)
+        assert np.allclose(dets[start:stop, 1], ya.confidence)
+        assert np.array_equal(dets[start:stop, 2:], ya.bbox)
+
+
+def test_detections_round_trip(tmp_path):
+    prefix = str(tmp_path / 'dets')
+    yolo_artifacts = _detections(20)
+
+    writer = DetectionWriter(prefix, flush_every=7)
+    for ya in yolo_artifacts[:10]:
+        writer.write(DetectionWorker(), ya)
+    writer.close()
+
+    writer = DetectionWriter(prefix, flush_every=7)
+    for ya in yolo_artifacts[10:]:
+        writer.write(DetectionWorker(), ya)
+    writer.close()
+
+    _check_detections(prefix, yolo_artifacts)
+
+
+def test_detections_reopen_after_torn_write(tmp_path):
+    prefix = str(tmp_path / 'dets')
+    yolo_artifacts = _detections(10)
+
+    writer = DetectionWriter(prefix)
+    for ya in yolo_artifacts[:5]:
+        writer.write(DetectionWorker(), ya)
+    writer.close()
+
+    # a run killed partway through its next flush: half a row, half an index line
+    with open(prefix + '.dets', 'ab') as f:
+        f.write(b'\0' * 30)
+    with open(prefix + '.index', 'a') as f:
+        f.write('img-99\t5')
+
+    writer = DetectionWriter(prefix)
+    for ya in yolo_artifacts[5:]:
+        writer.write(DetectionWorker(), ya)
+    writer.close()
+
+    _check_detections(prefix, yolo_artifacts)
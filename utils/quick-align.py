@@ -2,6 +2,10 @@
 
 """
     quick-align.py
+
+    One JPEG per face.  For large corpora, prefer
+        python -m tdesc --model dlib_align --outpath chips/pack
+    which writes chips into packed shards instead
 """
 
 import os
@@ -19,7 +23,7 @@ from concurrent.futures import ProcessPoolExecutor
 print_interval = 200
 
 det = dlib.get_frontal_face_detector()
-shapepath = '/home/bjohnson/.tdesc/models/dlib/shape_predictor_68_face_landmarks.dat'
+shapepath = os.path.join(os.environ['HOME'], '.tdesc', 'models/dlib/shape_predictor_68_face_landmarks.dat')
 fa = dlib.face_align(shapepath)
 
 # --
@@ -33,6 +37,7 @@ def parse_args():
     parser.add_argument('--threshold', type=float, default=0.0)
     parser.add_argument('--outdir', type=str, default='./face_chips/')
     parser.add_argument('--strip-path', type=int, default=2)
+    parser.add_argument('--n-procs', type=int, default=os.cpu_count())
     return parser.parse_args()
 
 def do_work(path, outdir, best_face=False, size=150, padding=0.25, threshold=0.0, strip_path=2):
@@ -97,7 +102,7 @@ if __name__ == "__main__":
             strip_path=args.strip_path,
         )
     
-    with ProcessPoolExecutor(max_workers=16) as execr:
+    with ProcessPoolExecutor(max_workers=args.n_procs) as execr:
         res = execr.map(f, gen)
         for r in res:
             i += 1